@@ -5,6 +5,136 @@ STORAGE_PATH = "./storage"
 STABILITY_API_KEY = os.getenv("STABILITY_API_KEY", "your_key_here")
 QWEN_API_KEY = os.getenv("QWEN_API_KEY", "your_key_here")
 
+# Internal state (task queue database etc.). Kept outside STORAGE_PATH so it is
+# never exposed through the /data static mount.
+STATE_PATH = os.getenv("MONSTER_STATE_PATH", "./state")
+TASK_DB_PATH = os.getenv("MONSTER_TASK_DB", os.path.join(STATE_PATH, "tasks.db"))
+
+# Task queue tuning
+TASK_LEASE_SECONDS = int(os.getenv("MONSTER_TASK_LEASE_SECONDS", "300"))
+TASK_MAX_ATTEMPTS = int(os.getenv("MONSTER_TASK_MAX_ATTEMPTS", "3"))
+TASK_RETRY_BACKOFF_SECONDS = float(os.getenv("MONSTER_TASK_RETRY_BACKOFF", "5"))
+# Run a worker inside the web process. Disable when running `python -m backend.worker` separately.
+EMBEDDED_WORKER = os.getenv("MONSTER_EMBEDDED_WORKER", "1") == "1"
+EMBEDDED_WORKER_CONCURRENCY = int(os.getenv("MONSTER_EMBEDDED_WORKER_CONCURRENCY", "4"))
+
+# Default number of tasks of each group allowed to run at once across all workers.
+# Override with e.g. MONSTER_TASK_LIMITS="chapter=4,illustration=2"; adjustable at
+# runtime through PUT /api/tasks/limits.
+TASK_CONCURRENCY_LIMITS = {
+    "outline": 2,
+    "chapter": 2,
+    "illustration": 1,
+    "audio": 2,
+    "audiobook": 1,
+    "export": 1,
+    "extraction": 1,
+}
+for _item in filter(None, os.getenv("MONSTER_TASK_LIMITS", "").split(",")):
+    _group, _, _limit = _item.partition("=")
+    TASK_CONCURRENCY_LIMITS[_group.strip()] = int(_limit)
+DEFAULT_TASK_CONCURRENCY = int(os.getenv("MONSTER_DEFAULT_TASK_CONCURRENCY", "1"))
+
+# Task event streams are woken instantly by updates made in the same process;
+# updates from separate worker processes are picked up within this interval.
+TASK_EVENT_POLL_SECONDS = float(os.getenv("MONSTER_TASK_EVENT_POLL_SECONDS", "1.0"))
+TASK_EVENT_KEEPALIVE_SECONDS = 15
+
+# Finished tasks are archived once older than the TTL or beyond the newest
+# TASK_RETENTION_MAX; workers run the pruning every TASK_PRUNE_INTERVAL_SECONDS.
+TASK_RETENTION_SECONDS = int(os.getenv("MONSTER_TASK_RETENTION_SECONDS", str(24 * 3600)))
+TASK_RETENTION_MAX = int(os.getenv("MONSTER_TASK_RETENTION_MAX", "500"))
+TASK_PRUNE_INTERVAL_SECONDS = 300
+# Archived tasks can still be looked up by id until they are this old, or beyond the newest TASK_ARCHIVE_MAX
+TASK_ARCHIVE_RETENTION_SECONDS = int(os.getenv("MONSTER_TASK_ARCHIVE_RETENTION_SECONDS", str(30 * 24 * 3600)))
+TASK_ARCHIVE_MAX = int(os.getenv("MONSTER_TASK_ARCHIVE_MAX", "10000"))
+# Clients reconnecting after longer than this get a fresh snapshot instead of a replay
+TASK_EVENT_RETENTION_SECONDS = 3600
+
+# Shared coordination (per-novel write locks, shared task state):
+# "local" = file locks + SQLite, fine for several processes on one host;
+# "redis" = any Redis-protocol server, for several hosts.
+COORDINATION_BACKEND = os.getenv("MONSTER_COORDINATION_BACKEND", "local")
+REDIS_URL = os.getenv("MONSTER_REDIS_URL", "redis://localhost:6379/0")
+NOVEL_LOCK_TIMEOUT_SECONDS = 30
+
+# Z-Image jobs: at most this many gradio submit() jobs in flight per process,
+# the rest wait in a local queue. Job status is polled at this interval.
+IMAGE_MAX_CONCURRENT_JOBS = int(os.getenv("MONSTER_IMAGE_JOBS", "4"))
+IMAGE_STATUS_POLL_SECONDS = 1.0
+IMAGE_RESOLUTION = "1024x1024 ( 1:1 )"
+IMAGE_STEPS = 8
+# Derive the seed from the prompt unless a request says otherwise, making
+# repeated prompts exact cache hits (off: every render gets a random seed).
+IMAGE_DETERMINISTIC_SEED = os.getenv("MONSTER_IMAGE_DETERMINISTIC_SEED", "0") == "1"
+# Rendered images with a known seed are cached here, LRU-evicted beyond the budget
+IMAGE_CACHE_PATH = os.path.join(STORAGE_PATH, "image_cache")
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("MONSTER_IMAGE_CACHE_MB", "512")) * 1024 * 1024
+# Resized variants served for /data/<image>?w=N (needs Pillow); N is snapped up to one of these widths
+IMAGE_VARIANT_PATH = os.path.join(STORAGE_PATH, "variants")
+IMAGE_VARIANT_WIDTHS = (128, 256, 512)
+IMAGE_VARIANT_QUALITY = 80
+# The Z-Image client connects in the background: failed attempts are retried
+# with exponential backoff, a healthy connection is re-checked periodically,
+# and jobs waiting longer than IMAGE_CONNECT_WAIT_SECONDS for it are failed.
+Z_IMAGE_SPACE = os.getenv("MONSTER_Z_IMAGE_SPACE", "Tongyi-MAI/Z-Image-Turbo")
+IMAGE_CONNECT_BACKOFF_SECONDS = 5
+IMAGE_CONNECT_BACKOFF_MAX_SECONDS = 300
+IMAGE_HEALTH_CHECK_SECONDS = 60
+IMAGE_CONNECT_WAIT_SECONDS = 120
+
+# Chapter illustrations: chapter text is cut into sentence-aligned segments of
+# at most this many characters, one image each; prompts are written
+# concurrently and images are submitted to the image job pool in batches.
+ILLUSTRATION_CHUNK_SIZE = 500
+ILLUSTRATION_PROMPT_CONCURRENCY = 4
+ILLUSTRATION_BATCH_SIZE = 4
+
+# Text-to-speech: text is split into sentence-aligned segments of at most
+# TTS_SEGMENT_CHARS, synthesized TTS_CONCURRENCY at a time and joined into one MP3.
+TTS_SEGMENT_CHARS = 600
+TTS_CONCURRENCY = int(os.getenv("MONSTER_TTS_CONCURRENCY", "4"))
+TTS_SEGMENT_RETRIES = 2
+# "edge" (online, edge-tts) or "synthetic" (offline silent MP3 for CI, air-gapped
+# staging and load tests; latency and pace below)
+TTS_BACKEND = os.getenv("MONSTER_TTS_BACKEND", "edge")
+TTS_SYNTHETIC_LATENCY_MS = float(os.getenv("MONSTER_TTS_SYNTHETIC_LATENCY_MS", "200"))
+# Audio produced per second of wall time (e.g. 20 = 20x real time); 0 sends it all at once
+TTS_SYNTHETIC_SPEED = float(os.getenv("MONSTER_TTS_SYNTHETIC_SPEED", "20"))
+TTS_SYNTHETIC_CHARS_PER_SECOND = 4
+# Synthesized audio per segment and per chapter, keyed by text hash, voice and rate
+TTS_CACHE_PATH = os.path.join(STATE_PATH, "tts_cache")
+TTS_CACHE_MAX_BYTES = int(os.getenv("MONSTER_TTS_CACHE_MB", "1024")) * 1024 * 1024
+# Chapters of an audiobook synthesized at once (each with up to TTS_CONCURRENCY segments)
+AUDIOBOOK_CHAPTER_CONCURRENCY = int(os.getenv("MONSTER_AUDIOBOOK_CHAPTERS", "2"))
+
+# Finished exports, one file per novel and format, keyed by novel revision
+EXPORT_CACHE_PATH = os.path.join(STATE_PATH, "exports")
+# Converted chapters (XHTML / plain text / image lists) kept for incremental rebuilds
+EXPORT_SECTION_CACHE_ENTRIES = 10000
+# Widths images are downscaled to in the illustrated EPUB (needs Pillow)
+EPUB_IMAGE_WIDTH = 1200
+EPUB_PORTRAIT_WIDTH = 480
+# Background exports convert chapters in up to this many processes, one per
+# EXPORT_CONVERT_MIN_BATCH chapters still to convert
+EXPORT_CONVERT_WORKERS = int(os.getenv("MONSTER_EXPORT_WORKERS", str(min(4, os.cpu_count() or 1))))
+EXPORT_CONVERT_MIN_BATCH = 50
+
+# List endpoints page through a SQLite index of novel/chapter/asset metadata
+# (utils/metadata_index.py), rescanned for outside changes at most this often
+METADATA_INDEX_RESYNC_SECONDS = 30
+LIST_PAGE_MAX_LIMIT = 200
+# Most chapters one batch fetch or batch update may touch
+CHAPTER_BATCH_MAX = 200
+
+# JSON API responses at least this large are sent compressed (brotli if installed, else gzip)
+HTTP_COMPRESS_MIN_BYTES = 1024
+HTTP_GZIP_LEVEL = 6
+HTTP_BROTLI_QUALITY = 5
+
 # Create storage directory if it doesn't exist
 if not os.path.exists(STORAGE_PATH):
     os.makedirs(STORAGE_PATH)
+
+if not os.path.exists(STATE_PATH):
+    os.makedirs(STATE_PATH)
@@ -1,27 +1,36 @@
-from fastapi import FastAPI, HTTPException, Body, BackgroundTasks, Request
+from fastapi import FastAPI, HTTPException, Body, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from starlette.background import BackgroundTask
 from pydantic import BaseModel
+from typing import Optional
 from .config import settings
-from .models.novel import NovelCreate, ChapterGenerate, Asset, PipelineStatus, ChapterUpdate, PlotChoiceRequest, OutlineUpdate, OutlineGenerate
-from .utils import storage
-from .services import novel_generator, dashboard_service, export_service
+from .models.novel import NovelCreate, ChapterGenerate, Asset, PipelineStatus, ChapterUpdate, ChapterBatchUpdate, PlotChoiceRequest, OutlineUpdate, OutlineGenerate
+from .utils import html_text, storage
+from .services import novel_generator, dashboard_service, export_service, generation_tasks, tts_service
 from .services.z_image_generator import z_image_generator
 from .utils.task_manager import task_manager
-from fastapi.concurrency import run_in_threadpool
+from .utils.image_cache import image_cache
+from .utils.tts_cache import tts_cache
+from .utils.export_cache import export_cache
+from .utils.image_variants import VariantStaticFiles
+from .utils.http_cache import JSONResponseCacheMiddleware
+from .utils import metadata_index as index
+from .utils.metadata_index import metadata_index
+from .utils.task_worker import TaskWorker
+from .utils import task_events
 import os
 import json
-from docx import Document
-from io import BytesIO
-import tempfile
-import re
-import edge_tts
+import anyio
+from urllib.parse import quote
 import time
 
 class ImageGenRequest(BaseModel):
     prompt: str
+    novel_id: Optional[str] = None
+    seed: Optional[int] = None
+    # Derive the seed from the prompt (repeatable, served from the image cache)
+    deterministic: Optional[bool] = None
 
 app = FastAPI()
 
@@ -31,7 +40,12 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # Mount data storage for serving generated audio/images
 os.makedirs(settings.STORAGE_PATH, exist_ok=True)
-app.mount("/data", StaticFiles(directory=settings.STORAGE_PATH), name="data")
+# /data/<image>?w=256 serves a cached, resized WebP/AVIF variant (see utils/image_variants.py)
+app.mount("/data", VariantStaticFiles(directory=settings.STORAGE_PATH), name="data")
+
+# ETag/304 and compression for JSON GETs (see utils/http_cache.py); added
+# before CORS so that 304 responses carry the CORS headers as well
+app.add_middleware(JSONResponseCacheMiddleware)
 
 # CORS configuration
 app.add_middleware(
@@ -40,8 +54,48 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
+# Queued tasks are executed by TaskWorkers. By default one runs inside the web
+# process; set MONSTER_EMBEDDED_WORKER=0 and run `python -m backend.worker`
+# to scale generation workers separately from the API.
+embedded_worker = None
+
+@app.on_event("startup")
+async def start_embedded_worker():
+    global embedded_worker
+    if settings.EMBEDDED_WORKER:
+        embedded_worker = TaskWorker(concurrency=settings.EMBEDDED_WORKER_CONCURRENCY)
+        embedded_worker.start()
+
+@app.on_event("startup")
+async def connect_image_backend():
+    # Connects in the background; startup does not wait for the remote Space
+    z_image_generator.start()
+
+@app.on_event("shutdown")
+async def stop_embedded_worker():
+    if embedded_worker:
+        embedded_worker.stop(timeout=5)
+    z_image_generator.stop()
+
+# --- Health ---
+
+@app.get("/api/health")
+async def health():
+    return {"status": "ok"}
+
+@app.get("/api/health/ready")
+async def readiness():
+    # Remote backends are reported, not required: the app still serves
+    # everything else (and queues image jobs) while they are down.
+    image_backend = z_image_generator.get_status()
+    return {
+        "status": "ok" if image_backend["ready"] else "degraded",
+        "components": {"image": image_backend}
+    }
+
 # --- Dashboard & Pipeline ---
 
 @app.get("/api/dashboard/stats")
@@ -88,12 +142,43 @@ async def update_pipeline_status(status: PipelineStatus):
 @app.post("/api/system/clean_cache")
 async def clean_system_cache():
     storage.clear_cache()
-    return {"status": "success", "message": "Cache cleaned"}
+    removed_images = image_cache.clear()
+    removed_audio = tts_cache.clear()
+    removed_exports = export_cache.clear()
+    return {"status": "success", "message": "Cache cleaned", "removed_cached_images": removed_images,
+            "removed_cached_audio": removed_audio, "removed_cached_exports": removed_exports}
 
 # --- Task Management ---
 @app.get("/api/tasks")
-async def get_active_tasks():
-    return task_manager.get_active_tasks()
+async def get_active_tasks(novel_id: str = None):
+    return task_manager.get_active_tasks(novel_id)
+
+@app.get("/api/tasks/events")
+async def stream_task_events(request: Request, task_id: str = None, last_event_id: int = None):
+    # Server-Sent Events; EventSource sends Last-Event-ID when reconnecting
+    header_id = request.headers.get("last-event-id")
+    if header_id and header_id.isdigit():
+        last_event_id = int(header_id)
+    return StreamingResponse(
+        task_events.stream_task_events(last_event_id, task_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/tasks/limits")
+async def get_task_limits():
+    # Per task group: concurrency limit, running and queued counts
+    return task_manager.get_queue_stats()
+
+@app.put("/api/tasks/limits")
+async def update_task_limits(limits: dict = Body(...)):
+    # e.g. {"chapter": 4, "illustration": 0}; 0 pauses a group
+    for group, limit in limits.items():
+        if not isinstance(limit, int) or limit < 0:
+            raise HTTPException(status_code=400, detail=f"Invalid limit for '{group}': must be a non-negative integer")
+    for group, limit in limits.items():
+        task_manager.set_limit(group, limit)
+    return task_manager.get_queue_stats()
 
 @app.get("/api/tasks/{task_id}")
 async def get_task_status(task_id: str):
@@ -102,111 +187,22 @@ async def get_task_status(task_id: str):
         raise HTTPException(status_code=404, detail="Task not found")
     return task
 
-# --- Background Tasks ---
-def generate_and_save_outline(task_id: str, novel_id: str, novel_type: str, title: str = "", description: str = ""):
-    try:
-        # Stage 0: Initializing
-        task_manager.update_task(task_id, status="processing", progress=10, step="Initializing outline generation...", current_stage_index=0)
-        
-        # Stage 1: AI Brainstorming
-        # Simulate thinking
-        task_manager.update_task(task_id, progress=30, step="AI is brainstorming plot points...", current_stage_index=1)
-        
-        # Stage 2: Generating
-        task_manager.update_task(task_id, progress=50, step="AI is generating the outline...", current_stage_index=2)
-        outline = novel_generator.generate_outline(novel_type, title, description)
-        
-        # Stage 3: Saving
-        task_manager.update_task(task_id, progress=80, step="Formatting and saving...", current_stage_index=3)
-        
-        # Load existing to ensure we don't overwrite updates (though rare this early)
-        novel_data = storage.load_json(f"novel_{novel_id}.json")
-        if novel_data:
-            novel_data['outline'] = outline
-            storage.save_json(f"novel_{novel_id}.json", novel_data)
-            print(f"Outline generated for novel {novel_id}")
-            
-        task_manager.update_task(task_id, status="completed", progress=100, step="Outline generated successfully", current_stage_index=4, result={"outline_length": len(outline)})
-    except Exception as e:
-        print(f"Failed to generate outline for {novel_id}: {e}")
-        task_manager.update_task(task_id, status="failed", step=f"Error: {str(e)}")
+@app.post("/api/tasks/{task_id}/cancel")
+async def cancel_task(task_id: str):
+    # Queued tasks are cancelled immediately, running ones at their next checkpoint
+    task = task_manager.cancel_task(task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+    return task
 
-def run_chapter_generation(task_id: str, novel_id: str, chapter: ChapterGenerate):
-    try:
-        # Stage 0: Loading Resources
-        task_manager.update_task(task_id, status="processing", progress=5, step="Loading context and assets...", current_stage_index=0)
-        
-        # Check if novel exists
-        novel_data = storage.load_json(f"novel_{novel_id}.json")
-        if not novel_data:
-            raise Exception("Novel not found")
-        
-        # 1. Build Context: Assets
-        context_parts = []
-        
-        # Add Outline to context
-        if novel_data.get("outline"):
-            context_parts.append(f"【小说大纲】\n{novel_data.get('outline')}")
-
-        if chapter.include_assets:
-            assets = storage.load_json(f"novel_{novel_id}_assets.json")
-            if assets:
-                relevant_assets = [
-                    f"{a.get('type').upper()}: {a.get('name')} - {a.get('role') or 'No description'}"
-                    for a in assets if a.get('type') in ['character', 'scene']
-                ]
-                if relevant_assets:
-                    context_parts.append("【相关设定】\n" + "\n".join(relevant_assets))
-        
-        # Stage 1: Analyzing Context
-        task_manager.update_task(task_id, progress=20, step="Analyzing previous chapter...", current_stage_index=1)
-
-        # 2. Build Context: Previous Chapter
-        if chapter.chapter_num > 1:
-            prev_chapter_num = chapter.chapter_num - 1
-            prev_chapter = storage.load_json(f"novel_{novel_id}_chapter_{prev_chapter_num}.json")
-            if prev_chapter and prev_chapter.get("content"):
-                content_preview = prev_chapter.get("content")[-chapter.context_window:]
-                context_parts.append(f"【前情提要（上一章结尾）】\n...{content_preview}")
-        
-        # Add Plot Choice
-        if chapter.plot_choice:
-            context_parts.append(f"【用户选择的剧情走向】\n{chapter.plot_choice}")
-                
-        full_context = "\n\n".join(context_parts)
-        
-        # Stage 2: AI Writing
-        task_manager.update_task(task_id, progress=40, step="AI is writing the chapter... (This may take 30-60s)", current_stage_index=2)
-        
-        # Generate content
-        content = novel_generator.generate_chapter_text(
-            chapter.prompt or f"Chapter {chapter.chapter_num}",
-            mode=chapter.mode,
-            context=full_context
-        )
-        
-        # Stage 3: Saving
-        task_manager.update_task(task_id, progress=90, step="Saving chapter...", current_stage_index=3)
-        
-        # Save chapter
-        chapter_data = {
-            "novel_id": novel_id,
-            "chapter_num": chapter.chapter_num,
-            "content": content,
-            "mode": chapter.mode
-        }
-        storage.save_json(f"novel_{novel_id}_chapter_{chapter.chapter_num}.json", chapter_data)
-        
-        task_manager.update_task(task_id, status="completed", progress=100, step="Chapter generated successfully", current_stage_index=4, result=chapter_data)
-        
-    except Exception as e:
-        print(f"Chapter generation failed: {e}")
-        task_manager.update_task(task_id, status="failed", step=f"Error: {str(e)}")
+def idempotency_key(request: Request, default: str) -> str:
+    # Clients may pass an Idempotency-Key header; otherwise identical in-flight jobs share `default`
+    return request.headers.get("idempotency-key") or default
 
 # --- Novels ---
 
 @app.post("/api/novels")
-async def create_novel(novel: NovelCreate, background_tasks: BackgroundTasks):
+async def create_novel(novel: NovelCreate):
     novel_dict = novel.dict()
     
     # Initialize empty outline
@@ -218,33 +214,44 @@ async def create_novel(novel: NovelCreate, background_tasks: BackgroundTasks):
     # Schedule Outline Generation if type is provided
     task_id = None
     if novel.type:
-        task_id = task_manager.create_task("outline_generation", f"Generating Outline for {novel.title}")
-        background_tasks.add_task(generate_and_save_outline, task_id, novel.id, novel.type, novel.title, novel.description)
+        task_id = task_manager.create_task(
+            "outline_generation", f"Generating Outline for {novel.title}",
+            payload={"novel_id": novel.id, "novel_type": novel.type, "title": novel.title, "description": novel.description}
+        )
         
     return {"status": "success", "novel": novel_dict, "task_id": task_id}
 
 @app.put("/api/novels/{id}/outline")
-async def update_outline(id: str, update: OutlineUpdate):
-    novel_data = storage.load_json(f"novel_{id}.json")
-    if not novel_data:
-        raise HTTPException(status_code=404, detail="Novel not found")
-    
-    novel_data["outline"] = update.outline
-    storage.save_json(f"novel_{id}.json", novel_data)
+def update_outline(id: str, update: OutlineUpdate):
+    with storage.novel_lock(id):
+        novel_data = storage.load_json(f"novel_{id}.json")
+        if not novel_data:
+            raise HTTPException(status_code=404, detail="Novel not found")
+
+        novel_data["outline"] = update.outline
+        storage.save_json(f"novel_{id}.json", novel_data)
     return {"status": "success", "outline": update.outline}
 
 @app.post("/api/novels/{id}/outline/generate")
-async def regenerate_outline(id: str, background_tasks: BackgroundTasks):
+async def regenerate_outline(id: str, request: Request):
     novel_data = storage.load_json(f"novel_{id}.json")
     if not novel_data:
         raise HTTPException(status_code=404, detail="Novel not found")
     
     novel_type = novel_data.get("type", "General")
     stages = ["初始化", "AI构思", "生成大纲", "保存结果"]
-    task_id = task_manager.create_task("outline_generation", f"Regenerating Outline for {novel_data.get('title')}", stages=stages)
-    background_tasks.add_task(generate_and_save_outline, task_id, id, novel_type, novel_data.get('title'), novel_data.get('description'))
+    task_id = task_manager.create_task(
+        "outline_generation", f"Regenerating Outline for {novel_data.get('title')}", stages=stages,
+        payload={"novel_id": id, "novel_type": novel_type, "title": novel_data.get('title'), "description": novel_data.get('description')},
+        idempotency_key=idempotency_key(request, f"outline:{id}")
+    )
     return {"status": "success", "message": "Outline generation started", "task_id": task_id}
 
+@app.get("/api/novels/{id}/tasks")
+async def list_novel_tasks(id: str, limit: int = 50):
+    # Recent tasks of this novel, including finished ones still within retention
+    return task_manager.get_novel_tasks(id, limit)
+
 @app.get("/api/novels/{id}/relationships")
 async def get_relationships(id: str):
     novel_data = storage.load_json(f"novel_{id}.json")
@@ -261,7 +268,7 @@ async def get_relationships(id: str):
     while True:
         chap = storage.load_json(f"novel_{id}_chapter_{chapter_num}.json")
         if not chap: break
-        if chap.get("content"): latest_chapter_content = chap.get("content")
+        if chap.get("content"): latest_chapter_content = html_text.chapter_text(chap)
         chapter_num += 1
         
     if latest_chapter_content:
@@ -273,46 +280,143 @@ async def get_relationships(id: str):
     graph_data = novel_generator.generate_relationship_graph(text_to_analyze)
     return graph_data
 
+def list_page(response: Response, fetch, limit: Optional[int], fields: Optional[str]):
+    """
+    One page of a list endpoint from the metadata index. `limit` (capped at
+    LIST_PAGE_MAX_LIMIT; none returns everything) and the opaque cursor from
+    the previous page's X-Next-Cursor header select the page; `fields`
+    ("id,title") limits the keys of each item.
+    """
+    if limit is not None:
+        limit = max(1, min(limit, settings.LIST_PAGE_MAX_LIMIT))
+    try:
+        rows, next_cursor = fetch(limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return rows, parse_fields(fields)
+
+def parse_fields(fields: Optional[str]):
+    return [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+
 @app.get("/api/novels")
-async def list_novels():
-    files = storage.get_all_files("novel_*.json")
+async def list_novels(response: Response, limit: Optional[int] = None, cursor: Optional[str] = None,
+                      fields: Optional[str] = None):
+    rows, field_list = list_page(response, lambda n: metadata_index.novels(cursor, n), limit, fields)
     novels = []
-    for f in files:
-        if "chapter" not in f: # Exclude chapters
-            data = storage.load_json(os.path.basename(f))
-            if data and 'title' in data:
-                novels.append(data)
+    for novel_id, meta in rows:
+        if index.needs_file("novel", field_list):
+            meta = storage.load_json(f"novel_{novel_id}.json") or meta
+        novels.append(index.project(meta, field_list))
     return novels
 
 @app.delete("/api/novels/{id}")
-async def delete_novel(id: str):
-    # Delete main novel file
-    if not storage.delete_file(f"novel_{id}.json"):
-        raise HTTPException(status_code=404, detail="Novel not found")
-    
-    # Delete all chapters
-    chapter_files = storage.get_all_files(f"novel_{id}_chapter_*.json")
-    for f in chapter_files:
-        storage.delete_file(os.path.basename(f))
-        
+def delete_novel(id: str):
+    with storage.novel_lock(id):
+        # Delete main novel file
+        if not storage.delete_file(f"novel_{id}.json"):
+            raise HTTPException(status_code=404, detail="Novel not found")
+
+        # Delete all chapters and the assets (their index rows go with them)
+        chapter_files = storage.get_all_files(f"novel_{id}_chapter_*.json")
+        for f in chapter_files:
+            storage.delete_file(os.path.basename(f))
+        storage.delete_file(f"novel_{id}_assets.json")
+
     return {"status": "success", "message": "Novel deleted"}
 
 @app.get("/api/novels/{id}/chapters")
-async def list_chapters(id: str):
-    files = storage.get_all_files(f"novel_{id}_chapter_*.json")
+async def list_chapters(id: str, response: Response, limit: Optional[int] = None, cursor: Optional[str] = None,
+                        fields: Optional[str] = "id,title,chapter_num"):
+    rows, field_list = list_page(response, lambda n: metadata_index.chapters(id, cursor, n), limit, fields)
     chapters = []
-    for f in files:
-        data = storage.load_json(os.path.basename(f))
-        if data:
-            chapters.append({
-                "id": data.get("chapter_num"),
-                "title": f"Chapter {data.get('chapter_num')}", # Simple title for now
-                "chapter_num": data.get("chapter_num")
-            })
-    # Sort by chapter number
-    chapters.sort(key=lambda x: x["chapter_num"])
+    for num, meta in rows:
+        if index.needs_file("chapter", field_list):
+            meta = dict(storage.load_json(f"novel_{id}_chapter_{num}.json") or {}, **meta)
+        chapters.append(index.project(meta, field_list))
     return chapters
 
+# The batch routes must come before /chapters/{chapter_num}, which would take "batch" for a number
+
+@app.get("/api/novels/{id}/chapters/batch")
+async def get_chapters_batch(id: str, start: Optional[int] = None, end: Optional[int] = None,
+                             nums: Optional[str] = None, fields: Optional[str] = None):
+    """
+    Several chapters in one request: those in start..end (inclusive) and/or
+    listed in `nums` ("3,5,8"), in chapter order and at most CHAPTER_BATCH_MAX
+    (continue from the last one returned). Missing chapters are left out.
+    `fields` limits the keys as in list_chapters; files are only read when a
+    field needs them (content, images, plain_text).
+    """
+    if start is None and end is None and not nums:
+        raise HTTPException(status_code=400, detail="Give start/end or nums")
+    try:
+        num_list = [int(n) for n in nums.split(",") if n.strip()] if nums else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="nums must be comma-separated chapter numbers")
+    field_list = parse_fields(fields)
+    rows = metadata_index.chapter_range(id, start, end, num_list)[:settings.CHAPTER_BATCH_MAX]
+    chapters = []
+    for num, meta in rows:
+        if index.needs_file("chapter", field_list):
+            meta = dict(storage.load_json(f"novel_{id}_chapter_{num}.json") or {}, **meta)
+        chapters.append(index.project(meta, field_list))
+    return chapters
+
+@app.put("/api/novels/{id}/chapters/batch")
+def update_chapters_batch(id: str, batch: ChapterBatchUpdate):
+    """
+    Apply several chapter updates at once: all of them are saved, or on an
+    error none (see storage.save_json_many).
+    Besides content and images, an update can renumber its chapter
+    (new_chapter_num); moves happen together, so chapters can swap or shift,
+    but may not land on a chapter that stays where it is.
+    """
+    updates = batch.updates
+    if len(updates) > settings.CHAPTER_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {settings.CHAPTER_BATCH_MAX} chapters per batch")
+    sources = [u.chapter_num for u in updates]
+    targets = [u.new_chapter_num if u.new_chapter_num is not None else u.chapter_num for u in updates]
+    if len(set(sources)) != len(sources):
+        raise HTTPException(status_code=400, detail="A chapter appears twice in the batch")
+    if len(set(targets)) != len(targets):
+        raise HTTPException(status_code=400, detail="Two chapters would get the same number")
+    if any(num < 1 for num in targets):
+        raise HTTPException(status_code=400, detail="Chapter numbers start at 1")
+
+    with storage.novel_lock(id):
+        saved = []
+        for update, target in zip(updates, targets):
+            filename = f"novel_{id}_chapter_{update.chapter_num}.json"
+            data = storage.load_json(filename)
+            if target != update.chapter_num:
+                if not data:
+                    raise HTTPException(status_code=404, detail=f"Chapter {update.chapter_num} not found")
+                if target not in sources and storage.load_json(f"novel_{id}_chapter_{target}.json"):
+                    raise HTTPException(status_code=409, detail=f"Chapter {target} already exists")
+                data["chapter_num"] = target
+            elif not data:
+                data = {
+                    "novel_id": id,
+                    "chapter_num": target,
+                    "content": "",
+                    "mode": "manual"
+                }
+
+            if update.content is not None:
+                data["content"] = update.content
+                html_text.refresh_chapter(data)
+            if update.images is not None:
+                data["images"] = update.images
+            saved.append((update.chapter_num, target, data))
+
+        # Moved-away files are deleted unless another chapter moves into them
+        files = {f"novel_{id}_chapter_{source}.json": None for source, target, _ in saved if source != target}
+        files.update({f"novel_{id}_chapter_{target}.json": data for _, target, data in saved})
+        storage.save_json_many(files)
+    return {"status": "success", "chapters": [data for _, _, data in saved]}
+
 @app.get("/api/novels/{id}/chapters/{chapter_num}")
 async def get_chapter(id: str, chapter_num: int):
     data = storage.load_json(f"novel_{id}_chapter_{chapter_num}.json")
@@ -327,112 +431,70 @@ async def get_chapter(id: str, chapter_num: int):
     return data
 
 @app.put("/api/novels/{id}/chapters/{chapter_num}")
-async def update_chapter(id: str, chapter_num: int, update: ChapterUpdate):
+def update_chapter(id: str, chapter_num: int, update: ChapterUpdate):
     filename = f"novel_{id}_chapter_{chapter_num}.json"
-    data = storage.load_json(filename)
-    if not data:
-        data = {
-            "novel_id": id,
-            "chapter_num": chapter_num,
-            "content": "",
-            "mode": "manual"
-        }
-    
-    if update.content is not None:
-        data["content"] = update.content
-    if update.images is not None:
-        data["images"] = update.images
-        
-    storage.save_json(filename, data)
+    with storage.novel_lock(id):
+        data = storage.load_json(filename)
+        if not data:
+            data = {
+                "novel_id": id,
+                "chapter_num": chapter_num,
+                "content": "",
+                "mode": "manual"
+            }
+
+        if update.content is not None:
+            data["content"] = update.content
+            html_text.refresh_chapter(data)
+        if update.images is not None:
+            data["images"] = update.images
+
+        storage.save_json(filename, data)
     return {"status": "success", "chapter": data}
 
-from .models.novel import IllustrationGenerate
-import math
-
 @app.post("/api/novels/{id}/chapters/{chapter_num}/generate-illustrations")
-async def generate_chapter_illustrations(id: str, chapter_num: int):
-    # 1. Load Chapter
-    filename = f"novel_{id}_chapter_{chapter_num}.json"
-    data = storage.load_json(filename)
+async def generate_chapter_illustrations(id: str, chapter_num: int, request: Request):
+    data = storage.load_json(f"novel_{id}_chapter_{chapter_num}.json")
     if not data or not data.get("content"):
         raise HTTPException(status_code=400, detail="Chapter content is empty")
 
-    content = data.get("content", "")
-    # Remove HTML tags for processing
-    clean_content = re.sub(r'<[^>]+>', '', content)
-    
-    # 2. Split content into ~500 char chunks
-    # Simple split logic:
-    chunk_size = 500
-    chunks = []
-    current_pos = 0
-    while current_pos < len(clean_content):
-        end_pos = min(current_pos + chunk_size, len(clean_content))
-        # Try to find a sentence break if possible
-        if end_pos < len(clean_content):
-            # Look for last period in the range
-            period_pos = clean_content.rfind('。', current_pos, end_pos)
-            if period_pos != -1 and period_pos > current_pos + 300: # Ensure chunk isn't too small
-                end_pos = period_pos + 1
-        
-        chunks.append(clean_content[current_pos:end_pos])
-        current_pos = end_pos
+    # Images are added to the chapter's `images` list one by one as they finish rendering
+    stages = ["切分章节", "生成提示词", "绘制插图", "完成"]
+    task_id = task_manager.create_task(
+        "illustration_generation", f"Illustrating Chapter {chapter_num}", stages=stages,
+        payload={"novel_id": id, "chapter_num": chapter_num},
+        idempotency_key=idempotency_key(request, f"illustrations:{id}:{chapter_num}")
+    )
 
-    # 3. Generate prompts and images for each chunk
-    generated_images = []
-    
-    # Mock/RPA Image Generation (Since we don't have a real high-speed image gen API)
-    # In a real scenario, this would call ComfyUI or Midjourney API
-    # Here we use placeholder logic or our existing RPA placeholder
-    
-    for i, chunk in enumerate(chunks):
-        prompt = novel_generator.generate_illustration_prompt(chunk)
-        # Using placeholder image service for speed and demo
-        # Format: https://placehold.co/512x512?text=Image+for+Part+X
-        # In future: call doubao_rpa or dashscope image gen
-        
-        # Simulating "generated" image URL
-        # We'll use a consistent placeholder that looks like a generated image
-        # Or better, we can use the prompt as text
-        safe_prompt = prompt[:20].replace(" ", "+")
-        img_url = f"https://placehold.co/1024x1024/2d3748/cbd5e0?text=Illustration+{i+1}\n{safe_prompt}..."
-        
-        generated_images.append({
-            "id": f"img_{int(tempfile.time.time())}_{i}",
-            "prompt": prompt,
-            "url": img_url,
-            "segment_text": chunk[:50] + "..."
-        })
-        
-    # 4. Save images to chapter
-    data["images"] = generated_images
-    storage.save_json(filename, data)
-    
-    return {"status": "success", "images": generated_images}
+    return {"status": "success", "message": "Illustration generation started", "task_id": task_id}
 
 
 @app.delete("/api/novels/{id}/chapters/{chapter_num}")
-async def delete_chapter(id: str, chapter_num: int):
+def delete_chapter(id: str, chapter_num: int):
     filename = f"novel_{id}_chapter_{chapter_num}.json"
-    if not storage.delete_file(filename):
-        raise HTTPException(status_code=404, detail="Chapter not found")
+    with storage.novel_lock(id):
+        if not storage.delete_file(filename):
+            raise HTTPException(status_code=404, detail="Chapter not found")
     return {"status": "success", "message": "Chapter deleted"}
 
 @app.post("/api/novels/{id}/generate")
-async def generate_chapter(id: str, chapter: ChapterGenerate, background_tasks: BackgroundTasks):
+async def generate_chapter(id: str, chapter: ChapterGenerate, request: Request):
     # Check if novel exists
     if not storage.load_json(f"novel_{id}.json"):
         raise HTTPException(status_code=404, detail="Novel not found")
     
     stages = ["加载资源", "分析上下文", "AI写作", "保存章节"]
-    task_id = task_manager.create_task("chapter_generation", f"Generating Chapter {chapter.chapter_num}", stages=stages)
-    background_tasks.add_task(run_chapter_generation, task_id, id, chapter)
+    task_id = task_manager.create_task(
+        "chapter_generation", f"Generating Chapter {chapter.chapter_num}", stages=stages,
+        payload={"novel_id": id, "chapter": chapter.dict()},
+        # One in-flight generation per chapter, so duplicate submissions can't race on its file
+        idempotency_key=idempotency_key(request, f"chapter:{id}:{chapter.chapter_num}")
+    )
     
     return {"status": "success", "message": "Chapter generation started", "task_id": task_id}
 
 @app.post("/api/novels/{id}/plot-choices")
 async def get_plot_choices(id: str, request: PlotChoiceRequest):
-    print(f"DEBUG: get_plot_choices called with id={id}, request={request}")
     # Check if novel exists
     novel_data = storage.load_json(f"novel_{id}.json")
     if not novel_data:
@@ -448,7 +510,7 @@ async def get_plot_choices(id: str, request: PlotChoiceRequest):
         prev_chapter_num = request.chapter_num - 1
         prev_chapter = storage.load_json(f"novel_{id}_chapter_{prev_chapter_num}.json")
         if prev_chapter and prev_chapter.get("content"):
-             content_preview = prev_chapter.get("content")[-request.context_window:]
+             content_preview = html_text.chapter_text(prev_chapter)[-request.context_window:]
              context_parts.append(f"【前情提要】\n...{content_preview}")
     
     full_context = "\n\n".join(context_parts)
@@ -470,7 +532,7 @@ async def ai_edit_text(request: dict = Body(...)):
     return {"result": result}
 
 @app.post("/api/novels/{id}/assets/{asset_id}/wiki")
-async def generate_asset_wiki(id: str, asset_id: int):
+def generate_asset_wiki(id: str, asset_id: int):
     # Load novel and assets
     novel_data = storage.load_json(f"novel_{id}.json")
     assets = storage.load_json(f"novel_{id}_assets.json")
@@ -498,180 +560,152 @@ async def generate_asset_wiki(id: str, asset_id: int):
     if wiki_content.startswith("Error:"):
         raise HTTPException(status_code=500, detail=wiki_content)
         
-    # Save back
-    target_asset["details"] = wiki_content
-    storage.save_json(f"novel_{id}_assets.json", assets)
-    
+    # Save back (reload under the lock so concurrent asset edits are kept)
+    with storage.novel_lock(id):
+        assets = storage.load_json(f"novel_{id}_assets.json") or []
+        target_asset = next((a for a in assets if a.get("id") == asset_id), None)
+        if not target_asset:
+            raise HTTPException(status_code=404, detail="Asset not found")
+        target_asset["details"] = wiki_content
+        storage.save_json(f"novel_{id}_assets.json", assets)
+
     return {"status": "success", "data": target_asset}
 
 @app.get("/api/novels/{id}/export")
 async def export_novel(id: str, format: str = "docx"):
-    # 1. Load Novel Info
     novel_data = storage.load_json(f"novel_{id}.json")
     if not novel_data:
         raise HTTPException(status_code=404, detail="Novel not found")
-        
-    # 2. Load All Chapters
-    files = storage.get_all_files(f"novel_{id}_chapter_*.json")
-    chapters = []
-    for f in files:
-        data = storage.load_json(os.path.basename(f))
-        if data:
-            chapters.append(data)
-    
-    # Sort chapters by number
-    chapters.sort(key=lambda x: x.get("chapter_num", 0))
-
-    if format == "epub":
-        fd, path = tempfile.mkstemp(suffix=".epub")
-        os.close(fd) # Close file descriptor, let ebooklib handle it
-        try:
-            export_service.export_to_epub(
-                novel_title=novel_data.get("title", "Untitled Novel"),
-                author="AI Author", # Could add author field later
-                chapters=chapters,
-                output_path=path
-            )
-            return FileResponse(
-                path,
-                filename=f"{novel_data.get('title', 'novel')}.epub",
-                media_type="application/epub+zip"
-            )
-        except Exception as e:
-            if os.path.exists(path):
-                os.unlink(path)
-            raise HTTPException(status_code=500, detail=str(e))
-
-    elif format == "txt":
-        content_lines = []
-        content_lines.append(novel_data.get("title", "Untitled Novel"))
-        content_lines.append(novel_data.get("description", ""))
-        content_lines.append("\n" + "="*20 + "\n")
-        
-        for chapter in chapters:
-            chapter_num = chapter.get("chapter_num")
-            content = chapter.get("content", "")
-            
-            # Clean HTML
-            clean_content = re.sub(r'</p>', '\n', content)
-            clean_content = re.sub(r'<[^>]+>', '', clean_content)
-            
-            content_lines.append(f"Chapter {chapter_num}")
-            content_lines.append(clean_content)
-            content_lines.append("\n" + "-"*10 + "\n")
-            
-        full_text = "\n".join(content_lines)
-        
-        # Save to temp file
-        fd, path = tempfile.mkstemp(suffix=".txt")
-        try:
-            with os.fdopen(fd, 'w', encoding='utf-8') as tmp:
-                tmp.write(full_text)
-                
-            return FileResponse(
-                path,
-                filename=f"{novel_data.get('title', 'novel')}.txt",
-                media_type="text/plain"
-            )
-        except Exception as e:
-            os.unlink(path)
-            raise HTTPException(status_code=500, detail=str(e))
-
-    else: # docx
-        # 3. Create Word Document
-        doc = Document()
-        
-        # Title Page
-        doc.add_heading(novel_data.get("title", "Untitled Novel"), 0)
-        if novel_data.get("description"):
-            doc.add_paragraph(novel_data.get("description"))
-        doc.add_page_break()
-        
-        # Chapters
-        for chapter in chapters:
-            chapter_num = chapter.get("chapter_num")
-            content = chapter.get("content", "")
-            
-            # Clean HTML tags if content is HTML (from Tiptap)
-            # Simple regex to strip tags, better to use BeautifulSoup but regex is faster for now
-            # Replace <p> with newline, strip others
-            clean_content = re.sub(r'</p>', '\n', content)
-            clean_content = re.sub(r'<[^>]+>', '', clean_content)
-            
-            doc.add_heading(f"Chapter {chapter_num}", level=1)
-            doc.add_paragraph(clean_content)
-            doc.add_page_break()
-            
-        # Save to temp file
-        fd, path = tempfile.mkstemp(suffix=".docx")
-        try:
-            doc.save(path)
-            return FileResponse(
-                path,
-                filename=f"{novel_data.get('title', 'novel')}.docx",
-                media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-            )
-        except Exception as e:
-            os.unlink(path)
-            raise HTTPException(status_code=500, detail=str(e))
+    if format not in export_service.MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported export format: {format}")
+
+    # Unchanged novels are served from the export cache; TXT is streamed while it is generated
+    filename = f"{novel_data.get('title', 'novel')}.{export_service.file_extension(format)}"
+    path, stream = await anyio.to_thread.run_sync(export_service.open_export, novel_data, id, format)
+    if path:
+        return FileResponse(path, filename=filename, media_type=export_service.MEDIA_TYPES[format])
+    return StreamingResponse(
+        stream,
+        media_type=export_service.MEDIA_TYPES[format],
+        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}"}
+    )
+
+@app.post("/api/novels/{id}/exports")
+async def create_export(id: str, request: Request, body: dict = Body(default={})):
+    if not storage.load_json(f"novel_{id}.json"):
+        raise HTTPException(status_code=404, detail="Novel not found")
+    formats = body.get("formats") or ["epub"]
+    unsupported = [fmt for fmt in formats if fmt not in export_service.MEDIA_TYPES]
+    if unsupported:
+        raise HTTPException(status_code=400, detail=f"Unsupported export format: {', '.join(unsupported)}")
+    formats = sorted(set(formats))
+
+    # Built in the background; the result lists one download URL per format
+    stages = ["检查章节", "转换章节", "生成文件", "完成"]
+    task_id = task_manager.create_task(
+        "novel_export", f"Exporting {', '.join(formats).upper()}", stages=stages,
+        payload={"novel_id": id, "formats": formats},
+        idempotency_key=idempotency_key(request, f"exports:{id}:{','.join(formats)}")
+    )
+    return {"status": "success", "message": "Export started", "task_id": task_id}
+
+@app.get("/api/novels/{id}/exports/{revision}/{format}")
+async def download_export(id: str, revision: str, format: str):
+    if format not in export_service.MEDIA_TYPES or not revision.isalnum():
+        raise HTTPException(status_code=404, detail="Export not found")
+    path = export_service.export_cache.export_path(id, revision, format)
+    if not os.path.exists(path):
+        # Replaced by a newer revision after the novel was edited
+        raise HTTPException(status_code=404, detail="Export not found or outdated, please export again")
+    novel_data = storage.load_json(f"novel_{id}.json") or {}
+    # A revision's content never changes
+    return FileResponse(path, filename=f"{novel_data.get('title', 'novel')}.{export_service.file_extension(format)}",
+                        media_type=export_service.MEDIA_TYPES[format],
+                        headers={"Cache-Control": "private, max-age=31536000, immutable"})
 
 # --- Assets (Library) ---
 
 @app.get("/api/novels/{novel_id}/assets")
-async def list_assets(novel_id: str):
-    assets = storage.load_json(f"novel_{novel_id}_assets.json")
-    if not assets:
-        assets = [] 
+async def list_assets(novel_id: str, response: Response, limit: Optional[int] = None, cursor: Optional[str] = None,
+                      fields: Optional[str] = None, type: Optional[str] = None):
+    types = type.split(",") if type else None
+    rows, field_list = list_page(response, lambda n: metadata_index.assets(novel_id, cursor, n, types), limit, fields)
+    full = None
+    if index.needs_file("asset", field_list) and rows:
+        # One file holds all of the novel's assets
+        full = storage.load_json(f"novel_{novel_id}_assets.json") or []
+    assets = []
+    for position, meta in rows:
+        if full is not None and position < len(full) and isinstance(full[position], dict):
+            meta = full[position]
+        assets.append(index.project(meta, field_list))
     return assets
 
 @app.post("/api/novels/{novel_id}/assets")
-async def create_asset(novel_id: str, asset: Asset):
+def create_asset(novel_id: str, asset: Asset):
     filename = f"novel_{novel_id}_assets.json"
-    assets = storage.load_json(filename) or []
-    
-    # Ensure ID is unique or generate one if not provided (though frontend usually provides it)
-    # Simple check if exists
-    for a in assets:
-        if str(a.get("id")) == str(asset.id):
-            raise HTTPException(status_code=400, detail="Asset ID already exists")
-            
-    assets.append(asset.dict())
-    storage.save_json(filename, assets)
+    with storage.novel_lock(novel_id):
+        assets = storage.load_json(filename) or []
+
+        # Ensure ID is unique or generate one if not provided (though frontend usually provides it)
+        # Simple check if exists
+        for a in assets:
+            if str(a.get("id")) == str(asset.id):
+                raise HTTPException(status_code=400, detail="Asset ID already exists")
+
+        assets.append(asset.dict())
+        storage.save_json(filename, assets)
     return {"status": "success", "asset": asset}
 
 @app.put("/api/novels/{novel_id}/assets/{asset_id}")
-async def update_asset(novel_id: str, asset_id: str, asset_update: Asset):
+def update_asset(novel_id: str, asset_id: str, asset_update: Asset):
     filename = f"novel_{novel_id}_assets.json"
-    assets = storage.load_json(filename) or []
-    
-    for i, asset in enumerate(assets):
-        if str(asset.get("id")) == str(asset_id):
-            assets[i] = asset_update.dict()
-            storage.save_json(filename, assets)
-            return {"status": "success", "asset": asset_update}
-            
+    with storage.novel_lock(novel_id):
+        assets = storage.load_json(filename) or []
+
+        for i, asset in enumerate(assets):
+            if str(asset.get("id")) == str(asset_id):
+                assets[i] = asset_update.dict()
+                storage.save_json(filename, assets)
+                return {"status": "success", "asset": asset_update}
+
     raise HTTPException(status_code=404, detail="Asset not found")
 
 @app.delete("/api/novels/{novel_id}/assets/{asset_id}")
-async def delete_asset(novel_id: str, asset_id: str):
+def delete_asset(novel_id: str, asset_id: str):
     filename = f"novel_{novel_id}_assets.json"
-    assets = storage.load_json(filename) or []
-    
-    initial_len = len(assets)
-    assets = [a for a in assets if str(a.get("id")) != str(asset_id)]
-    
-    if len(assets) == initial_len:
-        raise HTTPException(status_code=404, detail="Asset not found")
-        
-    storage.save_json(filename, assets)
+    with storage.novel_lock(novel_id):
+        assets = storage.load_json(filename) or []
+
+        initial_len = len(assets)
+        assets = [a for a in assets if str(a.get("id")) != str(asset_id)]
+
+        if len(assets) == initial_len:
+            raise HTTPException(status_code=404, detail="Asset not found")
+
+        storage.save_json(filename, assets)
     return {"status": "success", "message": "Asset deleted"}
 
+@app.post("/api/generate/image/jobs")
+async def submit_image_job(body: ImageGenRequest):
+    # Returns at once; follow the job via /api/tasks/{task_id} or the task event stream
+    task_id = z_image_generator.submit_job(body.prompt, novel_id=body.novel_id, seed=body.seed,
+                                           deterministic=body.deterministic)
+    return {"task_id": task_id, "status": task_manager.get_task(task_id)["status"]}
+
+@app.get("/api/generate/image/stats")
+async def image_job_stats():
+    return dict(z_image_generator.get_stats(), cache=image_cache.get_stats())
+
 @app.post("/api/generate/image")
 async def generate_image(request: Request, body: ImageGenRequest):
-    # Use Z-Image-Turbo via threadpool (since it's blocking)
-    result = await run_in_threadpool(z_image_generator.generate_image, body.prompt)
-    if "error" in result:
-        raise HTTPException(status_code=500, detail=result["error"])
+    # Synchronous variant: submit a job and await it (without holding a thread)
+    task_id = z_image_generator.submit_job(body.prompt, novel_id=body.novel_id, seed=body.seed,
+                                           deterministic=body.deterministic)
+    task = await z_image_generator.wait(task_id)
+    if task["status"] != "completed":
+        raise HTTPException(status_code=500, detail=task.get("error") or task.get("step") or "Image generation failed")
+    result = dict(task["result"], task_id=task_id)
     
     # Prepend base URL to image_url if it's relative
     if "image_url" in result and result["image_url"].startswith("/"):
@@ -685,7 +719,7 @@ async def get_video(chapter_id: str):
     return {"url": f"https://cdn.example.com/videos/{chapter_id}.mp4"}
 
 @app.post("/api/novels/{id}/analyze-assets")
-async def analyze_assets(id: str):
+def analyze_assets(id: str):
     # 1. Load latest chapter or full text (let's use latest chapter for now for speed)
     # Finding the latest chapter
     chapter_num = 1
@@ -696,7 +730,7 @@ async def analyze_assets(id: str):
         if not data:
             break
         if data.get("content"):
-            latest_content = data.get("content")
+            latest_content = html_text.chapter_text(data)
         chapter_num += 1
     
     if not latest_content:
@@ -718,53 +752,56 @@ async def analyze_assets(id: str):
     # 3. Extract updates
     updates = novel_generator.extract_assets_from_text(latest_content, current_assets, outline=outline_text)
     
-    # 4. Apply updates
+    # 4. Apply updates (reload under the lock: the extraction above can take a while)
     new_count = 0
     updated_count = 0
-    
-    for update in updates:
-        action = update.get("action", "create")
-        name = update.get("name")
-        if not name: continue
-        
-        existing_idx = next((i for i, a in enumerate(current_assets) if a["name"] == name), -1)
-        
-        new_asset = {
-            "id": int(time.time() * 1000) + new_count, # Simple ID generation
-            "type": update.get("type", "character"),
-            "name": name,
-            "role": update.get("role", ""),
-            "tags": update.get("tags", []),
-            "img": None
-        }
 
-        if existing_idx >= 0:
-            if action == "update" or action == "create": # Allow create to update if exists
-                # Merge logic: preserve ID and Img, update role/tags if provided
-                current_assets[existing_idx]["role"] = update.get("role") or current_assets[existing_idx]["role"]
-                # Merge tags
-                new_tags = set(current_assets[existing_idx].get("tags", []) + update.get("tags", []))
-                current_assets[existing_idx]["tags"] = list(new_tags)
-                updated_count += 1
-        else:
-            if action == "create":
-                current_assets.append(new_asset)
-                new_count += 1
-
-    # 5. Save back
-    storage.save_json(assets_filename, current_assets)
+    with storage.novel_lock(id):
+        current_assets = storage.load_json(assets_filename) or []
+
+        for update in updates:
+            action = update.get("action", "create")
+            name = update.get("name")
+            if not name: continue
+
+            existing_idx = next((i for i, a in enumerate(current_assets) if a["name"] == name), -1)
+
+            new_asset = {
+                "id": int(time.time() * 1000) + new_count, # Simple ID generation
+                "type": update.get("type", "character"),
+                "name": name,
+                "role": update.get("role", ""),
+                "tags": update.get("tags", []),
+                "img": None
+            }
+
+            if existing_idx >= 0:
+                if action == "update" or action == "create": # Allow create to update if exists
+                    # Merge logic: preserve ID and Img, update role/tags if provided
+                    current_assets[existing_idx]["role"] = update.get("role") or current_assets[existing_idx]["role"]
+                    # Merge tags
+                    new_tags = set(current_assets[existing_idx].get("tags", []) + update.get("tags", []))
+                    current_assets[existing_idx]["tags"] = list(new_tags)
+                    updated_count += 1
+            else:
+                if action == "create":
+                    current_assets.append(new_asset)
+                    new_count += 1
+
+        # 5. Save back
+        storage.save_json(assets_filename, current_assets)
     
     return {"status": "success", "new_assets_count": new_count, "updated_assets_count": updated_count}
 
 @app.post("/api/novels/{id}/assets/{asset_name}/refresh")
-async def refresh_single_asset(id: str, asset_name: str):
+def refresh_single_asset(id: str, asset_name: str):
     # 1. Load context (latest chapter or full text)
     chapter_num = 1
     latest_content = ""
     while True:
         data = storage.load_json(f"novel_{id}_chapter_{chapter_num}.json")
         if not data: break
-        if data.get("content"): latest_content = data.get("content")
+        if data.get("content"): latest_content = html_text.chapter_text(data)
         chapter_num += 1
     
     if not latest_content:
@@ -783,103 +820,117 @@ async def refresh_single_asset(id: str, asset_name: str):
     # 3. Call AI
     updates = novel_generator.refresh_single_asset(asset_name, latest_content, current_info)
     
-    # 4. Update
+    # 4. Update (reload under the lock in case the list changed during the AI call)
     if updates:
-        current_assets[asset_idx]["role"] = updates.get("role") or current_assets[asset_idx]["role"]
-        new_tags = set(current_assets[asset_idx].get("tags", []) + updates.get("tags", []))
-        current_assets[asset_idx]["tags"] = list(new_tags)
-        
-        storage.save_json(assets_filename, current_assets)
+        with storage.novel_lock(id):
+            current_assets = storage.load_json(assets_filename) or []
+            asset_idx = next((i for i, a in enumerate(current_assets) if a["name"] == asset_name), -1)
+            if asset_idx == -1:
+                raise HTTPException(status_code=404, detail="Asset not found")
+
+            current_assets[asset_idx]["role"] = updates.get("role") or current_assets[asset_idx]["role"]
+            new_tags = set(current_assets[asset_idx].get("tags", []) + updates.get("tags", []))
+            current_assets[asset_idx]["tags"] = list(new_tags)
+
+            storage.save_json(assets_filename, current_assets)
         return {"status": "success", "asset": current_assets[asset_idx]}
     else:
         return {"status": "no_change", "asset": current_assets[asset_idx]}
 
 @app.delete("/api/novels/{id}/assets/{asset_id}")
-async def delete_asset(id: str, asset_id: int):
+def delete_asset(id: str, asset_id: int):
     assets_filename = f"novel_{id}_assets.json"
-    current_assets = storage.load_json(assets_filename) or []
-    
-    # Filter out the asset with the given ID
-    new_assets = [a for a in current_assets if str(a.get("id")) != str(asset_id)]
-    
-    if len(new_assets) == len(current_assets):
-        raise HTTPException(status_code=404, detail="Asset not found")
-    
-    storage.save_json(assets_filename, new_assets)
+    with storage.novel_lock(id):
+        current_assets = storage.load_json(assets_filename) or []
+
+        # Filter out the asset with the given ID
+        new_assets = [a for a in current_assets if str(a.get("id")) != str(asset_id)]
+
+        if len(new_assets) == len(current_assets):
+            raise HTTPException(status_code=404, detail="Asset not found")
+
+        storage.save_json(assets_filename, new_assets)
     return {"status": "success", "message": "Asset deleted"}
 
 @app.post("/api/novels/{id}/chapters/{chapter_num}/generate-audio")
-async def generate_chapter_audio(id: str, chapter_num: int, request: dict = Body(...)):
-    text = request.get("text", "")
-    voice = request.get("voice", "zh-CN-XiaoxiaoNeural")
-    
+async def generate_chapter_audio(id: str, chapter_num: int, request: Request, body: dict = Body(default={})):
+    # Without "text" the stored chapter content is read; the whole chapter is voiced
+    text = body.get("text") or None
+    voice = body.get("voice", tts_service.DEFAULT_VOICE)
+
     if not text:
-         raise HTTPException(status_code=400, detail="Text is empty")
-    
-    # Directory: data/novels/{id}/audio/
-    audio_dir = os.path.join(settings.STORAGE_PATH, f"novel_{id}", "audio")
-    os.makedirs(audio_dir, exist_ok=True)
-    
-    # Filename: {chapter_num}_tts_{timestamp}.mp3
-    filename = f"{chapter_num}_tts_{int(time.time())}.mp3"
-    filepath = os.path.join(audio_dir, filename)
-    
-    try:
-        # Generate TTS
-        communicate = edge_tts.Communicate(text[:5000], voice) # Limit length
-        await communicate.save(filepath)
-        
-        # Add to Assets (Multimedia Warehouse)
-        assets_filename = f"novel_{id}_assets.json"
-        assets = storage.load_json(assets_filename) or []
-        
-        # Check if audio asset for this chapter already exists? 
-        # Or just append as a new "audio" type asset
-        new_asset = {
-                    "id": int(time.time() * 1000),
-                    "type": "audio",
-                    "name": f"第{chapter_num}章配音",
-                    "role": f"Chapter {chapter_num} Audio",
-                    "tags": ["audio", "tts"],
-                    "img": None,
-                    "file_path": f"novel_{id}/audio/{filename}" # Relative path for serving
-                }
-        assets.append(new_asset)
-        storage.save_json(assets_filename, assets)
-        
-        # Serve via static mount? 
-        # We need to mount the storage path to serve these files.
-        # For now, let's assume we can serve them or just return success.
-        # To serve, we might need a specific endpoint or mount.
-        # Let's add a generic file server endpoint if needed, or mount 'data'
-        
-        return {"status": "success", "asset": new_asset}
-    except Exception as e:
-        print(f"Audio Gen Error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        data = storage.load_json(f"novel_{id}_chapter_{chapter_num}.json")
+        if not data or not data.get("content"):
+            raise HTTPException(status_code=400, detail="Text is empty")
+    # Keyed by the text too, so a request for edited text is not handed a job still voicing the old one
+    content_hash = html_text.text_hash(text or data["content"])
+
+    # Segments are synthesized concurrently and joined into one MP3 with an index;
+    # the audio is added to the assets (Multimedia Warehouse) when the task completes
+    stages = ["切分文本", "合成语音", "保存音频", "完成"]
+    task_id = task_manager.create_task(
+        "audio_generation", f"Voicing Chapter {chapter_num}", stages=stages,
+        payload={"novel_id": id, "chapter_num": chapter_num, "voice": voice, "text": text},
+        idempotency_key=idempotency_key(request, f"audio:{id}:{chapter_num}:{voice}:{content_hash}")
+    )
+
+    return {"status": "success", "message": "Audio generation started", "task_id": task_id}
+
+@app.post("/api/novels/{id}/audiobook")
+async def generate_audiobook(id: str, request: Request, body: dict = Body(default={})):
+    if not storage.load_json(f"novel_{id}.json"):
+        raise HTTPException(status_code=404, detail="Novel not found")
+    voice = body.get("voice", tts_service.DEFAULT_VOICE)
+
+    # Chapters are voiced in parallel; a restarted build skips chapters already done
+    stages = ["收集章节", "合成章节", "合并有声书", "完成"]
+    task_id = task_manager.create_task(
+        "audiobook_generation", "Building audiobook", stages=stages,
+        payload={"novel_id": id, "voice": voice},
+        idempotency_key=idempotency_key(request, f"audiobook:{id}:{voice}")
+    )
+    return {"status": "success", "message": "Audiobook generation started", "task_id": task_id}
+
+@app.get("/api/novels/{id}/audiobook")
+async def get_audiobook(id: str):
+    manifest_path = os.path.join(settings.STORAGE_PATH, f"novel_{id}", "audiobook", "manifest.json")
+    if not os.path.exists(manifest_path):
+        raise HTTPException(status_code=404, detail="Audiobook not built yet")
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
 
 @app.post("/api/tts")
 async def generate_tts(request: dict = Body(...)):
-    text = request.get("text", "")
-    voice = request.get("voice", "zh-CN-XiaoxiaoNeural")
-    
-    if not text:
-        raise HTTPException(status_code=400, detail="Text is empty")
-        
-    # Limit text length for safety/speed
-    if len(text) > 5000:
-        text = text[:5000]
+    # Same cache as the stream endpoints: unchanged text is served from the cached file
+    return tts_stream_response(request.get("text", ""), request.get("voice", tts_service.DEFAULT_VOICE),
+                               request.get("rate", "+0%"))
 
-    output_filename = f"tts_{int(time.time())}.mp3"
-    output_path = os.path.join("static", output_filename)
-    
+def tts_stream_response(text: str, voice: str, rate: str = "+0%"):
+    # Cached audio is served as a file; otherwise it is sent chunked while it is synthesized
     try:
-        communicate = edge_tts.Communicate(text, voice)
-        await communicate.save(output_path)
-        return {"url": f"http://localhost:8000/static/{output_filename}"}
-    except Exception as e:
-        print(f"TTS Error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        path, stream = tts_service.stream_to_cache(text, voice, rate)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Text is empty")
+    if path:
+        return FileResponse(path, media_type="audio/mpeg")
+    return StreamingResponse(stream, media_type="audio/mpeg", headers={"Cache-Control": "no-store"})
+
+@app.get("/api/tts/stream")
+async def stream_tts(text: str, voice: str = tts_service.DEFAULT_VOICE, rate: str = "+0%"):
+    # GET so the URL can be used directly as an <audio> src
+    return tts_stream_response(text, voice, rate)
+
+@app.post("/api/tts/stream")
+async def stream_tts_post(request: dict = Body(...)):
+    return tts_stream_response(request.get("text", ""), request.get("voice", tts_service.DEFAULT_VOICE),
+                               request.get("rate", "+0%"))
+
+@app.get("/api/novels/{id}/chapters/{chapter_num}/audio/stream")
+async def stream_chapter_audio(id: str, chapter_num: int, voice: str = tts_service.DEFAULT_VOICE, rate: str = "+0%"):
+    data = storage.load_json(f"novel_{id}_chapter_{chapter_num}.json")
+    if not data:
+        raise HTTPException(status_code=404, detail="Chapter not found")
+    return tts_stream_response(html_text.chapter_text(data), voice, rate)
 
 if __name__ == "__main__":
     import uvicorn
@@ -41,6 +41,14 @@ class ChapterUpdate(BaseModel):
     content: Optional[str] = None
     images: Optional[List[str]] = None
 
+class ChapterBatchItem(ChapterUpdate):
+    chapter_num: int
+    # Renumber the chapter (moves are applied together, so chapters can swap places)
+    new_chapter_num: Optional[int] = None
+
+class ChapterBatchUpdate(BaseModel):
+    updates: List[ChapterBatchItem]
+
 class IllustrationGenerate(BaseModel):
     chapter_num: int
 
@@ -54,6 +62,10 @@ class Asset(BaseModel):
     date: Optional[str] = None
     img: Optional[str] = None
     details: Optional[str] = None # Wiki/Encyclopedia content
+    file_path: Optional[str] = None # Media file, relative to the storage root
+    index_path: Optional[str] = None # Audio: segment timing index (JSON)
+    voice: Optional[str] = None # Audio: TTS voice
+    tts_key: Optional[str] = None # Audio: TTS cache key of the voiced text (identical text -> same key)
 
 class PipelineStatus(BaseModel):
     status: str
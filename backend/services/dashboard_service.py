@@ -1,6 +1,6 @@
 import os
 import json
-from ..utils import storage
+from ..utils import html_text, storage
 from ..config import settings
 
 def get_dashboard_stats():
@@ -45,8 +45,7 @@ def get_dashboard_stats():
             if 'chapter_num' in data:
                 # It's a chapter
                 chapters.append(data)
-                content = data.get('content', '')
-                word_len = len(content)
+                word_len = html_text.chapter_word_count(data)
                 total_words += word_len
                 
                 nid = data.get('novel_id')
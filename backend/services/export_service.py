@@ -1,79 +1,539 @@
-import os
-from ebooklib import epub
-from docx import Document
-from typing import List, Dict
+"""
+Novel export (TXT, EPUB, DOCX).
+
+Chapters are loaded one at a time (iter_chapters), so memory use does not
+grow with the length of the novel:
+  - TXT is generated chapter by chapter (stream_txt).
+  - EPUB and DOCX are zip archives written by our own small writers
+    (write_epub, write_docx) entry by entry straight into a file.
+
+"epub_images" is the EPUB with the chapter illustrations and a character
+page with portraits. Every image is stored once in the package however often
+it is referenced, downscaled to reader size (settings.EPUB_IMAGE_WIDTH) when
+Pillow is available (EpubMedia).
 
+Exports are cached by novel revision (utils/export_cache.py): open_export()
+serves an unchanged novel from the cache, and a rebuild converts only the
+chapters whose content changed. Large novels are exported in the background
+(generation_tasks.run_novel_export), converting chapters in parallel first
+(prepare_sections).
+"""
+import os
 import re
+import html
+import json
+import uuid
+import hashlib
+import zipfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from html.parser import HTMLParser
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+from ..config import settings
+from ..utils import html_text, image_variants, storage
+from ..utils.export_cache import export_cache
+
+MEDIA_TYPES = {
+    "txt": "text/plain; charset=utf-8",
+    "epub": "application/epub+zip",
+    "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "epub_images": "application/epub+zip",
+}
+# Converted chapter sections each format is assembled from
+FORMAT_SECTIONS = {"txt": ("text",), "docx": ("text",), "epub": ("xhtml",), "epub_images": ("xhtml", "images")}
+
+def file_extension(format: str) -> str:
+    return "epub" if format == "epub_images" else format
+
+_CHAPTER_FILE = re.compile(r"novel_.+_chapter_(\d+)\.json$")
+
+# Bump when the output of the writers changes, so cached exports are rebuilt
+EXPORT_FORMAT_VERSION = 2
+
+def chapter_title(chapter: Dict) -> str:
+    return chapter.get("title") or f"Chapter {chapter.get('chapter_num')}"
+
+def chapter_files(novel_id: str) -> List[Tuple[int, str]]:
+    """(chapter number, path) of the novel's chapter files, in chapter order."""
+    numbered = []
+    for path in storage.get_all_files(f"novel_{novel_id}_chapter_*.json"):
+        m = _CHAPTER_FILE.search(os.path.basename(path))
+        if m:
+            numbered.append((int(m.group(1)), path))
+    return sorted(numbered)
+
+def iter_chapters(novel_id: str) -> Iterator[Dict]:
+    """The novel's chapters in chapter order, loaded one at a time."""
+    for _, path in chapter_files(novel_id):
+        data = storage.load_json(os.path.basename(path))
+        if data:
+            yield data
+
+def novel_revision(novel_id: str, novel: Dict) -> str:
+    """Hash of the novel's metadata and outline, its assets (portraits) and every chapter file's content."""
+    meta = {k: novel.get(k) for k in ("title", "description", "outline")}
+    parts = [f"v{EXPORT_FORMAT_VERSION}", json.dumps(meta, sort_keys=True, ensure_ascii=False, default=str)]
+    assets_path = os.path.join(settings.STORAGE_PATH, f"novel_{novel_id}_assets.json")
+    if os.path.exists(assets_path):
+        parts.append(f"assets:{export_cache.file_hash(assets_path)}")
+    for num, path in chapter_files(novel_id):
+        parts.append(f"{num}:{export_cache.file_hash(path)}")
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()[:32]
+
+# --- HTML -> XHTML ---
+
+_VOID_TAGS = {"br", "hr"}
+_BLOCK_TAGS = {"p", "div", "h1", "h2", "h3", "h4", "h5", "h6", "li", "blockquote", "pre"}
+_ALLOWED_TAGS = _VOID_TAGS | _BLOCK_TAGS | {"strong", "b", "em", "i", "u", "s", "code", "span", "ul", "ol", "a", "sub", "sup"}
+_ALLOWED_ATTRS = {"a": {"href"}}
+
+class _XhtmlWriter(HTMLParser):
+    """Re-emits Tiptap HTML as well-formed XHTML: allowlisted tags, balanced, escaped."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.out = []
+        self.stack = []
 
-def strip_html(html_content):
-    clean = re.compile('<.*?>')
-    return re.sub(clean, '', html_content)
-
-def export_to_epub(novel_title: str, author: str, chapters: List[Dict], output_path: str):
-    book = epub.EpubBook()
-
-    # set metadata
-    book.set_identifier(f'id_{novel_title}')
-    book.set_title(novel_title)
-    book.set_language('zh')
-    book.add_author(author)
-
-    # create chapters
-    epub_chapters = []
-    toc = []
-
-    for i, chap_data in enumerate(chapters):
-        title = f"Chapter {chap_data.get('chapter_num')}"
-        filename = f'chap_{i+1}.xhtml'
-        
-        c = epub.EpubHtml(title=title, file_name=filename, lang='zh')
-        content = chap_data.get('content', '')
-        
-        # Simple detection if content is HTML
-        if '<p>' in content or '<div>' in content or '<br>' in content:
-            c.content = f'<h1>{title}</h1>{content}'
+    def handle_starttag(self, tag, attrs):
+        if tag not in _ALLOWED_TAGS:
+            return
+        allowed = _ALLOWED_ATTRS.get(tag, ())
+        attr_text = "".join(f' {k}="{html.escape(v or "", quote=True)}"' for k, v in attrs if k in allowed)
+        if tag in _VOID_TAGS:
+            self.out.append(f"<{tag}{attr_text}/>")
         else:
-            # Plain text fallback
-            content = content.replace('\n', '<br>')
-            c.content = f'<h1>{title}</h1><p>{content}</p>'
-        
-        book.add_item(c)
-        epub_chapters.append(c)
-        toc.append(c)
-
-    # define Table Of Contents
-    book.toc = tuple(toc)
-
-    # add default NCX and Nav file
-    book.add_item(epub.EpubNcx())
-    book.add_item(epub.EpubNav())
-
-    # define CSS style
-    style = 'BODY { font-family: "Microsoft YaHei", "SimSun", serif; }' # Use fonts more likely to support Chinese
-    nav_css = epub.EpubItem(uid="style_nav", file_name="style/nav.css", media_type="text/css", content=style)
-
-    # add CSS file
-    book.add_item(nav_css)
-
-    # basic spine
-    book.spine = ['nav'] + epub_chapters
-
-    # write to the file
-    epub.write_epub(output_path, book, {})
-    return output_path
-
-def export_to_docx(novel_title: str, chapters: List[Dict], output_path: str):
-    doc = Document()
-    doc.add_heading(novel_title, 0)
-
-    for chap in chapters:
-        doc.add_heading(f"Chapter {chap.get('chapter_num')}", level=1)
-        content = chap.get('content', '')
-        # Strip HTML for docx
-        if '<' in content and '>' in content:
-            content = strip_html(content.replace('<br>', '\n').replace('</p>', '\n'))
-        
-        doc.add_paragraph(content)
-
-    doc.save(output_path)
-    return output_path
+            self.out.append(f"<{tag}{attr_text}>")
+            self.stack.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag in self.stack and tag not in _VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag not in self.stack:
+            return
+        while self.stack:
+            open_tag = self.stack.pop()
+            self.out.append(f"</{open_tag}>")
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        self.out.append(html.escape(data, quote=False))
+
+    def result(self) -> str:
+        self.close()
+        while self.stack:
+            self.out.append(f"</{self.stack.pop()}>")
+        return "".join(self.out)
+
+def to_xhtml(content: str) -> str:
+    """Chapter body as XHTML (plain text becomes one paragraph per line)."""
+    if not html_text.is_html(content):
+        return "".join(f"<p>{html.escape(line, quote=False)}</p>" for line in content.splitlines() if line.strip())
+    writer = _XhtmlWriter()
+    writer.feed(content)
+    return writer.result()
+
+# --- Converted chapters ("sections"), cached by chapter file content hash ---
+
+def chapter_section(chapter: Dict) -> Tuple[str, str]:
+    """(title, XHTML body) of a chapter in the EPUB."""
+    title = chapter_title(chapter)
+    return title, f"<h1>{html.escape(title)}</h1>{to_xhtml(chapter.get('content', ''))}"
+
+def text_section(chapter: Dict) -> Tuple[str, str]:
+    """(title, paragraphs joined by newlines) of a chapter in TXT and DOCX."""
+    return chapter_title(chapter), html_text.chapter_text(chapter)
+
+def image_section(chapter: Dict) -> Tuple[str, str]:
+    """(title, image URLs one per line) of a chapter's illustrations."""
+    urls = [img.get("url") if isinstance(img, dict) else img for img in chapter.get("images") or []]
+    return chapter_title(chapter), "\n".join(url for url in urls if url)
+
+def _converter(kind: str) -> Callable[[Dict], Tuple[str, str]]:
+    return {"xhtml": chapter_section, "text": text_section, "images": image_section}[kind]
+
+def _section_key(kind: str, path: str) -> str:
+    return f"{kind}:v{EXPORT_FORMAT_VERSION}:{export_cache.file_hash(path)}"
+
+def _sections(novel_id: str, kinds: Tuple[str, ...]) -> Iterator[List[Tuple[str, str]]]:
+    # Chapters not converted before (or edited since) are converted and cached here
+    for _, path in chapter_files(novel_id):
+        sections = []
+        data = None
+        for kind in kinds:
+            key = _section_key(kind, path)
+            section = export_cache.get_section(key)
+            if section is None:
+                data = data or storage.load_json(os.path.basename(path))
+                if not data:
+                    break
+                section = _converter(kind)(data)
+                export_cache.put_section(key, *section)
+            sections.append(section)
+        else:
+            yield sections
+
+def epub_sections(novel_id: str) -> Iterator[Tuple[str, str]]:
+    return (xhtml for xhtml, in _sections(novel_id, ("xhtml",)))
+
+def text_sections(novel_id: str) -> Iterator[Tuple[str, str]]:
+    return (text for text, in _sections(novel_id, ("text",)))
+
+def media_epub_sections(novel_id: str, media: "EpubMedia") -> Iterator[Tuple[str, str]]:
+    """EPUB sections with the chapter's illustrations appended (registered in `media`)."""
+    for (title, body), (_, urls) in _sections(novel_id, ("xhtml", "images")):
+        figures = []
+        for url in urls.split("\n") if urls else []:
+            href = media.add(url, settings.EPUB_IMAGE_WIDTH)
+            if href:
+                figures.append(f'<figure class="illustration"><img src="../{href}" alt="{html.escape(title)} 插图"/></figure>')
+        yield title, body + "".join(figures)
+
+def _convert_file(path: str, kinds: List[str]) -> Optional[Dict[str, Tuple[str, str]]]:
+    # Runs in a worker process
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return {kind: _converter(kind)(data) for kind in kinds}
+
+def prepare_sections(novel_id: str, formats: List[str], on_progress: Callable[[int, int], None] = None) -> int:
+    """
+    Convert every chapter not yet in the section cache for `formats`, in
+    parallel worker processes for larger batches (the conversion is CPU
+    bound). Returns the number of chapters converted.
+    """
+    kinds = sorted({kind for fmt in formats for kind in FORMAT_SECTIONS[fmt]})
+    pending = []
+    for _, path in chapter_files(novel_id):
+        missing = [kind for kind in kinds if not export_cache.has_section(_section_key(kind, path))]
+        if missing:
+            pending.append((path, missing))
+    if not pending:
+        return 0
+
+    def store(path: str, missing: List[str], result):
+        for kind in missing:
+            if result:
+                export_cache.put_section(_section_key(kind, path), *result[kind])
+
+    workers = min(settings.EXPORT_CONVERT_WORKERS, len(pending) // settings.EXPORT_CONVERT_MIN_BATCH)
+    if workers <= 1:
+        for n, (path, missing) in enumerate(pending, start=1):
+            store(path, missing, _convert_file(path, missing))
+            if on_progress:
+                on_progress(n, len(pending))
+        return len(pending)
+
+    # "spawn" so the worker processes do not inherit this process's threads and open connections
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        results = pool.map(_convert_file, [p for p, _ in pending], [m for _, m in pending], chunksize=8)
+        for n, ((path, missing), result) in enumerate(zip(pending, results), start=1):
+            store(path, missing, result)
+            if on_progress:
+                on_progress(n, len(pending))
+    return len(pending)
+
+# --- TXT ---
+
+def stream_txt(novel: Dict, sections: Iterable[Tuple[str, str]]) -> Iterator[bytes]:
+    header = [novel.get("title", "Untitled Novel"), novel.get("description", "") or "", "\n" + "=" * 20 + "\n"]
+    yield ("\n".join(header) + "\n").encode("utf-8")
+    for title, body in sections:
+        yield f"{title}\n{body}\n\n{'-' * 10}\n\n".encode("utf-8")
+
+# --- EPUB images ---
+
+_EPUB_IMAGE_TYPES = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png", ".gif": "image/gif", ".webp": "image/webp"}
+
+def _local_image(url: str) -> Optional[str]:
+    # Only images served from /data (STORAGE_PATH) are embedded
+    path = urlparse(url or "").path
+    if not path.startswith("/data/"):
+        return None
+    root = os.path.realpath(settings.STORAGE_PATH)
+    source = os.path.realpath(os.path.join(root, unquote(path[len("/data/"):])))
+    if os.path.commonpath([source, root]) != root or not os.path.isfile(source):
+        return None
+    return source
+
+class EpubMedia:
+    """
+    Images of one EPUB package. Each distinct image (by content) at a given
+    width becomes one file in OEBPS/images, however many pages reference it.
+    """
+
+    def __init__(self):
+        self.items = []  # (href, file path, media type)
+        self._hrefs = {}
+
+    def add(self, url: str, width: int) -> Optional[str]:
+        """href of the image (relative to OEBPS), or None if it cannot be embedded."""
+        source = _local_image(url)
+        if not source:
+            return None
+        key = (export_cache.file_hash(source), width)
+        if key in self._hrefs:
+            return self._hrefs[key]
+        ext = os.path.splitext(source)[1].lower()
+        path, media_type = source, _EPUB_IMAGE_TYPES.get(ext)
+        variant = image_variants.get_variant(source, width, "jpeg")
+        if variant:
+            path, ext, media_type = variant, ".jpg", "image/jpeg"
+        if not media_type:
+            self._hrefs[key] = None
+            return None
+        href = f"images/img_{key[0][:16]}_w{width}{ext}"
+        self.items.append((href, path, media_type))
+        self._hrefs[key] = href
+        return href
+
+def character_page(novel_id: str, media: EpubMedia) -> Optional[str]:
+    """XHTML body of the character page (portrait, name, role), or None if the novel has no characters."""
+    assets = storage.load_json(f"novel_{novel_id}_assets.json") or []
+    entries = []
+    for asset in assets:
+        if not isinstance(asset, dict) or asset.get("type") != "character":
+            continue
+        name = html.escape(str(asset.get("name") or ""))
+        href = media.add(asset.get("img"), settings.EPUB_PORTRAIT_WIDTH)
+        portrait = f'<img src="../{href}" alt="{name}"/>' if href else ""
+        role = f"<p>{html.escape(str(asset['role']))}</p>" if asset.get("role") else ""
+        entries.append(f'<div class="character">{portrait}<h2>{name}</h2>{role}</div>')
+    if not entries:
+        return None
+    return "<h1>人物</h1>" + "".join(entries)
+
+# --- Zip-based formats ---
+
+def _xhtml_page(title: str, body: str) -> str:
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="zh" xml:lang="zh">\n'
+        f'<head><meta charset="utf-8"/><title>{html.escape(title)}</title>'
+        '<link rel="stylesheet" type="text/css" href="../style.css"/></head>\n'
+        f'<body>{body}</body>\n</html>\n'
+    )
+
+_EPUB_CSS = (
+    'body { font-family: "Microsoft YaHei", "SimSun", serif; line-height: 1.6; }\np { text-indent: 2em; margin: 0.3em 0; }\n'
+    'figure.illustration { margin: 1em 0; text-align: center; }\nfigure.illustration img { max-width: 100%; }\n'
+    'div.character { margin: 1em 0; text-align: center; }\ndiv.character img { max-width: 50%; }\n'
+)
+
+_CONTAINER_XML = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">\n'
+    '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>\n'
+    '</container>\n'
+)
+
+def write_epub(fileobj, novel: Dict, sections: Iterable[Tuple[str, str]], author: str = "AI Author",
+               media: EpubMedia = None, characters: str = None):
+    """
+    EPUB 3 (with an NCX for EPUB 2 readers), one XHTML file per (title, body)
+    section, written as they arrive. `characters` is an optional page after
+    the title page; the images registered in `media` (by then) are packaged
+    at the end.
+    """
+    title = novel.get("title", "Untitled Novel")
+    book_id = f"urn:uuid:{uuid.uuid5(uuid.NAMESPACE_URL, 'monster-novel:' + str(novel.get('id', title)))}"
+    with zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED) as zf:
+        # The mimetype entry must come first and be stored uncompressed
+        zf.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        zf.writestr("META-INF/container.xml", _CONTAINER_XML)
+        zf.writestr("OEBPS/style.css", _EPUB_CSS)
+
+        description = novel.get("description") or ""
+        title_body = f"<h1>{html.escape(title)}</h1>" + (f"<p>{html.escape(description)}</p>" if description else "")
+        zf.writestr("OEBPS/text/title.xhtml", _xhtml_page(title, title_body))
+
+        toc = []
+        if characters:
+            zf.writestr("OEBPS/text/characters.xhtml", _xhtml_page("人物", characters))
+            toc.append(("characters", "characters.xhtml", "人物"))
+        for i, (chap_title, body) in enumerate(sections, start=1):
+            name = f"chap_{i}.xhtml"
+            zf.writestr(f"OEBPS/text/{name}", _xhtml_page(chap_title, body))
+            toc.append((f"chap_{i}", name, chap_title))
+
+        images = media.items if media else []
+        for href, path, _ in images:
+            # Already compressed
+            zf.write(path, f"OEBPS/{href}", compress_type=zipfile.ZIP_STORED)
+
+        zf.writestr("OEBPS/nav.xhtml", _epub_nav(title, toc))
+        zf.writestr("OEBPS/toc.ncx", _epub_ncx(book_id, title, toc))
+        zf.writestr("OEBPS/content.opf", _epub_opf(book_id, title, author, toc, images))
+
+def _epub_nav(title: str, toc: List) -> str:
+    items = "".join(f'<li><a href="text/{name}">{html.escape(label)}</a></li>' for _, name, label in toc)
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="zh" xml:lang="zh">\n'
+        f'<head><meta charset="utf-8"/><title>{html.escape(title)}</title></head>\n'
+        f'<body><nav epub:type="toc" id="toc"><h1>{html.escape(title)}</h1><ol>{items}</ol></nav></body>\n</html>\n'
+    )
+
+def _epub_ncx(book_id: str, title: str, toc: List) -> str:
+    points = "".join(
+        f'<navPoint id="{item_id}" playOrder="{n}"><navLabel><text>{html.escape(label)}</text></navLabel>'
+        f'<content src="text/{name}"/></navPoint>'
+        for n, (item_id, name, label) in enumerate(toc, start=1)
+    )
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">\n'
+        f'<head><meta name="dtb:uid" content="{book_id}"/></head>\n'
+        f'<docTitle><text>{html.escape(title)}</text></docTitle>\n<navMap>{points}</navMap>\n</ncx>\n'
+    )
+
+def _epub_opf(book_id: str, title: str, author: str, toc: List, images: List = ()) -> str:
+    modified = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    manifest = "".join(f'<item id="{item_id}" href="text/{name}" media-type="application/xhtml+xml"/>' for item_id, name, _ in toc)
+    manifest += "".join(f'<item id="img{n}" href="{href}" media-type="{media_type}"/>'
+                        for n, (href, _, media_type) in enumerate(images, start=1))
+    spine = "".join(f'<itemref idref="{item_id}"/>' for item_id, _, _ in toc)
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id" xml:lang="zh">\n'
+        '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+        f'<dc:identifier id="book-id">{book_id}</dc:identifier><dc:title>{html.escape(title)}</dc:title>'
+        f'<dc:language>zh</dc:language><dc:creator>{html.escape(author)}</dc:creator>'
+        f'<meta property="dcterms:modified">{modified}</meta></metadata>\n'
+        '<manifest><item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>'
+        '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>'
+        '<item id="css" href="style.css" media-type="text/css"/>'
+        f'<item id="title" href="text/title.xhtml" media-type="application/xhtml+xml"/>{manifest}</manifest>\n'
+        f'<spine toc="ncx"><itemref idref="title"/><itemref idref="nav"/>{spine}</spine>\n</package>\n'
+    )
+
+_DOCX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '<Override PartName="/word/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>'
+    '</Types>'
+)
+_DOCX_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>'
+    '</Relationships>'
+)
+_DOCX_DOCUMENT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+    '</Relationships>'
+)
+_W = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+_DOCX_STYLES = (
+    f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<w:styles {_W}>'
+    '<w:docDefaults><w:rPrDefault><w:rPr><w:rFonts w:eastAsia="SimSun"/><w:sz w:val="24"/></w:rPr></w:rPrDefault></w:docDefaults>'
+    '<w:style w:type="paragraph" w:default="1" w:styleId="Normal"><w:name w:val="Normal"/></w:style>'
+    '<w:style w:type="paragraph" w:styleId="Title"><w:name w:val="Title"/><w:basedOn w:val="Normal"/>'
+    '<w:pPr><w:jc w:val="center"/><w:spacing w:after="240"/></w:pPr><w:rPr><w:b/><w:sz w:val="52"/></w:rPr></w:style>'
+    '<w:style w:type="paragraph" w:styleId="Heading1"><w:name w:val="heading 1"/><w:basedOn w:val="Normal"/>'
+    '<w:pPr><w:keepNext/><w:spacing w:before="240" w:after="120"/><w:outlineLvl w:val="0"/></w:pPr>'
+    '<w:rPr><w:b/><w:sz w:val="32"/></w:rPr></w:style>'
+    '</w:styles>'
+)
+_PAGE_BREAK = '<w:p><w:r><w:br w:type="page"/></w:r></w:p>'
+_XML_INVALID = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+def _docx_paragraph(text: str, style: str = None) -> str:
+    props = f'<w:pPr><w:pStyle w:val="{style}"/></w:pPr>' if style else ""
+    text = html.escape(_XML_INVALID.sub("", text), quote=False)
+    return f'<w:p>{props}<w:r><w:t xml:space="preserve">{text}</w:t></w:r></w:p>'
+
+def write_docx(fileobj, novel: Dict, sections: Iterable[Tuple[str, str]]):
+    """Word document with a title page and one heading plus paragraphs per (title, text) section, streamed into document.xml."""
+    with zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("[Content_Types].xml", _DOCX_CONTENT_TYPES)
+        zf.writestr("_rels/.rels", _DOCX_RELS)
+        zf.writestr("word/_rels/document.xml.rels", _DOCX_DOCUMENT_RELS)
+        zf.writestr("word/styles.xml", _DOCX_STYLES)
+        with zf.open("word/document.xml", "w", force_zip64=True) as doc:
+            doc.write(f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<w:document {_W}><w:body>'.encode("utf-8"))
+            doc.write(_docx_paragraph(novel.get("title", "Untitled Novel"), "Title").encode("utf-8"))
+            if novel.get("description"):
+                doc.write(_docx_paragraph(novel["description"]).encode("utf-8"))
+            doc.write(_PAGE_BREAK.encode("utf-8"))
+            for title, body in sections:
+                parts = [_docx_paragraph(title, "Heading1")]
+                parts.extend(_docx_paragraph(p) for p in body.split("\n") if p)
+                parts.append(_PAGE_BREAK)
+                doc.write("".join(parts).encode("utf-8"))
+            doc.write(b"<w:sectPr/></w:body></w:document>")
+
+def write_export(fileobj, novel: Dict, novel_id: str, format: str):
+    """Write the export of the novel in `format` (a key of MEDIA_TYPES) to fileobj."""
+    if format == "txt":
+        for chunk in stream_txt(novel, text_sections(novel_id)):
+            fileobj.write(chunk)
+    elif format == "epub":
+        write_epub(fileobj, novel, epub_sections(novel_id))
+    elif format == "epub_images":
+        media = EpubMedia()
+        write_epub(fileobj, novel, media_epub_sections(novel_id, media),
+                   media=media, characters=character_page(novel_id, media))
+    else:
+        write_docx(fileobj, novel, text_sections(novel_id))
+
+def build_export(novel: Dict, novel_id: str, format: str, revision: str = None) -> Tuple[str, int]:
+    """Build the export into the cache (unless it is there already) and return its path and size."""
+    if revision is None:
+        revision = novel_revision(novel_id, novel)
+        path = export_cache.get(novel_id, revision, format)
+        if path:
+            return path, os.path.getsize(path)
+    tmp_path = export_cache.temp_path(format)
+    try:
+        with open(tmp_path, "wb") as f:
+            write_export(f, novel, novel_id, format)
+        return export_cache.store(novel_id, revision, format, tmp_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _stream_txt_to_cache(novel: Dict, novel_id: str, revision: str) -> Iterator[bytes]:
+    # Sent while it is generated and kept once complete; an interrupted stream is discarded
+    tmp_path = export_cache.temp_path("txt")
+    complete = False
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in stream_txt(novel, text_sections(novel_id)):
+                f.write(chunk)
+                yield chunk
+        complete = True
+    finally:
+        if complete:
+            export_cache.store(novel_id, revision, "txt", tmp_path)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def open_export(novel: Dict, novel_id: str, format: str) -> Tuple[Optional[str], Optional[Iterator[bytes]]]:
+    """
+    (path, None) for a cached or freshly built export file, or (None, stream)
+    for TXT, which is streamed while it is generated. Blocking: call from a
+    worker thread.
+    """
+    revision = novel_revision(novel_id, novel)
+    path = export_cache.get(novel_id, revision, format)
+    if path:
+        return path, None
+    if format == "txt":
+        return None, _stream_txt_to_cache(novel, novel_id, revision)
+    path, _ = build_export(novel, novel_id, format, revision)
+    return path, None
@@ -0,0 +1,473 @@
+"""
+Queued generation jobs. These run inside a TaskWorker (embedded in the web
+process or started with `python -m backend.worker`), never in the request path.
+Exceptions are left to the worker, which records the failure and retries.
+Handlers call task_manager.check_cancelled() between stages so a cancelled
+task stops (raising TaskCancelled) instead of writing its result.
+"""
+import os
+import json
+import time
+import queue
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from ..config import settings
+from ..models.novel import ChapterGenerate
+from ..utils import html_text, storage
+from ..utils.task_manager import task_manager, TaskCancelled
+from ..utils.task_worker import task_handler
+from ..utils.text_segmenter import segment_text
+from . import export_service, novel_generator, tts_service
+from .z_image_generator import z_image_generator
+
+@task_handler("outline_generation")
+def generate_and_save_outline(task_id: str, novel_id: str, novel_type: str, title: str = "", description: str = ""):
+    # Stage 0: Initializing
+    task_manager.update_task(task_id, status="processing", progress=10, step="Initializing outline generation...", current_stage_index=0)
+
+    # Stage 1: AI Brainstorming
+    # Simulate thinking
+    task_manager.check_cancelled(task_id)
+    task_manager.update_task(task_id, progress=30, step="AI is brainstorming plot points...", current_stage_index=1)
+
+    # Stage 2: Generating
+    task_manager.update_task(task_id, progress=50, step="AI is generating the outline...", current_stage_index=2)
+    outline = novel_generator.generate_outline(novel_type, title, description)
+
+    # Stage 3: Saving
+    task_manager.check_cancelled(task_id)
+    task_manager.update_task(task_id, progress=80, step="Formatting and saving...", current_stage_index=3)
+
+    # Load existing to ensure we don't overwrite updates (though rare this early)
+    with storage.novel_lock(novel_id):
+        novel_data = storage.load_json(f"novel_{novel_id}.json")
+        if novel_data:
+            novel_data['outline'] = outline
+            storage.save_json(f"novel_{novel_id}.json", novel_data)
+            print(f"Outline generated for novel {novel_id}")
+
+    task_manager.update_task(task_id, status="completed", progress=100, step="Outline generated successfully", current_stage_index=4, result={"outline_length": len(outline)})
+
+@task_handler("chapter_generation")
+def run_chapter_generation(task_id: str, novel_id: str, chapter: dict):
+    chapter = ChapterGenerate(**chapter)
+
+    # Stage 0: Loading Resources
+    task_manager.update_task(task_id, status="processing", progress=5, step="Loading context and assets...", current_stage_index=0)
+
+    # Check if novel exists
+    novel_data = storage.load_json(f"novel_{novel_id}.json")
+    if not novel_data:
+        raise Exception("Novel not found")
+
+    # 1. Build Context: Assets
+    context_parts = []
+
+    # Add Outline to context
+    if novel_data.get("outline"):
+        context_parts.append(f"【小说大纲】\n{novel_data.get('outline')}")
+
+    if chapter.include_assets:
+        assets = storage.load_json(f"novel_{novel_id}_assets.json")
+        if assets:
+            relevant_assets = [
+                f"{a.get('type').upper()}: {a.get('name')} - {a.get('role') or 'No description'}"
+                for a in assets if a.get('type') in ['character', 'scene']
+            ]
+            if relevant_assets:
+                context_parts.append("【相关设定】\n" + "\n".join(relevant_assets))
+
+    # Stage 1: Analyzing Context
+    task_manager.update_task(task_id, progress=20, step="Analyzing previous chapter...", current_stage_index=1)
+
+    # 2. Build Context: Previous Chapter
+    if chapter.chapter_num > 1:
+        prev_chapter_num = chapter.chapter_num - 1
+        prev_chapter = storage.load_json(f"novel_{novel_id}_chapter_{prev_chapter_num}.json")
+        if prev_chapter and prev_chapter.get("content"):
+            content_preview = html_text.chapter_text(prev_chapter)[-chapter.context_window:]
+            context_parts.append(f"【前情提要（上一章结尾）】\n...{content_preview}")
+
+    # Add Plot Choice
+    if chapter.plot_choice:
+        context_parts.append(f"【用户选择的剧情走向】\n{chapter.plot_choice}")
+
+    full_context = "\n\n".join(context_parts)
+
+    # Stage 2: AI Writing
+    task_manager.check_cancelled(task_id)
+    task_manager.update_task(task_id, progress=40, step="AI is writing the chapter... (This may take 30-60s)", current_stage_index=2)
+
+    # Generate content
+    content = novel_generator.generate_chapter_text(
+        chapter.prompt or f"Chapter {chapter.chapter_num}",
+        mode=chapter.mode,
+        context=full_context,
+        should_cancel=task_manager.cancel_checker(task_id)
+    )
+
+    # Stage 3: Saving
+    task_manager.check_cancelled(task_id)
+    task_manager.update_task(task_id, progress=90, step="Saving chapter...", current_stage_index=3)
+
+    # Save chapter
+    chapter_data = {
+        "novel_id": novel_id,
+        "chapter_num": chapter.chapter_num,
+        "content": content,
+        "mode": chapter.mode
+    }
+    html_text.refresh_chapter(chapter_data)
+    with storage.novel_lock(novel_id):
+        storage.save_json(f"novel_{novel_id}_chapter_{chapter.chapter_num}.json", chapter_data)
+
+    task_manager.update_task(task_id, status="completed", progress=100, step="Chapter generated successfully", current_stage_index=4, result=chapter_data)
+
+def _save_illustration(novel_id: str, chapter_num: int, image: dict):
+    # Store each image as soon as it is rendered, so partial results show up in the chapter
+    filename = f"novel_{novel_id}_chapter_{chapter_num}.json"
+    with storage.novel_lock(novel_id):
+        data = storage.load_json(filename)
+        if not data:
+            return
+        images = data.get("images") or []
+        images.append(image)
+        # Manually saved images first, then generated ones in text order
+        images.sort(key=lambda img: (img.get("source") == "auto", img.get("segment_index", 0)))
+        data["images"] = images
+        storage.save_json(filename, data)
+
+@task_handler("illustration_generation")
+def run_illustration_generation(task_id: str, novel_id: str, chapter_num: int):
+    filename = f"novel_{novel_id}_chapter_{chapter_num}.json"
+
+    # Stage 0: Split chapter
+    task_manager.update_task(task_id, status="processing", progress=5, step="Splitting chapter...", current_stage_index=0)
+    data = storage.load_json(filename)
+    if not data or not data.get("content"):
+        raise Exception("Chapter content is empty")
+    # One image per balanced, sentence-aligned segment
+    chunks = [seg.text for seg in segment_text(html_text.chapter_text(data), max_chars=settings.ILLUSTRATION_CHUNK_SIZE)]
+
+    # Stage 1: Prompts, written concurrently
+    task_manager.check_cancelled(task_id)
+    task_manager.update_task(task_id, progress=10, step=f"Writing {len(chunks)} image prompts...", current_stage_index=1)
+    with ThreadPoolExecutor(max_workers=settings.ILLUSTRATION_PROMPT_CONCURRENCY) as pool:
+        prompts = list(pool.map(novel_generator.generate_illustration_prompt, chunks))
+
+    # Replace images generated by an earlier run; manually saved ones stay
+    task_manager.check_cancelled(task_id)
+    with storage.novel_lock(novel_id):
+        data = storage.load_json(filename) or data
+        data["images"] = [img for img in data.get("images") or [] if img.get("source") != "auto"]
+        storage.save_json(filename, data)
+
+    # Stage 2: Render in batches through the image job pool
+    task_manager.update_task(task_id, progress=20, step="Rendering illustrations...", current_stage_index=2)
+    rendered, errors = 0, []
+    batch_size = settings.ILLUSTRATION_BATCH_SIZE
+    for start in range(0, len(chunks), batch_size):
+        task_manager.check_cancelled(task_id)
+        finished = queue.Queue()
+        pending = {}
+        for i in range(start, min(start + batch_size, len(chunks))):
+            # Deterministic seeds: re-running on unchanged text is served from the image cache
+            image_task = z_image_generator.submit_job(
+                prompts[i], description=f"Chapter {chapter_num} illustration {i + 1}", novel_id=novel_id,
+                deterministic=True
+            )
+            pending[image_task] = i
+            z_image_generator.on_finished(image_task, lambda t=image_task: finished.put(t))
+
+        try:
+            while pending:
+                try:
+                    image_task = finished.get(timeout=0.5)
+                except queue.Empty:
+                    task_manager.check_cancelled(task_id)
+                    continue
+                i = pending.pop(image_task)
+                result = task_manager.get_task(image_task) or {}
+                if result.get("status") == "completed":
+                    rendered += 1
+                    _save_illustration(novel_id, chapter_num, {
+                        "id": f"img_{int(time.time())}_{i}",
+                        "prompt": prompts[i],
+                        "url": result["result"]["image_url"],
+                        "segment_text": chunks[i][:50] + "...",
+                        "segment_index": i,
+                        "source": "auto"
+                    })
+                else:
+                    errors.append(result.get("error") or result.get("step") or "unknown error")
+                done = rendered + len(errors)
+                task_manager.update_task(
+                    task_id, progress=20 + int(75 * done / len(chunks)),
+                    step=f"Rendered {rendered}/{len(chunks)} illustrations"
+                )
+        except TaskCancelled:
+            for image_task in pending:
+                task_manager.cancel_task(image_task)
+            raise
+
+    if chunks and not rendered:
+        raise Exception(f"All illustrations failed: {errors[0]}")
+
+    task_manager.update_task(
+        task_id, status="completed", progress=100, step=f"Generated {rendered} illustrations",
+        current_stage_index=3, result={"images": rendered, "failed": len(errors), "segments": len(chunks)}
+    )
+
+@task_handler("audio_generation")
+def run_audio_generation(task_id: str, novel_id: str, chapter_num: int, voice: str = tts_service.DEFAULT_VOICE,
+                         text: str = None):
+    # Stage 0: Load text (the chapter's stored plain text unless the caller sent some)
+    task_manager.update_task(task_id, status="processing", progress=5, step="Splitting chapter...", current_stage_index=0)
+    if not text:
+        data = storage.load_json(f"novel_{novel_id}_chapter_{chapter_num}.json")
+        text = html_text.chapter_text(data or {})
+    if not text or not text.strip():
+        raise Exception("Chapter content is empty")
+
+    # Unchanged text in the same voice already has its asset
+    key = tts_service.audio_key(tts_service.split_for_tts(text), voice)
+    existing = _find_audio_asset(novel_id, key)
+    if existing:
+        task_manager.update_task(task_id, status="completed", progress=100, step="Audio up to date",
+                                 current_stage_index=3, result={"asset": existing, "cached": True})
+        return
+
+    # Stage 1: Synthesize segments concurrently and join them (cached segments are reused)
+    task_manager.check_cancelled(task_id)
+    task_manager.update_task(task_id, progress=10, step="Synthesizing speech...", current_stage_index=1)
+    audio_dir = os.path.join(settings.STORAGE_PATH, f"novel_{novel_id}", "audio")
+    os.makedirs(audio_dir, exist_ok=True)
+    filename = f"{chapter_num}_tts_{int(time.time())}.mp3"
+
+    def on_progress(done: int, total: int):
+        task_manager.update_task(task_id, progress=10 + int(80 * done / total),
+                                 step=f"Synthesized {done}/{total} segments")
+
+    index = asyncio.run(tts_service.synthesize_to_file(
+        text, os.path.join(audio_dir, filename), voice,
+        on_progress=on_progress, should_cancel=task_manager.cancel_checker(task_id)
+    ))
+
+    # Stage 2: Save the chapter index and register the audio asset
+    task_manager.update_task(task_id, progress=95, step="Saving audio...", current_stage_index=2)
+    index.update(voice=voice, chapter_num=chapter_num)
+    index_filename = filename.replace(".mp3", ".json")
+    _write_json(os.path.join(audio_dir, index_filename), index)
+
+    seconds = index["duration_ms"] // 1000
+    new_asset = {
+        "id": int(time.time() * 1000),
+        "type": "audio",
+        "name": f"第{chapter_num}章配音",
+        "role": f"Chapter {chapter_num} Audio",
+        "tags": ["audio", "tts"],
+        "img": None,
+        "duration": f"{seconds // 60}:{seconds % 60:02d}",
+        "file_path": f"novel_{novel_id}/audio/{filename}", # Relative path for serving
+        "index_path": f"novel_{novel_id}/audio/{index_filename}",
+        "voice": voice,
+        "tts_key": index["key"]
+    }
+    new_asset = _save_audio_asset(novel_id, new_asset)
+
+    task_manager.update_task(task_id, status="completed", progress=100, step="Audio generated",
+                             current_stage_index=3, result={"asset": new_asset, "segments": len(index["segments"])})
+
+def _find_audio_asset(novel_id: str, key: str):
+    assets = storage.load_json(f"novel_{novel_id}_assets.json") or []
+    for asset in assets:
+        if asset.get("type") == "audio" and asset.get("tts_key") == key and asset.get("file_path") \
+                and os.path.exists(os.path.join(settings.STORAGE_PATH, asset["file_path"])):
+            return asset
+    return None
+
+def _save_audio_asset(novel_id: str, new_asset: dict) -> dict:
+    # One audio asset per chapter and voice: earlier versions (and duplicates from
+    # before the cache existed) collapse into the new one, which keeps the oldest id
+    with storage.novel_lock(novel_id):
+        assets = storage.load_json(f"novel_{novel_id}_assets.json") or []
+        kept, replaced = [], []
+        for asset in assets:
+            same = asset.get("type") == "audio" and asset.get("role") == new_asset["role"] \
+                and (asset.get("voice") or tts_service.DEFAULT_VOICE) == new_asset["voice"]
+            (replaced if same else kept).append(asset)
+        if replaced:
+            new_asset["id"] = replaced[0]["id"]
+        kept.append(new_asset)
+        storage.save_json(f"novel_{novel_id}_assets.json", kept)
+
+    for asset in replaced:
+        for field in ("file_path", "index_path"):
+            path = asset.get(field)
+            if path and path != new_asset.get(field):
+                try:
+                    os.remove(os.path.join(settings.STORAGE_PATH, path))
+                except OSError:
+                    pass
+    return new_asset
+
+@task_handler("audiobook_generation")
+def run_audiobook_generation(task_id: str, novel_id: str, voice: str = tts_service.DEFAULT_VOICE):
+    # Stage 0: Collect chapters; a chapter whose audio for the current text is
+    # already in the audiobook folder (checkpoint) is not synthesized again
+    task_manager.update_task(task_id, status="processing", progress=2, step="Collecting chapters...", current_stage_index=0)
+    novel = storage.load_json(f"novel_{novel_id}.json") or {}
+    book_dir = os.path.join(settings.STORAGE_PATH, f"novel_{novel_id}", "audiobook")
+    os.makedirs(book_dir, exist_ok=True)
+
+    chapters = []
+    for path in storage.get_all_files(f"novel_{novel_id}_chapter_*.json"):
+        data = storage.load_json(os.path.basename(path))
+        text = html_text.chapter_text(data or {})
+        if not text:
+            continue
+        segments = tts_service.split_for_tts(text)
+        if not segments:
+            continue
+        num = data.get("chapter_num")
+        chapters.append({
+            "chapter_num": num,
+            "title": data.get("title") or f"第{num}章",
+            "text": text,
+            "segments": len(segments),
+            "key": tts_service.audio_key(segments, voice),
+            "path": os.path.join(book_dir, f"chapter_{num}.mp3"),
+            "index_path": os.path.join(book_dir, f"chapter_{num}.json"),
+        })
+    if not chapters:
+        raise Exception("Novel has no chapters with content")
+    chapters.sort(key=lambda c: c["chapter_num"])
+
+    total = sum(c["segments"] for c in chapters)
+    done = {}
+    for chapter in chapters:
+        index = _load_checkpoint(chapter)
+        if index:
+            chapter["duration_ms"] = index["duration_ms"]
+            done[chapter["chapter_num"]] = chapter["segments"]
+    resumed = len(done)
+
+    # Stage 1: Synthesize the remaining chapters, several at a time
+    task_manager.check_cancelled(task_id)
+    task_manager.update_task(task_id, progress=5, step=f"Synthesizing {len(chapters) - resumed} of {len(chapters)} chapters...",
+                             current_stage_index=1)
+    should_cancel = task_manager.cancel_checker(task_id)
+
+    def report(chapter_num: int, count: int):
+        done[chapter_num] = count
+        finished = sum(1 for c in chapters if done.get(c["chapter_num"]) == c["segments"])
+        task_manager.update_task(task_id, progress=5 + int(85 * sum(done.values()) / total),
+                                 step=f"Chapters done: {finished}/{len(chapters)}")
+
+    async def build(chapter: dict, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            num = chapter["chapter_num"]
+            index = await tts_service.synthesize_to_file(
+                chapter["text"], chapter["path"], voice,
+                on_progress=lambda count, _: report(num, count), should_cancel=should_cancel
+            )
+            index.update(voice=voice, chapter_num=num)
+            _write_json(chapter["index_path"], index)  # checkpoint
+            chapter["duration_ms"] = index["duration_ms"]
+
+    async def build_all():
+        semaphore = asyncio.Semaphore(settings.AUDIOBOOK_CHAPTER_CONCURRENCY)
+        tasks = [asyncio.ensure_future(build(c, semaphore)) for c in chapters if c["chapter_num"] not in done]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    asyncio.run(build_all())
+
+    # Stage 2: Join the chapters into one chaptered MP3 and write the manifest
+    task_manager.check_cancelled(task_id)
+    task_manager.update_task(task_id, progress=92, step="Assembling audiobook...", current_stage_index=2)
+    title = novel.get("title") or f"Novel {novel_id}"
+    timeline = tts_service.write_audiobook(os.path.join(book_dir, "audiobook.mp3"), title, chapters)
+    rel_dir = f"novel_{novel_id}/audiobook"
+    manifest = {
+        "novel_id": novel_id,
+        "title": title,
+        "voice": voice,
+        "file_path": f"{rel_dir}/audiobook.mp3",
+        "duration_ms": sum(c["duration_ms"] for c in chapters),
+        "built_at": time.time(),
+        "chapters": [{
+            "chapter_num": c["chapter_num"],
+            "title": c["title"],
+            "start_ms": t["start_ms"],
+            "end_ms": t["end_ms"],
+            "file_path": f"{rel_dir}/chapter_{c['chapter_num']}.mp3",
+            "index_path": f"{rel_dir}/chapter_{c['chapter_num']}.json",
+            "tts_key": c["key"],
+        } for c, t in zip(chapters, timeline)],
+    }
+    _write_json(os.path.join(book_dir, "manifest.json"), manifest)
+
+    task_manager.update_task(task_id, status="completed", progress=100, step="Audiobook ready", current_stage_index=3,
+                             result={"manifest": manifest, "resumed_chapters": resumed})
+
+def _load_checkpoint(chapter: dict):
+    # Valid when the chapter's audio and index exist and were made from the current text and voice
+    try:
+        with open(chapter["index_path"], "r", encoding="utf-8") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get("key") != chapter["key"] or not os.path.exists(chapter["path"]):
+        return None
+    return index
+
+def _write_json(path: str, data: dict):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+@task_handler("novel_export")
+def run_novel_export(task_id: str, novel_id: str, formats: list = None):
+    # Stage 0: Revision of the current content; files already exported for it are reused
+    formats = formats or ["epub"]
+    task_manager.update_task(task_id, status="processing", progress=2, step="Checking chapters...", current_stage_index=0)
+    novel = storage.load_json(f"novel_{novel_id}.json")
+    if not novel:
+        raise Exception("Novel not found")
+    revision = export_service.novel_revision(novel_id, novel)
+    # Sizes are taken while the files are known to exist: an export of a newer
+    # revision replaces them in the cache at any time
+    sizes = {}
+    for fmt in formats:
+        path = export_service.export_cache.get(novel_id, revision, fmt)
+        if path:
+            sizes[fmt] = os.path.getsize(path)
+    pending = [fmt for fmt in formats if fmt not in sizes]
+
+    # Stage 1: Convert the chapters (in parallel processes for large novels)
+    task_manager.check_cancelled(task_id)
+    task_manager.update_task(task_id, progress=5, step="Converting chapters...", current_stage_index=1)
+
+    def report(done: int, total: int):
+        task_manager.check_cancelled(task_id)
+        task_manager.update_task(task_id, progress=5 + int(70 * done / total), step=f"Chapters converted: {done}/{total}")
+
+    if pending:
+        export_service.prepare_sections(novel_id, pending, on_progress=report)
+
+    # Stage 2: Assemble each format from the converted chapters
+    for i, fmt in enumerate(pending):
+        task_manager.check_cancelled(task_id)
+        task_manager.update_task(task_id, progress=75 + int(20 * i / len(pending)), step=f"Building {fmt.upper()}...",
+                                 current_stage_index=2)
+        _, sizes[fmt] = export_service.build_export(novel, novel_id, fmt, revision)
+
+    files = {fmt: {"url": f"/api/novels/{novel_id}/exports/{revision}/{fmt}", "size": sizes[fmt]} for fmt in formats}
+    task_manager.update_task(task_id, status="completed", progress=100, step="Export ready", current_stage_index=3,
+                             result={"revision": revision, "files": files, "built": pending})
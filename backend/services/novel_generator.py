@@ -4,6 +4,8 @@ from dashscope import Generation
 import dashscope
 from fastapi import HTTPException
 from ..models.novel import GenerationMode
+from ..utils.task_manager import TaskCancelled
+from ..utils.text_segmenter import clip_text
 
 # 配置 DashScope API
 dashscope.base_http_api_url = 'https://dashscope.aliyuncs.com/api/v1'
@@ -86,9 +88,11 @@ def generate_wiki_entry(name: str, role: str, basic_info: str, context: str = ""
     except Exception as e:
         return f"Error: {str(e)}"
 
-def _generate_via_api(prompt: str, context: str = "") -> str:
+def _generate_via_api(prompt: str, context: str = "", should_cancel=None) -> str:
     """
     Generate content using DashScope API (Qwen-Max).
+    The response is streamed; if `should_cancel()` becomes true the stream is
+    closed and TaskCancelled is raised.
     """
     api_key = os.getenv("DASHSCOPE_API_KEY")
     if not api_key:
@@ -122,17 +126,29 @@ def _generate_via_api(prompt: str, context: str = "") -> str:
         messages.append({"role": "user", "content": prompt})
 
     try:
-        response = Generation.call(
+        responses = Generation.call(
             api_key=api_key,
             model="qwen-max",
             messages=messages,
             result_format="message",
+            stream=True,
+            incremental_output=True,
         )
 
-        if response.status_code == 200:
-            return response.output.choices[0].message.content
-        else:
-            return f"[Error] Generation failed: {response.code} - {response.message}"
+        parts = []
+        try:
+            for response in responses:
+                if should_cancel and should_cancel():
+                    raise TaskCancelled()
+                if response.status_code != 200:
+                    return f"[Error] Generation failed: {response.code} - {response.message}"
+                parts.append(response.output.choices[0].message.content)
+        finally:
+            # Closing the generator drops the HTTP stream if we stopped early
+            responses.close()
+        return "".join(parts)
+    except TaskCancelled:
+        raise
     except Exception as e:
         return f"[Error] Exception during generation: {str(e)}"
 
@@ -225,13 +241,13 @@ def _generate_via_rpa(prompt: str, context: str = "") -> str:
     """
     return "[RPA Mode] This feature is currently under maintenance. Please use API mode."
 
-def generate_chapter_text(prompt: str, mode: GenerationMode = GenerationMode.API, context: str = "") -> str:
+def generate_chapter_text(prompt: str, mode: GenerationMode = GenerationMode.API, context: str = "", should_cancel=None) -> str:
     # 优先使用 API 模式，因为用户指定了使用 DashScope
     # 即使传入 RPA 模式，如果未实现，也可以回退或提示
     if mode == GenerationMode.RPA:
          return _generate_via_rpa(prompt, context)
     else:
-        return _generate_via_api(prompt, context)
+        return _generate_via_api(prompt, context, should_cancel)
 
 def generate_illustration_prompt(segment_text: str) -> str:
     """
@@ -294,7 +310,7 @@ def refresh_single_asset(name: str, context_text: str, current_info: dict) -> di
 
     messages = [
         {"role": "system", "content": system_prompt},
-        {"role": "user", "content": f"【小说文本片段】\n{context_text[:4000]}"}
+        {"role": "user", "content": f"【小说文本片段】\n{clip_text(context_text, 4000)}"}
     ]
 
     try:
@@ -359,7 +375,7 @@ JSON 列表，示例：
 
     messages = [
         {"role": "system", "content": system_prompt},
-        {"role": "user", "content": f"【小说文本片段】\n{text[:4000]}"} # Increased limit slightly
+        {"role": "user", "content": f"【小说文本片段】\n{clip_text(text, 4000)}"} # Increased limit slightly
     ]
 
     try:
@@ -401,7 +417,7 @@ def generate_relationship_graph(text: str) -> dict:
     
     messages = [
         {"role": "system", "content": system_prompt},
-        {"role": "user", "content": f"【小说文本】\n{text[:4000]}"}
+        {"role": "user", "content": f"【小说文本】\n{clip_text(text, 4000)}"}
     ]
 
     try:
@@ -0,0 +1,69 @@
+"""
+Speech synthesis backends behind tts_service.
+
+Backends:
+  - "edge": Microsoft's online voices through edge-tts (needs network access).
+  - "synthetic": offline stand-in that returns valid silent MP3 in the same
+    format as edge-tts, as long as the text would take to read, after a
+    configurable latency and at a configurable pace. For CI, air-gapped
+    staging and load tests of the audio pipeline.
+
+Select with MONSTER_TTS_BACKEND (see settings).
+"""
+import re
+import asyncio
+from abc import ABC, abstractmethod
+from typing import AsyncIterator
+
+import edge_tts
+
+from ..config import settings
+from ..utils import mp3
+
+class TTSBackend(ABC):
+    name = ""
+
+    @abstractmethod
+    def stream(self, text: str, voice: str, rate: str = "+0%") -> AsyncIterator[bytes]:
+        """MP3 data for `text` in chunks, as it becomes available."""
+
+class EdgeTTSBackend(TTSBackend):
+    name = "edge"
+
+    async def stream(self, text: str, voice: str, rate: str = "+0%") -> AsyncIterator[bytes]:
+        async for chunk in edge_tts.Communicate(text, voice, rate=rate).stream():
+            if chunk["type"] == "audio":
+                yield chunk["data"]
+
+class SyntheticTTSBackend(TTSBackend):
+    name = "synthetic"
+
+    def __init__(self, latency_ms: float = None, speed: float = None, chars_per_second: float = None):
+        self.latency_ms = settings.TTS_SYNTHETIC_LATENCY_MS if latency_ms is None else latency_ms
+        self.speed = settings.TTS_SYNTHETIC_SPEED if speed is None else speed
+        self.chars_per_second = chars_per_second or settings.TTS_SYNTHETIC_CHARS_PER_SECOND
+
+    def duration_ms(self, text: str, rate: str = "+0%") -> int:
+        m = re.fullmatch(r"([+-]\d+)%", rate or "")
+        factor = 1 + int(m.group(1)) / 100 if m else 1
+        return int(len(text.strip()) / self.chars_per_second / max(factor, 0.1) * 1000)
+
+    async def stream(self, text: str, voice: str, rate: str = "+0%") -> AsyncIterator[bytes]:
+        await asyncio.sleep(self.latency_ms / 1000)
+        audio = mp3.silent_frames(self.duration_ms(text, rate))
+        # Half a second of audio per chunk, paced like a service producing `speed`x real time
+        chunk = len(mp3.SILENT_FRAME) * (500 // mp3.SILENT_FRAME_MS)
+        for start in range(0, len(audio), chunk):
+            if start and self.speed > 0:
+                await asyncio.sleep(0.5 / self.speed)
+            yield audio[start:start + chunk]
+
+def create_tts_backend(name: str = None) -> TTSBackend:
+    name = name or settings.TTS_BACKEND
+    if name == "edge":
+        return EdgeTTSBackend()
+    if name == "synthetic":
+        return SyntheticTTSBackend()
+    raise ValueError(f"Unknown TTS backend: {name}")
+
+tts_backend = create_tts_backend()
@@ -0,0 +1,292 @@
+"""
+Chapter-length text-to-speech (edge-tts, or the offline backend; see tts_backends.py).
+
+Text is split at sentence boundaries (utils/text_segmenter.py), segments are
+synthesized concurrently up to settings.TTS_CONCURRENCY, and the resulting
+MP3 frames are concatenated in order into one file (no re-encoding). An index
+maps every segment to its time range in the audio and its text offsets.
+
+Segments are cut with segment_stable() and cached by text, voice and rate
+(utils/tts_cache.py), so after an edit only the changed segments are
+synthesized again. stream_to_cache() relays the audio while it is being
+synthesized, so playback can start after the first chunk.
+"""
+import os
+import uuid
+import shutil
+import asyncio
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from ..config import settings
+from ..utils import mp3
+from ..utils.task_manager import TaskCancelled
+from ..utils.text_segmenter import Segment, segment_html, segment_stable
+from ..utils.tts_cache import tts_cache, segment_key, chapter_key
+from .tts_backends import tts_backend
+
+DEFAULT_VOICE = "zh-CN-XiaoxiaoNeural"
+
+async def synthesize_segment(text: str, voice: str = DEFAULT_VOICE, rate: str = "+0%") -> bytes:
+    """MP3 frames for one segment, retried a few times on transient service errors."""
+    for attempt in range(settings.TTS_SEGMENT_RETRIES + 1):
+        try:
+            chunks = [data async for data in tts_backend.stream(text, voice, rate)]
+            return mp3.audio_frames(b"".join(chunks))
+        except Exception as e:
+            if attempt == settings.TTS_SEGMENT_RETRIES:
+                raise
+            print(f"TTS segment failed ({e}), retrying...")
+            await asyncio.sleep(1 + attempt)
+
+async def stream_segment(text: str, voice: str = DEFAULT_VOICE, rate: str = "+0%") -> AsyncIterator[bytes]:
+    """Audio chunks of one segment as the service sends them; retried only if nothing was sent yet."""
+    for attempt in range(settings.TTS_SEGMENT_RETRIES + 1):
+        sent = False
+        try:
+            async for data in tts_backend.stream(text, voice, rate):
+                sent = True
+                yield data
+            return
+        except Exception as e:
+            if sent or attempt == settings.TTS_SEGMENT_RETRIES:
+                raise
+            print(f"TTS segment failed ({e}), retrying...")
+            await asyncio.sleep(1 + attempt)
+
+def split_for_tts(text: str, is_html: bool = False) -> List[Segment]:
+    # Content-defined boundaries keep segment cache keys stable across edits
+    if is_html:
+        return segment_html(text, stable=True, max_chars=settings.TTS_SEGMENT_CHARS)
+    return segment_stable(text, max_chars=settings.TTS_SEGMENT_CHARS)
+
+def audio_key(segments: List[Segment], voice: str = DEFAULT_VOICE, rate: str = "+0%") -> str:
+    """Chapter-level cache key of the audio for these segments."""
+    return chapter_key([segment_key(segment.text, voice, rate, tts_backend.name) for segment in segments])
+
+async def synthesize_segments(segments: List[Segment], voice: str = DEFAULT_VOICE, rate: str = "+0%",
+                              on_progress: Callable[[int, int], None] = None,
+                              should_cancel: Callable[[], bool] = None) -> List[bytes]:
+    """
+    Audio of all segments in segment order. Cached segments are reused; the
+    others are synthesized, at most settings.TTS_CONCURRENCY at a time.
+    """
+    semaphore = asyncio.Semaphore(settings.TTS_CONCURRENCY)
+    done = 0
+
+    async def run(segment: Segment) -> bytes:
+        nonlocal done
+        async with semaphore:
+            key = segment_key(segment.text, voice, rate, tts_backend.name)
+            audio = tts_cache.get_bytes(key)
+            if audio is None:
+                if should_cancel and should_cancel():
+                    raise TaskCancelled()
+                audio = await synthesize_segment(segment.text, voice, rate)
+                tts_cache.put_bytes(key, audio)
+        done += 1
+        if on_progress:
+            on_progress(done, len(segments))
+        return audio
+
+    tasks = [asyncio.ensure_future(run(segment)) for segment in segments]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def build_index(segments: List[Segment], audio: List[bytes]) -> Dict:
+    """Chapter index: time range and text offsets of each segment in the joined audio."""
+    entries = []
+    position = 0
+    for segment, data in zip(segments, audio):
+        length = mp3.duration_ms(data)
+        entries.append({
+            "index": segment.index,
+            "start_ms": position,
+            "end_ms": position + length,
+            "text_start": segment.start,
+            "text_end": segment.end,
+            "source_start": segment.source_start,
+            "source_end": segment.source_end,
+            "preview": segment.text[:30],
+        })
+        position += length
+    return {"duration_ms": position, "segments": entries}
+
+async def synthesize_to_file(text: str, output_path: str, voice: str = DEFAULT_VOICE, rate: str = "+0%",
+                             is_html: bool = False, on_progress: Callable[[int, int], None] = None,
+                             should_cancel: Callable[[], bool] = None) -> Optional[Dict]:
+    """
+    Synthesize the full text into one MP3 at output_path and return its index
+    (None if there is no text). The joined file is also kept as the chapter-level cache entry.
+    """
+    segments = split_for_tts(text, is_html)
+    if not segments:
+        return None
+    audio = await synthesize_segments(segments, voice, rate, on_progress, should_cancel)
+    tmp_path = f"{output_path}.part"
+    with open(tmp_path, "wb") as f:
+        for data in audio:
+            f.write(data)
+    os.replace(tmp_path, output_path)
+    key = audio_key(segments, voice, rate)
+    tts_cache.put(key, output_path)
+    return dict(build_index(segments, audio), key=key)
+
+async def stream_segments(segments: List[Segment], voice: str = DEFAULT_VOICE, rate: str = "+0%") -> AsyncIterator[bytes]:
+    """
+    Audio of all segments in order. The segment being sent is relayed chunk
+    by chunk while the following ones are synthesized ahead, at most
+    settings.TTS_CONCURRENCY segments in flight (which also bounds buffering).
+    """
+    queues = [asyncio.Queue() for _ in segments]
+    tasks = {}
+
+    async def fill(i: int):
+        queue = queues[i]
+        key = segment_key(segments[i].text, voice, rate, tts_backend.name)
+        cached = tts_cache.get_bytes(key)
+        if cached is not None:
+            queue.put_nowait(cached)
+            queue.put_nowait(None)
+            return
+        # Tags and partial frames are filtered out as they arrive, so the
+        # client gets the same bytes as later plays from the cache
+        frames = mp3.FrameFilter()
+        chunks = []
+        try:
+            async for data in stream_segment(segments[i].text, voice, rate):
+                data = frames.feed(data)
+                if data:
+                    chunks.append(data)
+                    queue.put_nowait(data)
+        except Exception as e:
+            queue.put_nowait(e)
+            return
+        tts_cache.put_bytes(key, b"".join(chunks))
+        queue.put_nowait(None)
+
+    try:
+        for i in range(len(segments)):
+            for j in range(i, min(i + settings.TTS_CONCURRENCY, len(segments))):
+                if j not in tasks:
+                    tasks[j] = asyncio.ensure_future(fill(j))
+            while True:
+                item = await queues[i].get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+            del tasks[i]
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+def stream_to_cache(text: str, voice: str = DEFAULT_VOICE, rate: str = "+0%",
+                    is_html: bool = False) -> Tuple[Optional[str], Optional[AsyncIterator[bytes]]]:
+    """
+    (path, None) if the whole audio is already cached, otherwise (None, stream):
+    the stream yields the audio as it is synthesized (cached segments
+    immediately) and stores the chapter in the cache once complete. An
+    interrupted stream (client gone) keeps only its finished segments.
+    """
+    segments = split_for_tts(text, is_html)
+    if not segments:
+        raise ValueError("Text is empty")
+    key = audio_key(segments, voice, rate)
+    path = tts_cache.path(key)
+    if path:
+        return path, None
+
+    async def stream():
+        tmp_path = os.path.join(tts_cache.cache_dir, f"{uuid.uuid4().hex}.part")
+        complete = False
+        try:
+            chunks = stream_segments(segments, voice, rate)
+            try:
+                with open(tmp_path, "wb") as f:
+                    async for data in chunks:
+                        f.write(data)
+                        yield data
+            finally:
+                await chunks.aclose()
+            complete = True
+        finally:
+            if complete:
+                tts_cache.put_file(key, tmp_path)
+            elif os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    return None, stream()
+
+def write_audiobook(output_path: str, title: str, chapters: List[Dict], artist: str = None) -> List[Dict]:
+    """
+    Join chapter MP3 files into one audiobook behind an ID3 chapter tag.
+    `chapters` are dicts with "title", "path" and "duration_ms" (in order);
+    returns their timeline (title, start_ms, end_ms).
+    """
+    timeline = []
+    position = 0
+    for chapter in chapters:
+        timeline.append({"title": chapter["title"], "start_ms": position, "end_ms": position + chapter["duration_ms"]})
+        position += chapter["duration_ms"]
+    tmp_path = f"{output_path}.part"
+    with open(tmp_path, "wb") as out:
+        out.write(mp3.id3_chapters(title, timeline, artist))
+        for chapter in chapters:
+            with open(chapter["path"], "rb") as f:
+                shutil.copyfileobj(f, out)
+    os.replace(tmp_path, output_path)
+    return timeline
+
+def _benchmark():
+    """Offline load test of concurrent chapter synthesis against the synthetic backend."""
+    import time
+    import argparse
+    import tempfile
+    from .tts_backends import SyntheticTTSBackend
+    from ..utils.tts_cache import AudioCache
+    global tts_backend, tts_cache
+
+    parser = argparse.ArgumentParser(description=_benchmark.__doc__)
+    parser.add_argument("--chapters", type=int, default=8, help="chapters synthesized at once")
+    parser.add_argument("--chars", type=int, default=6000, help="characters per chapter")
+    parser.add_argument("--latency-ms", type=float, default=settings.TTS_SYNTHETIC_LATENCY_MS)
+    parser.add_argument("--speed", type=float, default=settings.TTS_SYNTHETIC_SPEED)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="tts-bench-")
+    tts_backend = SyntheticTTSBackend(latency_ms=args.latency_ms, speed=args.speed)
+    tts_cache = AudioCache(os.path.join(workdir, "cache"), settings.TTS_CACHE_MAX_BYTES, os.path.join(workdir, "cache.db"))
+    sentence = "夜色渐深，城外的风卷起落叶，他低声说道：“我们必须在天亮之前离开。”"
+
+    def chapter(n: int) -> str:
+        # Distinct sentences, so nothing is served from the segment cache
+        return "".join(f"第{n}章第{i}句。{sentence}" for i in range(args.chars // (len(sentence) + 8) + 1))
+
+    async def run():
+        started = time.perf_counter()
+        _, stream = stream_to_cache(chapter(-1))
+        try:
+            async for _ in stream:
+                print(f"stream: first audio after {(time.perf_counter() - started) * 1000:.0f} ms")
+                break
+        finally:
+            await stream.aclose()
+
+        started = time.perf_counter()
+        indexes = await asyncio.gather(*(synthesize_to_file(chapter(n), os.path.join(workdir, f"{n}.mp3"))
+                                         for n in range(args.chapters)))
+        elapsed = time.perf_counter() - started
+        segments = sum(len(index["segments"]) for index in indexes)
+        audio = sum(index["duration_ms"] for index in indexes) / 1000
+        print(f"{args.chapters} chapters x {args.chars} chars: {segments} segments in {elapsed:.2f} s "
+              f"({segments / elapsed:.1f} segments/s, {audio / elapsed:.0f}x real time)")
+
+    asyncio.run(run())
+    shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    _benchmark()
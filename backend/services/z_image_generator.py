@@ -1,129 +1,454 @@
 import os
 import shutil
+import time
 import uuid
+import asyncio
+import threading
+from collections import deque
+from typing import Callable, Dict, List
 try:
+    import httpx
     from gradio_client import Client
 except ImportError:
     Client = None
 
 from ..config import settings
+from ..utils.task_manager import task_manager
+from ..utils.image_cache import image_cache, cache_key, deterministic_seed
+from ..utils.image_variants import schedule_variants
+
+IMAGE_STAGES = ["Queued", "Rendering", "Saving"]
 
 class ZImageGenerator:
-    def __init__(self):
+    """
+    Z-Image-Turbo images are rendered as jobs: submit_job() records an
+    "image_generation" task and returns its id at once. Up to
+    settings.IMAGE_MAX_CONCURRENT_JOBS gradio submit() jobs run at a time, the
+    rest wait in a local queue; progress and results go through task_manager,
+    so clients follow them like any other task (/api/tasks/{id}, SSE).
+    No request or worker thread is held while an image renders.
+
+    The gradio client is created lazily by a background connector thread
+    (never at import time), which health-checks the Space and reconnects with
+    exponential backoff. Jobs submitted while disconnected wait in the queue
+    for up to settings.IMAGE_CONNECT_WAIT_SECONDS.
+    """
+
+    def __init__(self, space: str = None):
+        self.space = space or settings.Z_IMAGE_SPACE
         self.client = None
-        if Client:
-            try:
-                # Initialize client (might fail if network is down or SSL issues)
-                self.client = Client("Tongyi-MAI/Z-Image-Turbo")
-                print("Z-Image-Turbo client initialized successfully.")
-            except Exception as e:
-                print(f"Warning: Failed to initialize Z-Image-Turbo client: {e}")
-        else:
-            print("Warning: gradio_client not installed. Z-Image-Turbo will not work.")
+        self.max_jobs = settings.IMAGE_MAX_CONCURRENT_JOBS
+        self._lock = threading.Lock()
+        self._queue = deque()      # (task_id, params, queued_at) waiting for a free slot
+        self._running = {}         # task_id -> gradio Job
+        self._last_status = {}     # task_id -> last published (progress, step)
+        self._waiters: Dict[str, List[Callable[[], None]]] = {}
+        self._monitor = None
+        # Connection state, reported by get_status()
+        self._connector = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self.state = "idle" if Client else "unavailable"
+        self.last_error = None if Client else "gradio_client module not found. Please install it: pip install gradio_client"
+        self.connected_at = None
+        self.last_check_at = None
+        self.next_retry_at = None
+        self.failures = 0
+
+    # --- Connection management ---
+
+    def start(self):
+        """Start the background connector (idempotent). Returns without waiting for the connection."""
+        if Client is None:
+            return
+        with self._lock:
+            if self._connector and self._connector.is_alive():
+                return
+            self._stop.clear()
+            self._connector = threading.Thread(target=self._connect_loop, name="z-image-connector", daemon=True)
+            self._connector.start()
 
-    def generate_image(self, prompt: str) -> dict:
-        if not self.client:
-             if Client is None:
-                 return {"error": "gradio_client module not found. Please install it: pip install gradio_client"}
-             return {"error": "Z-Image-Turbo client not initialized (check network/SSL)."}
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
 
+    def get_status(self) -> Dict:
+        with self._lock:
+            status = {
+                "backend": "z-image-turbo",
+                "space": self.space,
+                "state": self.state,
+                "ready": self.client is not None,
+                "last_error": self.last_error,
+                "connected_at": self.connected_at,
+                "last_check_at": self.last_check_at,
+                "next_retry_at": self.next_retry_at,
+                "consecutive_failures": self.failures,
+            }
+        status.update(self.get_stats())
+        return status
+
+    def _connect_loop(self):
+        while not self._stop.is_set():
+            if self.client is None:
+                self._try_connect()
+            else:
+                self._health_check()
+            if self.client is None:
+                delay = min(settings.IMAGE_CONNECT_BACKOFF_SECONDS * (2 ** max(0, self.failures - 1)),
+                            settings.IMAGE_CONNECT_BACKOFF_MAX_SECONDS)
+                self.next_retry_at = time.time() + delay
+            else:
+                delay = settings.IMAGE_HEALTH_CHECK_SECONDS
+                self.next_retry_at = None
+            self._wake.wait(delay)
+            self._wake.clear()
+
+    def _try_connect(self):
+        self.state = "connecting"
         try:
-            # The API parameters based on backend/eg/imageGenerate.py
-            # Note: predict() is blocking. For async, use submit() but that requires callback handling.
-            # Since this is called from an async path in FastAPI, blocking call might block the event loop.
-            # Ideally we should run this in a threadpool.
-            
-            print(f"Generating image with prompt: {prompt}")
-            result = self.client.predict(
-                prompt=prompt,
-                resolution="1024x1024 ( 1:1 )",
-                seed=42, # We might want to randomize this
-                steps=8,
-                shift=3,
-                random_seed=True,
-                gallery_images=[],
-                api_name="/generate"
-            )
-            
-            # result logic: gradio_client typically returns the file path for Image outputs
-            image_path = None
-            
-            # Handle different return types
-            if isinstance(result, str):
-                image_path = result
-            elif isinstance(result, (list, tuple)):
-                # If multiple outputs, take the first file path
-                for item in result:
-                    # Case 1: item is the path string
-                    if isinstance(item, str):
-                        image_path = item
-                        if os.path.exists(image_path):
-                            break
-                    # Case 2: item is a dict with file info
-                    if isinstance(item, dict):
-                        if 'name' in item: # sometimes it returns file info dict
-                            image_path = item['name']
-                            break
-                        if 'image' in item: # sometimes {'image': 'path'}
-                            image_path = item['image']
-                            break
-                    # Case 3: item is a list of dicts (e.g. Gallery output)
-                    # Structure: [{'image': 'path', 'caption': None}]
-                    if isinstance(item, list) and len(item) > 0 and isinstance(item[0], dict):
-                        first_img = item[0]
-                        if 'image' in first_img:
-                            image_path = first_img['image']
-                            break
-                        if 'name' in first_img:
-                            image_path = first_img['name']
-                            break
-            
-            print(f"DEBUG: Extracted image_path: {image_path}")
-
-            if image_path:
-                # Check if path exists as-is
-                if not os.path.exists(image_path):
-                    print(f"DEBUG: Path not found as-is: {image_path}. Trying variations...")
-                    
-                    # Variation 1: Fix double backslashes
-                    p1 = image_path.replace("\\\\", "\\")
-                    if os.path.exists(p1):
-                        image_path = p1
-                        print(f"DEBUG: Found path with double backslash fix: {image_path}")
-                    else:
-                        # Variation 2: Replace backslashes with forward slashes
-                        p2 = image_path.replace("\\", "/")
-                        if os.path.exists(p2):
-                            image_path = p2
-                            print(f"DEBUG: Found path with forward slash fix: {image_path}")
-                        else:
-                            # Variation 3: Both
-                            p3 = image_path.replace("\\\\", "\\").replace("\\", "/")
-                            if os.path.exists(p3):
-                                image_path = p3
-                                print(f"DEBUG: Found path with combined fix: {image_path}")
-
-            if not image_path or not os.path.exists(image_path):
-                 print(f"DEBUG: Path does not exist: {image_path}")
-                 return {"error": f"Failed to get valid image path from result: {result}"}
-
-            # Move to storage to make it accessible via web
+            # Makes network requests; might fail if network is down or SSL issues
+            client = Client(self.space, verbose=False)
+        except Exception as e:
+            self._mark_down(f"Failed to initialize Z-Image-Turbo client: {e}")
+            return
+        with self._lock:
+            self.client = client
+            self.state = "ready"
+            self.last_error = None
+            self.failures = 0
+            self.connected_at = self.last_check_at = time.time()
+        print("Z-Image-Turbo client initialized successfully.")
+        self._dispatch()
+
+    def _health_check(self):
+        try:
+            response = httpx.get(self.client.src.rstrip("/") + "/config", timeout=10)
+            response.raise_for_status()
+            self.last_check_at = time.time()
+        except Exception as e:
+            with self._lock:
+                self.client = None
+            self._mark_down(f"Z-Image-Turbo health check failed: {e}")
+
+    def _mark_down(self, error: str):
+        print(f"Warning: {error}")
+        with self._lock:
+            self.state = "error"
+            self.last_error = error
+            self.failures += 1
+
+    def _unavailable_reason(self) -> str:
+        if Client is None:
+            return self.last_error
+        return None
+
+    # --- Job API ---
+
+    def submit_job(self, prompt: str, description: str = None, novel_id: str = None, seed: int = None,
+                   deterministic: bool = None, resolution: str = None, steps: int = None) -> str:
+        """
+        Queue an image render and return its task id immediately.
+
+        Without a seed the model picks a random one and the result is not
+        cached. With `deterministic` (default settings.IMAGE_DETERMINISTIC_SEED)
+        the seed is derived from the prompt, so the same prompt is a cache hit.
+        """
+        if deterministic is None:
+            deterministic = settings.IMAGE_DETERMINISTIC_SEED
+        if seed is None and deterministic:
+            seed = deterministic_seed(prompt)
+        params = {
+            "prompt": prompt,
+            "resolution": resolution or settings.IMAGE_RESOLUTION,
+            "steps": steps or settings.IMAGE_STEPS,
+            "seed": seed,
+        }
+        task_id = task_manager.create_task(
+            "image_generation",
+            description or f"Generating image: {prompt[:40]}",
+            stages=IMAGE_STAGES,
+            novel_id=novel_id
+        )
+
+        if seed is not None:
+            params["cache_key"] = cache_key(prompt, params["resolution"], params["steps"], seed)
             filename = f"z_gen_{uuid.uuid4().hex}.png"
-            dest_path = os.path.join(settings.STORAGE_PATH, filename)
-            
-            # Ensure storage dir exists
             os.makedirs(settings.STORAGE_PATH, exist_ok=True)
-            
-            shutil.move(image_path, dest_path)
-            
-            # Return URL relative to server root
-            # FastAPI mounts /data to STORAGE_PATH
-            url = f"/data/{filename}"
-            
-            return {"image_url": url}
+            dest_path = os.path.join(settings.STORAGE_PATH, filename)
+            if image_cache.get(params["cache_key"], dest_path):
+                schedule_variants(dest_path)
+                task_manager.update_task(task_id, status="completed", progress=100, step="Image loaded from cache",
+                                         current_stage_index=3,
+                                         result={"image_url": f"/data/{filename}", "seed": seed, "cached": True})
+                return task_id
+
+        reason = self._unavailable_reason()
+        if reason:
+            task_manager.update_task(task_id, status="failed", step=f"Error: {reason}", error=reason)
+            return task_id
+
+        with self._lock:
+            self._queue.append((task_id, params, time.time()))
+            self._waiters.setdefault(task_id, [])
+            queued = len(self._queue)
+        if self.client is None:
+            task_manager.update_task(task_id, step="Waiting for the Z-Image-Turbo connection...")
+            self.start()
+            if self.state == "error":
+                self._wake.set()  # retry now rather than at the end of the backoff
+        else:
+            task_manager.update_task(task_id, step=f"Waiting for a render slot ({queued} queued)")
+        self._dispatch()
+        self._ensure_monitor()
+        return task_id
+
+    def on_finished(self, task_id: str, callback: Callable[[], None]):
+        """Call `callback` (from any thread) once the job has finished; at once if it already has."""
+        with self._lock:
+            waiters = self._waiters.get(task_id)
+            if waiters is not None:
+                waiters.append(callback)
+                return
+        callback()
+
+    async def wait(self, task_id: str) -> Dict:
+        """Await a job without occupying a thread. Returns the final task."""
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        self.on_finished(task_id, lambda: loop.call_soon_threadsafe(
+            lambda: done.done() or done.set_result(None)))
+        await done
+        return task_manager.get_task(task_id)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {"running": len(self._running), "queued": len(self._queue), "max_jobs": self.max_jobs}
 
+    # --- Scheduling ---
+
+    def _dispatch(self):
+        # Start queued jobs while there are free slots
+        while True:
+            with self._lock:
+                client = self.client
+                if client is None or len(self._running) >= self.max_jobs or not self._queue:
+                    return
+                task_id, params, _ = self._queue.popleft()
+                self._running[task_id] = None  # reserve the slot
+            if task_manager.is_cancel_requested(task_id):
+                self._release(task_id)
+                continue
+
+            task_manager.update_task(task_id, status="processing", progress=5,
+                                     step="Submitting to Z-Image-Turbo...", current_stage_index=1)
+            print(f"Generating image with prompt: {params['prompt']}")
+            try:
+                job = client.submit(
+                    prompt=params["prompt"],
+                    resolution=params["resolution"],
+                    seed=params["seed"] if params["seed"] is not None else 42,
+                    steps=params["steps"],
+                    shift=3,
+                    random_seed=params["seed"] is None,
+                    gallery_images=[],
+                    api_name="/generate"
+                )
+            except Exception as e:
+                task_manager.update_task(task_id, status="failed", step=f"Error: {e}", error=str(e))
+                self._release(task_id)
+                continue
+            with self._lock:
+                self._running[task_id] = job
+            # Invoked on gradio's thread once the job is done (or right away if it already is)
+            job.future.add_done_callback(
+                lambda _, task_id=task_id, job=job, params=params: self._on_job_done(task_id, job, params))
+
+    def _on_job_done(self, task_id: str, job, params: Dict):
+        with self._lock:
+            if task_id not in self._running:
+                return  # already cancelled
+        try:
+            result = job.result()
+            task_manager.update_task(task_id, progress=90, step="Saving image...", current_stage_index=2)
+            saved = self._save_result(result)
+            if "error" in saved:
+                self._fail(task_id, saved["error"])
+                return
+            saved.update(seed=params["seed"], cached=False)
+            image_path = os.path.join(settings.STORAGE_PATH, os.path.basename(saved["image_url"]))
+            schedule_variants(image_path)
+            if params.get("cache_key"):
+                try:
+                    image_cache.put(params["cache_key"], image_path)
+                except Exception as e:
+                    print(f"Failed to cache image: {e}")
+            task_manager.update_task(task_id, status="completed", progress=100, step="Image generated",
+                                     current_stage_index=3, result=saved)
+            self._finish(task_id)
         except Exception as e:
             print(f"Error generating image: {e}")
-            return {"error": str(e)}
+            self._fail(task_id, str(e))
+
+    def _fail(self, task_id: str, error: str):
+        task_manager.update_task(task_id, status="failed", step=f"Error: {error}", error=error)
+        self._finish(task_id)
+
+    def _finish(self, task_id: str):
+        self._release(task_id)
+        self._dispatch()
+
+    def _release(self, task_id: str):
+        # Free the job's slot and wake anyone waiting for it
+        with self._lock:
+            self._running.pop(task_id, None)
+            self._last_status.pop(task_id, None)
+            waiters = self._waiters.pop(task_id, [])
+        for callback in waiters:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Image job callback failed: {e}")
+
+    def _ensure_monitor(self):
+        with self._lock:
+            if self._monitor and self._monitor.is_alive():
+                return
+            self._monitor = threading.Thread(target=self._monitor_loop, name="z-image-monitor", daemon=True)
+            self._monitor.start()
+
+    def _monitor_loop(self):
+        # One thread reports queue/progress status and handles cancellation for all jobs
+        while True:
+            time.sleep(settings.IMAGE_STATUS_POLL_SECONDS)
+            with self._lock:
+                running = [(tid, job) for tid, job in self._running.items() if job is not None]
+                queued = [(tid, queued_at) for tid, _, queued_at in self._queue]
+                if not running and not queued:
+                    self._monitor = None
+                    return
+            for task_id, job in running:
+                try:
+                    self._poll_job(task_id, job)
+                except Exception as e:
+                    print(f"Failed to poll image job {task_id}: {e}")
+            for task_id, queued_at in queued:
+                if task_manager.is_cancel_requested(task_id):
+                    self._unqueue(task_id)
+                elif self.client is None and time.time() - queued_at > settings.IMAGE_CONNECT_WAIT_SECONDS:
+                    error = f"Z-Image-Turbo unavailable: {self.last_error or 'not connected'}"
+                    task_manager.update_task(task_id, status="failed", step=f"Error: {error}", error=error)
+                    self._unqueue(task_id)
+
+    def _unqueue(self, task_id: str):
+        with self._lock:
+            self._queue = deque(item for item in self._queue if item[0] != task_id)
+        self._release(task_id)
+
+    def _poll_job(self, task_id: str, job):
+        if task_manager.is_cancel_requested(task_id):
+            with self._lock:
+                # Drop the job first so its done callback ignores the cancellation
+                self._running.pop(task_id, None)
+            job.cancel()
+            task_manager.update_task(task_id, status="cancelled", step="Cancelled")
+            self._finish(task_id)
+            return
+        if job.done():
+            return
+        status = job.status()
+        progress, step = 10, "Rendering..."
+        if status.rank is not None and status.queue_size:
+            step = f"Waiting in Z-Image queue ({status.rank + 1}/{status.queue_size})"
+        if status.progress_data:
+            unit = status.progress_data[0]
+            if unit.index is not None and unit.length:
+                progress = 10 + int(75 * unit.index / unit.length)
+                step = f"Rendering... ({unit.index}/{unit.length})"
+        if status.eta:
+            step += f", ~{int(status.eta)}s left"
+        if self._last_status.get(task_id) != (progress, step):
+            self._last_status[task_id] = (progress, step)
+            task_manager.update_task(task_id, progress=progress, step=step)
+
+    # --- Results ---
+
+    def _save_result(self, result) -> dict:
+        # result logic: gradio_client typically returns the file path for Image outputs
+        image_path = None
+
+        # Handle different return types
+        if isinstance(result, str):
+            image_path = result
+        elif isinstance(result, (list, tuple)):
+            # If multiple outputs, take the first file path
+            for item in result:
+                # Case 1: item is the path string
+                if isinstance(item, str):
+                    image_path = item
+                    if os.path.exists(image_path):
+                        break
+                # Case 2: item is a dict with file info
+                if isinstance(item, dict):
+                    if 'name' in item: # sometimes it returns file info dict
+                        image_path = item['name']
+                        break
+                    if 'image' in item: # sometimes {'image': 'path'}
+                        image_path = item['image']
+                        break
+                # Case 3: item is a list of dicts (e.g. Gallery output)
+                # Structure: [{'image': 'path', 'caption': None}]
+                if isinstance(item, list) and len(item) > 0 and isinstance(item[0], dict):
+                    first_img = item[0]
+                    if 'image' in first_img:
+                        image_path = first_img['image']
+                        break
+                    if 'name' in first_img:
+                        image_path = first_img['name']
+                        break
+
+        print(f"DEBUG: Extracted image_path: {image_path}")
+
+        if image_path:
+            # Check if path exists as-is
+            if not os.path.exists(image_path):
+                print(f"DEBUG: Path not found as-is: {image_path}. Trying variations...")
+
+                # Variation 1: Fix double backslashes
+                p1 = image_path.replace("\\\\", "\\")
+                if os.path.exists(p1):
+                    image_path = p1
+                    print(f"DEBUG: Found path with double backslash fix: {image_path}")
+                else:
+                    # Variation 2: Replace backslashes with forward slashes
+                    p2 = image_path.replace("\\", "/")
+                    if os.path.exists(p2):
+                        image_path = p2
+                        print(f"DEBUG: Found path with forward slash fix: {image_path}")
+                    else:
+                        # Variation 3: Both
+                        p3 = image_path.replace("\\\\", "\\").replace("\\", "/")
+                        if os.path.exists(p3):
+                            image_path = p3
+                            print(f"DEBUG: Found path with combined fix: {image_path}")
+
+        if not image_path or not os.path.exists(image_path):
+            print(f"DEBUG: Path does not exist: {image_path}")
+            return {"error": f"Failed to get valid image path from result: {result}"}
+
+        # Move to storage to make it accessible via web
+        filename = f"z_gen_{uuid.uuid4().hex}.png"
+        dest_path = os.path.join(settings.STORAGE_PATH, filename)
+
+        # Ensure storage dir exists
+        os.makedirs(settings.STORAGE_PATH, exist_ok=True)
+
+        shutil.move(image_path, dest_path)
+
+        # Return URL relative to server root
+        # FastAPI mounts /data to STORAGE_PATH
+        url = f"/data/{filename}"
+
+        return {"image_url": url}
 
 z_image_generator = ZImageGenerator()
@@ -0,0 +1,285 @@
+"""
+Shared coordination layer: named locks and a small key/value store that work
+across processes (and, with the Redis backend, across hosts).
+
+Backends:
+  - "local": file locks (fcntl/msvcrt) plus SQLite, for several uvicorn or
+    task-worker processes on one host.
+  - "redis": any server speaking the Redis protocol (Redis, Valkey, or the
+    stand-in in utils/resp_standin.py). No client library is required.
+
+Select with MONSTER_COORDINATION_BACKEND / MONSTER_REDIS_URL (see settings).
+"""
+import os
+import re
+import time
+import uuid
+import socket
+import sqlite3
+import hashlib
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Optional
+from urllib.parse import urlparse
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from ..config import settings
+
+class LockTimeout(Exception):
+    """Raised when a lock could not be acquired within the timeout."""
+
+class LockLost(Exception):
+    """Raised on leaving a lock whose TTL expired while it was held (another holder may have run meanwhile)."""
+
+class CoordinationBackend(ABC):
+    # True when the backend is reachable from other hosts
+    shared = False
+
+    @abstractmethod
+    def lock(self, name: str, timeout: float = 30.0, ttl: float = 60.0):
+        """Context manager holding the named lock; LockTimeout if not acquired within `timeout`."""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: str, ttl: float = None):
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+def _safe_name(name: str) -> str:
+    # Readable prefix plus a hash so distinct names never collide on disk
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", name)[:64] + "-" + hashlib.sha1(name.encode("utf-8")).hexdigest()[:12]
+
+class LocalBackend(CoordinationBackend):
+    """File locks and SQLite key/value store under settings.STATE_PATH. Single host only."""
+
+    def __init__(self, state_path: str = None):
+        state_path = state_path or settings.STATE_PATH
+        self.lock_dir = os.path.join(state_path, "locks")
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self.db_path = os.path.join(state_path, "coordination.db")
+        self._local = threading.local()
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _try_lock(f) -> bool:
+        try:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def _unlock(f):
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    @contextmanager
+    def lock(self, name: str, timeout: float = 30.0, ttl: float = 60.0):
+        # `ttl` is not needed here: the OS releases file locks when the holder dies
+        f = open(os.path.join(self.lock_dir, _safe_name(name) + ".lock"), "a+")
+        try:
+            deadline = time.time() + timeout
+            while not self._try_lock(f):
+                if time.time() >= deadline:
+                    raise LockTimeout(name)
+                time.sleep(0.02)
+            try:
+                yield
+            finally:
+                self._unlock(f)
+        finally:
+            f.close()
+
+    def get(self, key: str) -> Optional[str]:
+        row = self._conn().execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str, ttl: float = None):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, time.time() + ttl if ttl else None)
+        )
+
+    def delete(self, key: str):
+        self._conn().execute("DELETE FROM kv WHERE key = ?", (key,))
+
+class RedisError(Exception):
+    pass
+
+# Deletes the lock only if we still own it (compare-and-delete)
+RELEASE_LOCK_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+# Extends the lock's TTL only if we still own it
+RENEW_LOCK_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end"
+
+class RedisBackend(CoordinationBackend):
+    """Minimal RESP2 client. One connection per thread, reconnecting on failure."""
+    shared = True
+
+    def __init__(self, url: str = None, socket_timeout: float = 5.0):
+        parsed = urlparse(url or settings.REDIS_URL)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.socket_timeout = socket_timeout
+        self._local = threading.local()
+
+    # --- Protocol ---
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.socket_timeout)
+        self._local.sock = sock
+        self._local.reader = sock.makefile("rb")
+        if self.password:
+            self._send("AUTH", self.password)
+        if self.db:
+            self._send("SELECT", self.db)
+
+    def _send(self, *args):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+        self._local.sock.sendall(b"".join(parts))
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self._local.reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by server")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode("utf-8")
+        if kind == b"-":
+            raise RedisError(rest.decode("utf-8"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length == -1:
+                return None
+            data = self._local.reader.read(length + 2)
+            return data[:-2].decode("utf-8")
+        if kind == b"*":
+            count = int(rest)
+            if count == -1:
+                return None
+            return [self._read_reply() for _ in range(count)]
+        raise RedisError(f"Unexpected reply: {line!r}")
+
+    def execute(self, *args):
+        if getattr(self._local, "sock", None) is None:
+            self._connect()
+        try:
+            return self._send(*args)
+        except (ConnectionError, OSError):
+            # Retry once on a fresh connection
+            self._close()
+            self._connect()
+            return self._send(*args)
+
+    def _close(self):
+        for name in ("reader", "sock"):
+            conn = getattr(self._local, name, None)
+            setattr(self._local, name, None)
+            if conn is not None:
+                try:
+                    conn.close()
+                except OSError:
+                    pass
+
+    # --- Backend interface ---
+
+    @contextmanager
+    def lock(self, name: str, timeout: float = 30.0, ttl: float = 60.0):
+        # The TTL bounds how long a crashed holder can block others; while we
+        # hold the lock a thread (with its own connection) keeps extending it
+        key = f"monster:lock:{name}"
+        token = uuid.uuid4().hex
+        ttl_ms = int(ttl * 1000)
+        deadline = time.time() + timeout
+        while self.execute("SET", key, token, "NX", "PX", ttl_ms) is None:
+            if time.time() >= deadline:
+                raise LockTimeout(name)
+            time.sleep(0.02)
+
+        stop = threading.Event()
+        lost = threading.Event()
+
+        def renew():
+            try:
+                while not stop.wait(ttl / 3):
+                    try:
+                        if not self.execute("EVAL", RENEW_LOCK_SCRIPT, 1, key, token, ttl_ms):
+                            lost.set()
+                            return
+                    except (RedisError, OSError) as e:
+                        print(f"Failed to renew lock {name}: {e}")
+            finally:
+                self._close()
+
+        renewer = threading.Thread(target=renew, name=f"lock-renew:{name}", daemon=True)
+        renewer.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            renewer.join()
+            released = self.execute("EVAL", RELEASE_LOCK_SCRIPT, 1, key, token)
+        # Not ours any more at release: it expired between two renewals
+        if lost.is_set() or not released:
+            raise LockLost(name)
+
+    def get(self, key: str) -> Optional[str]:
+        return self.execute("GET", f"monster:{key}")
+
+    def set(self, key: str, value: str, ttl: float = None):
+        if ttl:
+            self.execute("SET", f"monster:{key}", value, "PX", int(ttl * 1000))
+        else:
+            self.execute("SET", f"monster:{key}", value)
+
+    def delete(self, key: str):
+        self.execute("DEL", f"monster:{key}")
+
+def create_backend(name: str = None) -> CoordinationBackend:
+    name = name or settings.COORDINATION_BACKEND
+    if name == "redis":
+        return RedisBackend()
+    if name == "local":
+        return LocalBackend()
+    raise ValueError(f"Unknown coordination backend: {name}")
+
+coordination = create_backend()
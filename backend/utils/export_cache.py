@@ -0,0 +1,157 @@
+"""
+Cache for novel exports, keyed by the novel's revision: a hash over its
+metadata and outline plus the content hash of every chapter file.
+
+- Chapter hashes are memoized by file size and mtime, so computing the
+  revision of an unchanged novel does not read the chapters again.
+- Finished export files live in settings.EXPORT_CACHE_PATH, one per novel
+  and format (an older revision is removed when a newer one is stored).
+- Converted chapters (EPUB XHTML, plain text for TXT/DOCX) are kept in
+  SQLite under the chapter's content hash, so a rebuild after an edit only
+  converts the changed chapters.
+"""
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Dict, Optional, Tuple
+
+from ..config import settings
+
+class ExportCache:
+    def __init__(self, cache_dir: str = None, db_path: str = None, max_sections: int = None):
+        self.cache_dir = cache_dir or settings.EXPORT_CACHE_PATH
+        self.db_path = db_path or os.path.join(settings.STATE_PATH, "export_cache.db")
+        self.max_sections = max_sections or settings.EXPORT_SECTION_CACHE_ENTRIES
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "section_hits": 0, "section_misses": 0}
+        conn = self._conn()
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS file_hashes (
+                   path TEXT PRIMARY KEY,
+                   size INTEGER NOT NULL,
+                   mtime_ns INTEGER NOT NULL,
+                   hash TEXT NOT NULL
+               )"""
+        )
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS sections (
+                   key TEXT PRIMARY KEY,
+                   title TEXT NOT NULL,
+                   body TEXT NOT NULL,
+                   last_access REAL NOT NULL
+               )"""
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sections_lru ON sections (last_access)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def file_hash(self, path: str) -> str:
+        """sha256 of the file's bytes, recomputed only when its size or mtime changes."""
+        stat = os.stat(path)
+        conn = self._conn()
+        row = conn.execute("SELECT size, mtime_ns, hash FROM file_hashes WHERE path = ?", (path,)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        conn.execute("INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, hash) VALUES (?, ?, ?, ?)",
+                     (path, stat.st_size, stat.st_mtime_ns, digest))
+        return digest
+
+    # --- Finished exports ---
+
+    def _prefix(self, novel_id: str, fmt: str) -> str:
+        safe_id = hashlib.sha1(str(novel_id).encode("utf-8")).hexdigest()[:12]
+        return f"novel-{safe_id}-{fmt}-"
+
+    def export_path(self, novel_id: str, revision: str, fmt: str) -> str:
+        return os.path.join(self.cache_dir, f"{self._prefix(novel_id, fmt)}{revision}.{fmt}")
+
+    def get(self, novel_id: str, revision: str, fmt: str) -> Optional[str]:
+        path = self.export_path(novel_id, revision, fmt)
+        if os.path.exists(path):
+            self._count("hits")
+            return path
+        self._count("misses")
+        return None
+
+    def store(self, novel_id: str, revision: str, fmt: str, tmp_path: str) -> Tuple[str, int]:
+        """
+        Move a finished export into the cache, replacing older revisions of the
+        same novel and format. Returns its path and size (taken before it is
+        published: a newer revision may replace it at any time after).
+        """
+        path = self.export_path(novel_id, revision, fmt)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        prefix = self._prefix(novel_id, fmt)
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(prefix) and name.endswith(f".{fmt}") and os.path.join(self.cache_dir, name) != path:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+        return path, size
+
+    def temp_path(self, fmt: str) -> str:
+        return os.path.join(self.cache_dir, f".{os.getpid()}-{threading.get_ident()}-{time.time_ns()}.{fmt}.part")
+
+    # --- Per-chapter sections ---
+
+    def get_section(self, key: str) -> Optional[Tuple[str, str]]:
+        conn = self._conn()
+        row = conn.execute("SELECT title, body FROM sections WHERE key = ?", (key,)).fetchone()
+        if row:
+            conn.execute("UPDATE sections SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._count("section_hits")
+            return row[0], row[1]
+        self._count("section_misses")
+        return None
+
+    def has_section(self, key: str) -> bool:
+        return self._conn().execute("SELECT 1 FROM sections WHERE key = ?", (key,)).fetchone() is not None
+
+    def put_section(self, key: str, title: str, body: str):
+        conn = self._conn()
+        conn.execute("INSERT OR REPLACE INTO sections (key, title, body, last_access) VALUES (?, ?, ?, ?)",
+                     (key, title, body, time.time()))
+        # Keep the most recently used sections only
+        conn.execute(
+            """DELETE FROM sections WHERE key IN (
+                   SELECT key FROM sections ORDER BY last_access DESC LIMIT -1 OFFSET ?)""",
+            (self.max_sections,)
+        )
+
+    def clear(self) -> int:
+        removed = 0
+        for name in os.listdir(self.cache_dir):
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+                removed += 1
+            except OSError:
+                pass
+        self._conn().execute("DELETE FROM sections")
+        return removed
+
+    def get_stats(self) -> Dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["sections"] = self._conn().execute("SELECT COUNT(*) FROM sections").fetchone()[0]
+        stats["files"] = len([n for n in os.listdir(self.cache_dir) if not n.endswith(".part")])
+        return stats
+
+export_cache = ExportCache()
@@ -0,0 +1,136 @@
+"""
+Disk cache of files keyed by content keys, with an SQLite index and a byte
+budget: the least recently used entries are evicted once the cache grows
+beyond it. Base of the image cache (utils/image_cache.py) and the speech
+cache (utils/tts_cache.py).
+
+Entries are handed out as hard links (or copies) by get(), so evicting an
+entry never breaks a file that was already returned.
+"""
+import os
+import time
+import shutil
+import sqlite3
+import threading
+from typing import Dict, Optional
+
+def link_or_copy(src: str, dest: str):
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+class FileCache:
+    # Extension of entries added from a file without one
+    default_extension = ""
+
+    def __init__(self, cache_dir: str, max_bytes: int, db_path: str):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.db_path = db_path
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        self._conn().execute(
+            """CREATE TABLE IF NOT EXISTS entries (
+                   key TEXT PRIMARY KEY,
+                   filename TEXT NOT NULL,
+                   size INTEGER NOT NULL,
+                   created_ts REAL NOT NULL,
+                   last_access REAL NOT NULL,
+                   hits INTEGER NOT NULL DEFAULT 0
+               )"""
+        )
+        self._conn().execute("CREATE INDEX IF NOT EXISTS idx_entries_lru ON entries (last_access)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, name: str, n: int = 1):
+        with self._stats_lock:
+            self._stats[name] += n
+
+    def path(self, key: str) -> Optional[str]:
+        """Path of the cached file for key, or None (counted as a hit or a miss)."""
+        conn = self._conn()
+        row = conn.execute("SELECT filename FROM entries WHERE key = ?", (key,)).fetchone()
+        path = os.path.join(self.cache_dir, row[0]) if row else None
+        if path and os.path.exists(path):
+            conn.execute("UPDATE entries SET last_access = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+            self._count("hits")
+            return path
+        if row:
+            # File removed behind our back
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self._count("misses")
+        return None
+
+    def get(self, key: str, dest_path: str) -> bool:
+        """On a hit, materialize the cached file at dest_path and return True."""
+        path = self.path(key)
+        if not path:
+            return False
+        link_or_copy(path, dest_path)
+        return True
+
+    def put(self, key: str, src_path: str):
+        """Add a file (src_path is left in place) and enforce the disk budget."""
+        filename = f"{key}{os.path.splitext(src_path)[1] or self.default_extension}"
+        path = os.path.join(self.cache_dir, filename)
+        if not os.path.exists(path):
+            link_or_copy(src_path, path)
+        self._add_entry(key, filename)
+
+    def _add_entry(self, key: str, filename: str):
+        now = time.time()
+        self._conn().execute(
+            "INSERT OR REPLACE INTO entries (key, filename, size, created_ts, last_access) VALUES (?, ?, ?, ?, ?)",
+            (key, filename, os.path.getsize(os.path.join(self.cache_dir, filename)), now, now)
+        )
+        self._count("stores")
+        self.evict()
+
+    def evict(self, max_bytes: int = None) -> int:
+        """Drop least recently used entries until the cache fits its budget."""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        conn = self._conn()
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        evicted = 0
+        if total <= max_bytes:
+            return 0
+        for key, filename, size in conn.execute(
+            "SELECT key, filename, size FROM entries ORDER BY last_access"
+        ).fetchall():
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, filename))
+            except FileNotFoundError:
+                pass
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+        self._count("evictions", evicted)
+        return evicted
+
+    def clear(self) -> int:
+        return self.evict(max_bytes=0)
+
+    def get_stats(self) -> Dict:
+        entries, size = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        with self._stats_lock:
+            stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats.update({
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "hit_rate": round(stats["hits"] / lookups, 3) if lookups else None,
+        })
+        return stats
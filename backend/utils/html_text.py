@@ -0,0 +1,121 @@
+"""
+Plain text of chapter HTML (Tiptap), in one pass.
+
+Tags are dropped, entities decoded, and block ends (</p>, <br>, headings,
+list items...) become line breaks, so paragraphs survive as lines. Every
+chapter file stores its plain text next to the HTML ("plain_text", with
+"word_count" and the "text_hash" of the content it was made from);
+refresh_chapter() is called wherever a chapter's content is saved, and
+chapter_text() is what export, TTS, illustration, extraction and context
+building read instead of parsing the HTML again.
+"""
+import re
+import html
+import hashlib
+from typing import Dict, List, Tuple
+
+_HTML = re.compile(r'<(p|div|br|h[1-6])\b', re.IGNORECASE)
+_BLOCK_END = re.compile(r'</(p|div|h[1-6]|li|blockquote|pre)>|<br\s*/?>', re.IGNORECASE)
+_ENTITY = re.compile(r'&(#\d+|#x[0-9a-fA-F]+|\w+);')
+# Only real tags: a "<" in prose ("x<y") is text, not the start of markup
+_TAG = re.compile(r'<[A-Za-z/!][^<>]*>')
+_MARKUP = re.compile(_TAG.pattern + r'|&(?:#\d+|#x[0-9a-fA-F]+|\w+);')
+_BLANK_LINES = re.compile(r'[^\S\n]*\n\s*')
+_CJK = re.compile(r'[\u3000-\u303f\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]')
+_WORD = re.compile(r"[A-Za-z0-9]+(?:['’-][A-Za-z0-9]+)*")
+
+def _replace(m: re.Match) -> str:
+    token = m.group(0)
+    if token[0] == "&":
+        return html.unescape(token)
+    return "\n" if _BLOCK_END.fullmatch(token) else ""
+
+def is_html(content: str) -> bool:
+    """Whether `content` is editor HTML rather than plain text (as generated chapters are stored)."""
+    return bool(_HTML.search(content))
+
+def plain_text(content: str) -> str:
+    """Text of `content` with one line per paragraph (no empty lines, lines stripped)."""
+    if not content:
+        return ""
+    if not is_html(content):
+        text = content
+    else:
+        text = _MARKUP.sub(_replace, content)
+    return _BLANK_LINES.sub("\n", text).strip()
+
+def paragraphs(content: str) -> List[str]:
+    text = plain_text(content)
+    return text.split("\n") if text else []
+
+def html_to_text(content: str) -> Tuple[str, List[int]]:
+    """
+    Like plain_text(), but keeps all whitespace and returns, for every
+    plain-text position, its offset in `content` (with one extra entry for
+    the end). Used where positions must map back into the HTML.
+    """
+    out = []
+    offsets = []
+    pos = 0
+    length = len(content)
+    while pos < length:
+        ch = content[pos]
+        tag = _TAG.match(content, pos) if ch == "<" else None
+        if tag:
+            if _BLOCK_END.fullmatch(tag.group(0)):
+                out.append("\n")
+                offsets.append(pos)
+            pos = tag.end()
+        elif ch == "&":
+            m = _ENTITY.match(content, pos)
+            decoded = html.unescape(m.group(0)) if m else ch
+            if m and decoded != m.group(0):
+                out.append(decoded)
+                offsets.extend([pos] * len(decoded))
+                pos = m.end()
+            else:
+                out.append(ch)
+                offsets.append(pos)
+                pos += 1
+        else:
+            # Copy the run of plain characters up to the next tag or entity in one go
+            nxt = pos + 1
+            while nxt < length and content[nxt] not in "<&":
+                nxt += 1
+            out.append(content[pos:nxt])
+            offsets.extend(range(pos, nxt))
+            pos = nxt
+    offsets.append(length)
+    return "".join(out), offsets
+
+def word_count(text: str) -> int:
+    """字数 as editors count it: every CJK character (and full-width punctuation) plus every Latin word or number."""
+    return len(_CJK.findall(text)) + len(_WORD.findall(text))
+
+# Part of text_hash(), so plain text stored by an older conversion is derived again
+_TEXT_VERSION = 2
+
+def text_hash(content: str) -> str:
+    return hashlib.sha1(f"v{_TEXT_VERSION}:{content or ''}".encode("utf-8")).hexdigest()[:16]
+
+def refresh_chapter(data: Dict) -> Dict:
+    """Store the plain text and word count of the chapter's current content in `data` (returned)."""
+    content = data.get("content") or ""
+    data["plain_text"] = plain_text(content)
+    data["word_count"] = word_count(data["plain_text"])
+    data["text_hash"] = text_hash(content)
+    return data
+
+def is_fresh(data: Dict) -> bool:
+    return "plain_text" in data and data.get("text_hash") == text_hash(data.get("content") or "")
+
+def chapter_text(data: Dict) -> str:
+    """The chapter's stored plain text, or derived from the content if it is missing or stale."""
+    if is_fresh(data):
+        return data["plain_text"]
+    return plain_text(data.get("content") or "")
+
+def chapter_word_count(data: Dict) -> int:
+    if is_fresh(data) and "word_count" in data:
+        return data["word_count"]
+    return word_count(chapter_text(data))
@@ -0,0 +1,132 @@
+"""
+Conditional GETs and compression for the JSON API.
+
+The views poll chapters, assets and novel lists; a repeated poll of
+unchanged data should not resend it. JSONResponseCacheMiddleware gives
+every JSON GET response under /api a strong ETag (hash of the body) and
+`Cache-Control: no-cache`, so the browser revalidates with If-None-Match
+and gets an empty 304 while nothing changed. Bodies of at least
+settings.HTTP_COMPRESS_MIN_BYTES are sent brotli (if the `brotli` package is
+installed) or gzip compressed, whichever the client accepts.
+
+Media under /data is handled by the static mount (utils/image_variants.py):
+ETag/Last-Modified and Range for every file, immutable cache headers for
+uuid-named files and versioned variants, `no-cache` for files that can be
+rewritten under the same name.
+"""
+import gzip
+import hashlib
+from typing import List
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from ..config import settings
+
+# Suffixes that mark the compressed representations of the same ETag
+_ENCODING_SUFFIX = {"br": "-br", "gzip": "-gz"}
+
+def etag_for(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match contains `etag` (or one of its compressed variants)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        for suffix in _ENCODING_SUFFIX.values():
+            if candidate.endswith(suffix + '"'):
+                candidate = candidate[:-len(suffix) - 1] + '"'
+        if candidate == etag:
+            return True
+    return False
+
+def choose_encoding(accept_encoding: str) -> str:
+    accepted = set()
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    if brotli and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=settings.HTTP_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=settings.HTTP_GZIP_LEVEL, mtime=0)
+
+class JSONResponseCacheMiddleware:
+    """ASGI middleware adding ETag/304 handling and compression to JSON GET responses under `prefix`."""
+
+    def __init__(self, app, prefix: str = "/api"):
+        self.app = app
+        self.prefix = prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET" or not scope["path"].startswith(self.prefix):
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+        start = None
+        chunks: List[bytes] = []
+
+        async def wrapped_send(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                headers = {k.decode("latin-1").lower() for k, _ in message.get("headers", [])}
+                content_type = next((v.decode("latin-1") for k, v in message.get("headers", [])
+                                     if k.decode("latin-1").lower() == "content-type"), "")
+                # Only plain JSON bodies are buffered; files, streams and errors pass through
+                if message["status"] == 200 and content_type.startswith("application/json") \
+                        and "etag" not in headers and "content-encoding" not in headers:
+                    start = message
+                    return
+                await send(message)
+            elif start is None:
+                await send(message)
+            else:
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    await self._finish(start, b"".join(chunks), request_headers, send)
+
+        await self.app(scope, receive, wrapped_send)
+
+    async def _finish(self, start, body: bytes, request_headers: dict, send):
+        headers = [(k, v) for k, v in start.get("headers", []) if k.decode("latin-1").lower() != "content-length"]
+        headers += [(b"cache-control", b"no-cache"), (b"vary", b"Accept-Encoding")]
+        encoding = choose_encoding(request_headers.get("accept-encoding")) \
+            if len(body) >= settings.HTTP_COMPRESS_MIN_BYTES else None
+        etag = etag_for(body)
+        if encoding:
+            etag = etag[:-1] + _ENCODING_SUFFIX[encoding] + '"'
+
+        if etag_matches(request_headers.get("if-none-match"), etag_for(body)):
+            headers = [(k, v) for k, v in headers if k.decode("latin-1").lower() != "content-type"]
+            await send({"type": "http.response.start", "status": 304,
+                        "headers": headers + [(b"etag", etag.encode("latin-1"))]})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        if encoding:
+            body = compress(body, encoding)
+            headers.append((b"content-encoding", encoding.encode("latin-1")))
+        headers += [(b"etag", etag.encode("latin-1")), (b"content-length", str(len(body)).encode("latin-1"))]
+        await send({"type": "http.response.start", "status": start["status"], "headers": headers})
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,42 @@
+"""
+Content cache for rendered images, keyed by the normalized prompt plus the
+render parameters (resolution, steps, seed). Only renders with a known seed
+are cacheable: with a random seed the same request is expected to produce a
+new image.
+
+Cached files live in settings.IMAGE_CACHE_PATH, in the LRU store of
+utils/file_cache.py (settings.IMAGE_CACHE_MAX_BYTES budget). Results are
+handed out as hard links (or copies), so evicting an entry never breaks an
+image URL that was already returned.
+"""
+import os
+import json
+import hashlib
+import unicodedata
+
+from ..config import settings
+from .file_cache import FileCache
+
+def normalize_prompt(prompt: str) -> str:
+    # Width variants, case and whitespace do not change the rendered image
+    return " ".join(unicodedata.normalize("NFKC", prompt).lower().split())
+
+def cache_key(prompt: str, resolution: str, steps: int, seed: int) -> str:
+    params = {"prompt": normalize_prompt(prompt), "resolution": resolution, "steps": steps, "seed": seed}
+    return hashlib.sha256(json.dumps(params, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def deterministic_seed(prompt: str) -> int:
+    """Seed derived from the prompt, so regenerating the same prompt is an exact cache hit."""
+    return int(hashlib.sha256(normalize_prompt(prompt).encode("utf-8")).hexdigest()[:8], 16) % (2 ** 31)
+
+class ImageCache(FileCache):
+    default_extension = ".png"
+
+    def __init__(self, cache_dir: str = None, max_bytes: int = None, db_path: str = None):
+        super().__init__(
+            cache_dir or settings.IMAGE_CACHE_PATH,
+            max_bytes if max_bytes is not None else settings.IMAGE_CACHE_MAX_BYTES,
+            db_path or os.path.join(settings.STATE_PATH, "image_cache.db"),
+        )
+
+image_cache = ImageCache()
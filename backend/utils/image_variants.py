@@ -0,0 +1,163 @@
+"""
+Resized image variants (thumbnails) for files under STORAGE_PATH.
+
+`/data/<image>?w=256` serves a variant no wider than the requested width
+(snapped up to one of settings.IMAGE_VARIANT_WIDTHS), encoded as WebP when
+the client accepts it (AVIF with `&format=avif`). Variants are generated once, either in the
+background when an image is stored (schedule_variants) or on first request.
+
+Files whose names embed a uuid or content hash (`z_gen_<uuid>.png`) are
+never rewritten and get immutable cache headers. Other files can be rebuilt
+under the same name (audiobooks, chapter audio), so they are sent with
+`Cache-Control: no-cache` and revalidated against their size+mtime ETag.
+Variants of such files are versioned in the URL instead: an unversioned or
+stale `?w=` request is redirected to `&v=<source version>`, and a versioned
+variant is immutable. Range requests work as usual.
+
+Requires Pillow; without it the original file is served unchanged.
+"""
+import os
+import re
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from urllib.parse import parse_qs
+
+import anyio
+from fastapi.staticfiles import StaticFiles
+from starlette.responses import RedirectResponse
+from starlette.staticfiles import NotModifiedResponse
+from starlette.datastructures import URL, Headers
+from starlette.responses import FileResponse
+
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+
+from ..config import settings
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".gif", ".bmp"}
+MEDIA_TYPES = {"webp": "image/webp", "avif": "image/avif", "png": "image/png", "jpeg": "image/jpeg"}
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Files that may be rewritten under the same name are revalidated on each use
+REVALIDATE_CACHE_CONTROL = "no-cache"
+# A uuid or content hash in the name means the file is never rewritten
+_UNIQUE_NAME = re.compile(r"[0-9a-f]{32}")
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="image-variants")
+# Variant generation is serialized per destination through a fixed pool of
+# locks (unrelated variants occasionally share one), so memory stays bounded
+_LOCK_STRIPES = 64
+_locks = [threading.Lock() for _ in range(_LOCK_STRIPES)]
+
+_formats = None
+
+def _supported_formats():
+    global _formats
+    if _formats is None:
+        _formats = set()
+        if Image:
+            _formats = {"png", "jpeg"} | {fmt for fmt in ("webp", "avif") if features.check(fmt)}
+    return _formats
+
+def snap_width(width: int) -> int:
+    # Only a fixed set of sizes is generated, so arbitrary ?w= values cannot fill the disk
+    for allowed in settings.IMAGE_VARIANT_WIDTHS:
+        if width <= allowed:
+            return allowed
+    return settings.IMAGE_VARIANT_WIDTHS[-1]
+
+def choose_format(accept: str = "", requested: str = None) -> str:
+    formats = _supported_formats()
+    if requested in formats:
+        return requested
+    # WebP is what schedule_variants() pre-generates and every current browser accepts
+    if "webp" in formats and ("image/webp" in (accept or "") or not accept):
+        return "webp"
+    return "png"
+
+def is_immutable(path: str) -> bool:
+    return bool(_UNIQUE_NAME.search(os.path.splitext(os.path.basename(path))[0]))
+
+def source_version(source: str) -> str:
+    # Changes with the source's size and mtime, so a replaced file gets new variants
+    stat = os.stat(source)
+    rel = os.path.relpath(source, settings.STORAGE_PATH)
+    return hashlib.sha1(f"{rel}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8")).hexdigest()[:16]
+
+def variant_path(source: str, width: int, fmt: str) -> str:
+    stem = os.path.splitext(os.path.basename(source))[0]
+    return os.path.join(settings.IMAGE_VARIANT_PATH, f"{stem}-{source_version(source)}-w{width}.{fmt}")
+
+def _lock_for(path: str) -> threading.Lock:
+    return _locks[int(hashlib.sha1(path.encode("utf-8")).hexdigest()[:8], 16) % _LOCK_STRIPES]
+
+def get_variant(source: str, width: int, fmt: str) -> Optional[str]:
+    """Path of the variant, generating it if needed. None if it cannot be made."""
+    if not Image or os.path.splitext(source)[1].lower() not in IMAGE_EXTENSIONS or not os.path.isfile(source):
+        return None
+    dest = variant_path(source, width, fmt)
+    if os.path.exists(dest):
+        return dest
+    with _lock_for(dest):
+        if os.path.exists(dest):
+            return dest
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        try:
+            with Image.open(source) as img:
+                if img.width > width:
+                    img.thumbnail((width, round(img.height * width / img.width)), Image.LANCZOS)
+                if fmt == "jpeg" and img.mode not in ("RGB", "L"):
+                    img = img.convert("RGB")
+                tmp = f"{dest}.tmp"
+                img.save(tmp, format=fmt.upper(), quality=settings.IMAGE_VARIANT_QUALITY)
+                os.replace(tmp, dest)
+        except Exception as e:
+            print(f"Failed to create image variant for {source}: {e}")
+            return None
+    return dest
+
+def schedule_variants(source: str):
+    """Pre-generate the standard variants in the background after an image is stored."""
+    if not Image:
+        return
+    fmt = choose_format(requested="webp")
+    for width in settings.IMAGE_VARIANT_WIDTHS:
+        _executor.submit(get_variant, source, width, fmt)
+
+class VariantStaticFiles(StaticFiles):
+    """StaticFiles that serves resized variants for `?w=` requests on images, with cache headers."""
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL if is_immutable(full_path) else REVALIDATE_CACHE_CONTROL
+        return response
+
+    async def get_response(self, path: str, scope):
+        params = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        width = params.get("w", [None])[0]
+        if width and width.isdigit() and Image:
+            source = os.path.join(self.directory, path)
+            if os.path.commonpath([os.path.realpath(source), os.path.realpath(self.directory)]) == os.path.realpath(self.directory):
+                headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+                fmt = choose_format(headers.get("accept", ""), params.get("format", [None])[0])
+                variant = await anyio.to_thread.run_sync(get_variant, source, snap_width(int(width)), fmt)
+                if variant:
+                    if not is_immutable(source):
+                        # The URL must name the source version for the variant to be cached for good
+                        version = source_version(source)
+                        if params.get("v", [None])[0] != version:
+                            url = URL(scope=scope).include_query_params(v=version)
+                            return RedirectResponse(f"{url.path}?{url.query}",
+                                                    headers={"Cache-Control": REVALIDATE_CACHE_CONTROL})
+                    # Given the stat, the response carries its ETag/Last-Modified for the 304 check below
+                    response = FileResponse(variant, media_type=MEDIA_TYPES[fmt], stat_result=os.stat(variant), headers={
+                        "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+                        "Vary": "Accept",
+                    })
+                    if self.is_not_modified(response.headers, Headers(scope=scope)):
+                        return NotModifiedResponse(response.headers)
+                    return response
+        return await super().get_response(path, scope)
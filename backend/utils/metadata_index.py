@@ -0,0 +1,301 @@
+"""
+SQLite index of novel, chapter and asset metadata, for paginated lists.
+
+The JSON files in settings.STORAGE_PATH stay the source of truth. The index
+keeps one row per novel, chapter and asset holding its small fields (large
+ones such as chapter content, outlines and wiki details are left out), so a
+list page is a keyset query that loads files only for the rows shown, and
+only when a large field is asked for.
+
+storage.save_json() and delete_file() update the index as files are
+written; every settings.METADATA_INDEX_RESYNC_SECONDS a stat pass (which
+does not parse unchanged files) also picks up files changed by other means.
+"""
+import os
+import re
+import json
+import time
+import base64
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from ..config import settings
+from . import html_text
+
+_CHAPTER_FILE = re.compile(r"^novel_(.+)_chapter_(\d+)\.json$")
+_ASSETS_FILE = re.compile(r"^novel_(.+)_assets\.json$")
+_NOVEL_FILE = re.compile(r"^novel_(.+)\.json$")
+
+# Fields not stored in the index; asking for them loads the file
+LARGE_FIELDS = {
+    "novel": {"outline"},
+    "chapter": {"content", "plain_text", "images"},
+    "asset": {"details"},
+}
+
+def classify(filename: str) -> Optional[Tuple[str, str, Optional[int]]]:
+    """(kind, novel_id, chapter_num) of an indexed file name ("novel", "chapter" or "assets"), else None."""
+    m = _CHAPTER_FILE.match(filename)
+    if m:
+        return "chapter", m.group(1), int(m.group(2))
+    m = _ASSETS_FILE.match(filename)
+    if m:
+        return "assets", m.group(1), None
+    m = _NOVEL_FILE.match(filename)
+    if m:
+        return "novel", m.group(1), None
+    return None
+
+def encode_cursor(value) -> str:
+    return base64.urlsafe_b64encode(json.dumps(value).encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str):
+    """The value in a cursor made by encode_cursor(); ValueError if it is malformed."""
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def chapter_meta(data: Dict, chapter_num: int) -> Dict:
+    meta = {k: v for k, v in data.items() if k not in LARGE_FIELDS["chapter"]}
+    meta.update(
+        id=chapter_num,
+        chapter_num=chapter_num,
+        title=data.get("title") or f"Chapter {chapter_num}",
+        word_count=html_text.chapter_word_count(data),
+        image_count=len(data.get("images") or []),
+    )
+    return meta
+
+def project(item: Dict, fields: Optional[List[str]]) -> Dict:
+    return item if fields is None else {k: item[k] for k in fields if k in item}
+
+def needs_file(kind: str, fields: Optional[List[str]]) -> bool:
+    """Whether `fields` (None: all) include fields only the file has."""
+    return fields is None or bool(LARGE_FIELDS[kind] & set(fields))
+
+class MetadataIndex:
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or os.path.join(settings.STATE_PATH, "metadata_index.db")
+        self._local = threading.local()
+        self._synced = {}  # storage root -> time of the last full pass
+        self._sync_lock = threading.Lock()
+        self._conn().executescript(
+            """CREATE TABLE IF NOT EXISTS files (
+                   root TEXT NOT NULL, name TEXT NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,
+                   PRIMARY KEY (root, name));
+               CREATE TABLE IF NOT EXISTS novels (
+                   root TEXT NOT NULL, novel_id TEXT NOT NULL, meta TEXT NOT NULL,
+                   PRIMARY KEY (root, novel_id));
+               CREATE TABLE IF NOT EXISTS chapters (
+                   root TEXT NOT NULL, novel_id TEXT NOT NULL, chapter_num INTEGER NOT NULL, meta TEXT NOT NULL,
+                   PRIMARY KEY (root, novel_id, chapter_num));
+               CREATE TABLE IF NOT EXISTS assets (
+                   root TEXT NOT NULL, novel_id TEXT NOT NULL, position INTEGER NOT NULL, type TEXT, meta TEXT NOT NULL,
+                   PRIMARY KEY (root, novel_id, position));"""
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _root() -> str:
+        # Read on every call, as tests and tools point STORAGE_PATH elsewhere
+        return os.path.realpath(settings.STORAGE_PATH)
+
+    # --- Keeping the index current ---
+
+    def update(self, filename: str, data=None):
+        """(Re)index one storage file; `data` is its content if the caller has it at hand."""
+        self.update_many({filename: data})
+
+    def update_many(self, files: Dict[str, Optional[object]]):
+        """
+        (Re)index several storage files in one transaction ({filename: content
+        or None to read it}); files that no longer exist are dropped.
+        """
+        root = self._root()
+        entries = []
+        for filename, data in files.items():
+            kind = classify(filename)
+            if not kind:
+                continue
+            path = os.path.join(root, filename)
+            try:
+                stat = os.stat(path)
+                if data is None:
+                    with open(path, "r", encoding="utf-8") as f:
+                        data = json.load(f)
+            except (OSError, ValueError):
+                stat = data = None
+            entries.append((filename, kind, stat, data))
+        if not entries:
+            return
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for filename, kind, stat, data in entries:
+                self._delete_rows(conn, root, kind)
+                if stat is None:
+                    conn.execute("DELETE FROM files WHERE root = ? AND name = ?", (root, filename))
+                    continue
+                self._insert_rows(conn, root, kind, data)
+                conn.execute("INSERT OR REPLACE INTO files (root, name, size, mtime_ns) VALUES (?, ?, ?, ?)",
+                             (root, filename, stat.st_size, stat.st_mtime_ns))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def remove(self, filename: str):
+        kind = classify(filename)
+        if not kind:
+            return
+        root = self._root()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        self._delete_rows(conn, root, kind)
+        conn.execute("DELETE FROM files WHERE root = ? AND name = ?", (root, filename))
+        conn.execute("COMMIT")
+
+    def _delete_rows(self, conn, root: str, kind: Tuple):
+        what, novel_id, chapter_num = kind
+        if what == "novel":
+            conn.execute("DELETE FROM novels WHERE root = ? AND novel_id = ?", (root, novel_id))
+        elif what == "chapter":
+            conn.execute("DELETE FROM chapters WHERE root = ? AND novel_id = ? AND chapter_num = ?",
+                         (root, novel_id, chapter_num))
+        else:
+            conn.execute("DELETE FROM assets WHERE root = ? AND novel_id = ?", (root, novel_id))
+
+    def _insert_rows(self, conn, root: str, kind: Tuple, data):
+        what, novel_id, chapter_num = kind
+        dumps = lambda meta: json.dumps(meta, ensure_ascii=False, default=str)
+        if what == "novel":
+            # Same test as the old list_novels(): a dict with a title
+            if isinstance(data, dict) and "title" in data:
+                meta = {k: v for k, v in data.items() if k not in LARGE_FIELDS["novel"]}
+                conn.execute("INSERT INTO novels (root, novel_id, meta) VALUES (?, ?, ?)", (root, novel_id, dumps(meta)))
+        elif what == "chapter":
+            if isinstance(data, dict):
+                conn.execute("INSERT INTO chapters (root, novel_id, chapter_num, meta) VALUES (?, ?, ?, ?)",
+                             (root, novel_id, chapter_num, dumps(chapter_meta(data, chapter_num))))
+        else:
+            for position, asset in enumerate(data if isinstance(data, list) else []):
+                if isinstance(asset, dict):
+                    meta = {k: v for k, v in asset.items() if k not in LARGE_FIELDS["asset"]}
+                    conn.execute("INSERT INTO assets (root, novel_id, position, type, meta) VALUES (?, ?, ?, ?, ?)",
+                                 (root, novel_id, position, asset.get("type"), dumps(meta)))
+
+    def sync(self, force: bool = False) -> int:
+        """
+        Reindex files added, changed or removed without going through
+        storage, at most every METADATA_INDEX_RESYNC_SECONDS unless `force`.
+        Returns the number of files (re)indexed or dropped.
+        """
+        root = self._root()
+        with self._sync_lock:
+            if not force and time.monotonic() - self._synced.get(root, float("-inf")) < settings.METADATA_INDEX_RESYNC_SECONDS:
+                return 0
+            self._synced[root] = time.monotonic()
+        known = {name: (size, mtime) for name, size, mtime in
+                 self._conn().execute("SELECT name, size, mtime_ns FROM files WHERE root = ?", (root,))}
+        changed = 0
+        seen = set()
+        try:
+            entries = list(os.scandir(root))
+        except OSError:
+            entries = []
+        for entry in entries:
+            if not entry.name.endswith(".json") or not classify(entry.name):
+                continue
+            seen.add(entry.name)
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if known.get(entry.name) != (stat.st_size, stat.st_mtime_ns):
+                self.update(entry.name)
+                changed += 1
+        for name in known.keys() - seen:
+            self.remove(name)
+            changed += 1
+        return changed
+
+    # --- Queries ---
+
+    def _page(self, sql: str, params: Tuple, cursor: Optional[str], limit: Optional[int],
+              key: str) -> Tuple[List[Tuple], Optional[str]]:
+        # Keyset pagination on `key`; fetch one row more to know whether there is a next page
+        if cursor:
+            sql += f" AND {key} > ?"
+            params += (decode_cursor(cursor),)
+        sql += f" ORDER BY {key}"
+        if limit:
+            sql += " LIMIT ?"
+            params += (limit + 1,)
+        rows = self._conn().execute(sql, params).fetchall()
+        if limit and len(rows) > limit:
+            rows = rows[:limit]
+            return rows, encode_cursor(rows[-1][0])
+        return rows, None
+
+    def novels(self, cursor: str = None, limit: int = None) -> Tuple[List[Tuple[str, Dict]], Optional[str]]:
+        """([(novel_id, metadata)], next cursor) in novel id order."""
+        self.sync()
+        rows, next_cursor = self._page("SELECT novel_id, meta FROM novels WHERE root = ?", (self._root(),),
+                                       cursor, limit, "novel_id")
+        return [(novel_id, json.loads(meta)) for novel_id, meta in rows], next_cursor
+
+    def chapters(self, novel_id: str, cursor: str = None, limit: int = None) -> Tuple[List[Tuple[int, Dict]], Optional[str]]:
+        """([(chapter_num, metadata)], next cursor) in chapter order."""
+        self.sync()
+        rows, next_cursor = self._page("SELECT chapter_num, meta FROM chapters WHERE root = ? AND novel_id = ?",
+                                       (self._root(), str(novel_id)), cursor, limit, "chapter_num")
+        return [(num, json.loads(meta)) for num, meta in rows], next_cursor
+
+    def chapter_range(self, novel_id: str, start: int = None, end: int = None,
+                      nums: Iterable[int] = None) -> List[Tuple[int, Dict]]:
+        """[(chapter_num, metadata)] of the existing chapters in start..end (inclusive) and/or in `nums`, in order."""
+        self.sync()
+        sql = "SELECT chapter_num, meta FROM chapters WHERE root = ? AND novel_id = ?"
+        params = (self._root(), str(novel_id))
+        if start is not None:
+            sql += " AND chapter_num >= ?"
+            params += (start,)
+        if end is not None:
+            sql += " AND chapter_num <= ?"
+            params += (end,)
+        if nums is not None:
+            nums = sorted(set(nums))
+            sql += f" AND chapter_num IN ({', '.join('?' * len(nums))})"
+            params += tuple(nums)
+        rows = self._conn().execute(sql + " ORDER BY chapter_num", params).fetchall()
+        return [(num, json.loads(meta)) for num, meta in rows]
+
+    def assets(self, novel_id: str, cursor: str = None, limit: int = None,
+               types: Iterable[str] = None) -> Tuple[List[Tuple[int, Dict]], Optional[str]]:
+        """([(position in the assets file, metadata)], next cursor) in file order, optionally of some types only."""
+        self.sync()
+        sql = "SELECT position, meta FROM assets WHERE root = ? AND novel_id = ?"
+        params = (self._root(), str(novel_id))
+        types = list(types or [])
+        if types:
+            sql += f" AND type IN ({', '.join('?' * len(types))})"
+            params += tuple(types)
+        rows, next_cursor = self._page(sql, params, cursor, limit, "position")
+        return [(position, json.loads(meta)) for position, meta in rows], next_cursor
+
+    def clear(self):
+        conn = self._conn()
+        for table in ("files", "novels", "chapters", "assets"):
+            conn.execute(f"DELETE FROM {table}")
+        self._synced.clear()
+
+metadata_index = MetadataIndex()
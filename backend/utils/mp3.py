@@ -0,0 +1,165 @@
+"""
+Minimal MPEG audio (MP3) frame handling: enough to measure durations and to
+join TTS segments losslessly by concatenating their frames, without
+re-encoding or external tools. id3_chapters() writes the chapter tag of
+audiobooks.
+"""
+from typing import Dict, Iterator, List, Tuple
+
+# Bitrates (kbps) for Layer III, indexed by the 4-bit header field
+_BITRATES = {
+    "mpeg1": [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 0],
+    "mpeg2": [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, 0],
+}
+_SAMPLE_RATES = {
+    3: [44100, 48000, 32000],  # MPEG-1
+    2: [22050, 24000, 16000],  # MPEG-2
+    0: [11025, 12000, 8000],   # MPEG-2.5
+}
+
+def strip_id3(data: bytes) -> bytes:
+    """Drop a leading ID3v2 tag and a trailing ID3v1 tag, leaving only audio frames."""
+    if data[:3] == b"ID3" and len(data) >= 10:
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        footer = 10 if data[5] & 0x10 else 0
+        data = data[10 + size + footer:]
+    if len(data) >= 128 and data[-128:-125] == b"TAG":
+        data = data[:-128]
+    return data
+
+def parse_header(header: bytes) -> Tuple[int, int, int]:
+    """(frame length in bytes, sample rate, samples per frame) of a Layer III frame header."""
+    b1, b2, b3 = header[1], header[2], header[3]
+    if header[0] != 0xFF or (b1 & 0xE0) != 0xE0:
+        raise ValueError("Not an MPEG frame header")
+    version = (b1 >> 3) & 0x03
+    layer = (b1 >> 1) & 0x03
+    if version == 1 or layer != 1:
+        raise ValueError("Only MPEG Layer III frames are supported")
+    bitrate = _BITRATES["mpeg1" if version == 3 else "mpeg2"][(b2 >> 4) & 0x0F] * 1000
+    rate_index = (b2 >> 2) & 0x03
+    if not bitrate or rate_index == 3:
+        raise ValueError("Invalid bitrate or sample rate")
+    sample_rate = _SAMPLE_RATES[version][rate_index]
+    padding = (b2 >> 1) & 0x01
+    samples = 1152 if version == 3 else 576
+    length = samples // 8 * bitrate // sample_rate + padding
+    return length, sample_rate, samples
+
+def iter_frames(data: bytes) -> Iterator[Tuple[int, int, int, int]]:
+    """Yield (offset, length, sample_rate, samples) for each frame, resyncing over junk bytes."""
+    pos = 0
+    end = len(data)
+    while pos + 4 <= end:
+        if data[pos] != 0xFF:
+            pos += 1
+            continue
+        try:
+            length, sample_rate, samples = parse_header(data[pos:pos + 4])
+        except ValueError:
+            pos += 1
+            continue
+        if pos + length > end:
+            break
+        yield pos, length, sample_rate, samples
+        pos += length
+
+def duration_ms(data: bytes) -> int:
+    seconds = 0.0
+    for _, _, sample_rate, samples in iter_frames(data):
+        seconds += samples / sample_rate
+    return int(round(seconds * 1000))
+
+def audio_frames(data: bytes) -> bytes:
+    """Only the complete audio frames of `data` (tags and trailing partial frames removed)."""
+    data = strip_id3(data)
+    return b"".join(data[offset:offset + length] for offset, length, _, _ in iter_frames(data))
+
+class FrameFilter:
+    """
+    audio_frames() for data arriving in chunks: feed() returns the complete
+    frames received so far, so streamed audio matches what the whole data
+    would give (and what is cached).
+    """
+
+    def __init__(self):
+        self.buffer = b""
+        self.started = False
+
+    def feed(self, chunk: bytes) -> bytes:
+        self.buffer += chunk
+        if not self.started:
+            # Wait for the ID3 header (and the whole tag, if there is one) before looking for frames
+            if len(self.buffer) < 10:
+                return b""
+            if self.buffer[:3] == b"ID3":
+                data = self.buffer
+                size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+                skip = 10 + size + (10 if data[5] & 0x10 else 0)
+                if len(data) < skip:
+                    return b""
+                self.buffer = data[skip:]
+            self.started = True
+        frames = []
+        consumed = 0
+        for offset, length, _, _ in iter_frames(self.buffer):
+            frames.append(self.buffer[offset:offset + length])
+            consumed = offset + length
+        self.buffer = self.buffer[consumed:]
+        return b"".join(frames)
+
+def _syncsafe(n: int) -> bytes:
+    return bytes([(n >> 21) & 0x7F, (n >> 14) & 0x7F, (n >> 7) & 0x7F, n & 0x7F])
+
+def _frame(frame_id: str, body: bytes) -> bytes:
+    # ID3v2.3 frame: plain 32-bit size, no flags
+    return frame_id.encode("latin-1") + len(body).to_bytes(4, "big") + b"\x00\x00" + body
+
+def _text_frame(frame_id: str, text: str) -> bytes:
+    # Encoding 1 = UTF-16 with BOM, which every ID3v2.3 reader handles
+    return _frame(frame_id, b"\x01" + text.encode("utf-16") + b"\x00\x00")
+
+def id3_chapters(title: str, chapters: List[Dict], artist: str = None) -> bytes:
+    """
+    ID3v2.3 tag with a table of contents (CTOC) and one CHAP frame per
+    chapter, for players that show chapters in MP3 audiobooks. Each chapter
+    dict has "title", "start_ms" and "end_ms".
+    """
+    frames = [_text_frame("TIT2", title), _text_frame("TALB", title)]
+    if artist:
+        frames.append(_text_frame("TPE1", artist))
+    ids = [f"chp{i}" for i in range(len(chapters))]
+    for element_id, chapter in zip(ids, chapters):
+        frames.append(_frame("CHAP", element_id.encode("latin-1") + b"\x00"
+                             + chapter["start_ms"].to_bytes(4, "big") + chapter["end_ms"].to_bytes(4, "big")
+                             + b"\xff\xff\xff\xff" * 2  # byte offsets unused
+                             + _text_frame("TIT2", chapter["title"])))
+    # A CTOC lists at most 255 entries; longer books get one sub-table per 255 chapters
+    groups = [ids[i:i + 255] for i in range(0, len(ids), 255)]
+    if len(groups) > 1:
+        children = []
+        for n, group in enumerate(groups):
+            child = f"toc{n}"
+            children.append(child)
+            frames.append(_ctoc(child, group, top_level=False))
+        frames.append(_ctoc("toc", children, top_level=True, title=title))
+    else:
+        frames.append(_ctoc("toc", ids, top_level=True, title=title))
+    body = b"".join(frames)
+    return b"ID3\x03\x00\x00" + _syncsafe(len(body)) + body
+
+def _ctoc(element_id: str, children: List[str], top_level: bool, title: str = None) -> bytes:
+    flags = 0x03 if top_level else 0x01  # ordered (+ top-level)
+    body = element_id.encode("latin-1") + b"\x00" + bytes([flags, len(children)])
+    body += b"".join(child.encode("latin-1") + b"\x00" for child in children)
+    if title:
+        body += _text_frame("TIT2", title)
+    return _frame("CTOC", body)
+
+# MPEG-2 Layer III, 48 kbps, 24 kHz, mono (the format edge-tts returns):
+# 144-byte frames of 24 ms. An all-zero body decodes as silence.
+SILENT_FRAME = b"\xff\xf3\x64\xc0" + b"\x00" * 140
+SILENT_FRAME_MS = 24
+
+def silent_frames(duration_ms: int) -> bytes:
+    return SILENT_FRAME * max(1, round(duration_ms / SILENT_FRAME_MS))
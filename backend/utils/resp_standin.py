@@ -0,0 +1,138 @@
+"""
+In-memory stand-in for a Redis server, speaking just enough of the protocol
+for the coordination layer (PING, GET, SET with NX/XX/EX/PX, DEL, EXISTS,
+FLUSHALL and EVAL of the lock release and renewal scripts). Use it for tests and local
+multi-process runs without a real Redis:
+
+    python -m backend.utils.resp_standin --port 6390
+    MONSTER_COORDINATION_BACKEND=redis MONSTER_REDIS_URL=redis://localhost:6390/0 uvicorn ...
+"""
+import time
+import argparse
+import threading
+import socketserver
+
+from .coordination import RELEASE_LOCK_SCRIPT, RENEW_LOCK_SCRIPT
+
+class _Store:
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.lock = threading.Lock()
+
+    def _alive(self, key):
+        exp = self.expires.get(key)
+        if exp is not None and exp <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.data
+
+    def get(self, key):
+        return self.data[key] if self._alive(key) else None
+
+    def delete(self, key):
+        existed = self._alive(key)
+        self.data.pop(key, None)
+        self.expires.pop(key, None)
+        return int(existed)
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                args = self._read_command()
+            except (ConnectionError, ValueError):
+                return
+            if args is None:
+                return
+            with self.server.store.lock:
+                reply = self._dispatch(args)
+            self.wfile.write(reply)
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            raise ValueError("Only RESP arrays are supported")
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2].decode("utf-8"))
+        return args
+
+    @staticmethod
+    def _bulk(value):
+        if value is None:
+            return b"$-1\r\n"
+        data = value.encode("utf-8")
+        return f"${len(data)}\r\n".encode() + data + b"\r\n"
+
+    def _dispatch(self, args):
+        store = self.server.store
+        cmd = args[0].upper()
+        if cmd == "PING":
+            return b"+PONG\r\n"
+        if cmd in ("AUTH", "SELECT"):
+            return b"+OK\r\n"
+        if cmd == "GET":
+            return self._bulk(store.get(args[1]))
+        if cmd == "SET":
+            key, value, opts = args[1], args[2], [a.upper() for a in args[3:]]
+            exists = store._alive(key)
+            if ("NX" in opts and exists) or ("XX" in opts and not exists):
+                return b"$-1\r\n"
+            store.data[key] = value
+            store.expires.pop(key, None)
+            for unit, scale in (("EX", 1.0), ("PX", 0.001)):
+                if unit in opts:
+                    store.expires[key] = time.time() + float(args[3 + opts.index(unit) + 1]) * scale
+            return b"+OK\r\n"
+        if cmd == "DEL":
+            return f":{sum(store.delete(k) for k in args[1:])}\r\n".encode()
+        if cmd == "EXISTS":
+            return f":{sum(int(store._alive(k)) for k in args[1:])}\r\n".encode()
+        if cmd == "FLUSHALL":
+            store.data.clear()
+            store.expires.clear()
+            return b"+OK\r\n"
+        if cmd == "EVAL" and args[1] == RELEASE_LOCK_SCRIPT:
+            key, token = args[3], args[4]
+            return b":1\r\n" if store.get(key) == token and store.delete(key) else b":0\r\n"
+        if cmd == "EVAL" and args[1] == RENEW_LOCK_SCRIPT:
+            key, token, ttl_ms = args[3], args[4], float(args[5])
+            if store.get(key) != token:
+                return b":0\r\n"
+            store.expires[key] = time.time() + ttl_ms / 1000
+            return b":1\r\n"
+        return f"-ERR unsupported command '{args[0]}'\r\n".encode()
+
+class RespStandin(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), _Handler)
+        self.store = _Store()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address
+        return f"redis://{host}:{port}/0"
+
+    def start(self):
+        """Serve in a background thread (port 0 picks a free port, see `url`)."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+def main():
+    parser = argparse.ArgumentParser(description="In-memory Redis protocol stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+    server = RespStandin(args.host, args.port)
+    print(f"RESP stand-in listening on {server.url}")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
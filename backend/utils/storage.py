@@ -1,16 +1,130 @@
 import os
 import json
 import glob
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
 from fastapi import HTTPException
 from ..config import settings
+from .coordination import coordination, LockLost, LockTimeout
+from .metadata_index import metadata_index
+from .file_cache import link_or_copy
 
 def save_json(filename: str, data: dict):
     path = os.path.join(settings.STORAGE_PATH, filename)
+    # Write to a temp file and rename, so concurrent readers never see a partial file
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
     try:
-        with open(path, 'w', encoding='utf-8') as f:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
     except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
         raise HTTPException(status_code=500, detail=f"Failed to save file: {str(e)}")
+    _reindex(filename, data)
+
+def save_json_many(files: dict):
+    """
+    Write several files ({filename: data, or None to delete it}) as one
+    change: every new file is written to a temp file first, and the files
+    being replaced or deleted are kept as backups until all renames and
+    deletions succeeded. If one fails, the backups are put back and new
+    files removed, so an error leaves the previous files in place (a crash
+    of the process midway can still leave a partial change).
+    Callers changing files of one novel should hold its novel_lock().
+    """
+    paths = {filename: os.path.join(settings.STORAGE_PATH, filename) for filename in files}
+    temps = {}    # path -> temp file with its new content
+    backups = {}  # path -> backup of the file it had before (None: it did not exist)
+    try:
+        for filename, data in files.items():
+            if data is None:
+                continue
+            path = paths[filename]
+            temps[path] = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(temps[path], 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+        for path in paths.values():
+            backups[path] = None
+            if os.path.exists(path):
+                backup = f"{path}.{uuid.uuid4().hex}.bak"
+                link_or_copy(path, backup)
+                backups[path] = backup
+        for filename, data in files.items():
+            path = paths[filename]
+            if data is None:
+                if os.path.exists(path):
+                    os.remove(path)
+            else:
+                os.replace(temps[path], path)
+                del temps[path]
+    except Exception as e:
+        for path, backup in backups.items():
+            try:
+                if backup and os.path.exists(path) and os.path.samefile(backup, path):
+                    # Not replaced yet (renaming a hard link onto its twin would be a no-op)
+                    os.remove(backup)
+                elif backup:
+                    os.replace(backup, path)
+                elif os.path.exists(path):
+                    os.remove(path)
+            except OSError as restore_error:
+                print(f"Failed to restore {path}: {restore_error}")
+        for tmp_path in temps.values():
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise HTTPException(status_code=500, detail=f"Failed to save files: {str(e)}")
+    for backup in backups.values():
+        if backup:
+            os.remove(backup)
+    try:
+        metadata_index.update_many(files)
+    except Exception as e:
+        print(f"Metadata index update failed for {len(files)} files: {e}")
+
+def _reindex(filename: str, data=None):
+    # The list endpoints page through the metadata index; its periodic resync covers a failure here
+    try:
+        if data is None:
+            metadata_index.remove(filename)
+        else:
+            metadata_index.update(filename, data)
+    except Exception as e:
+        print(f"Metadata index update failed for {filename}: {e}")
+
+# Locks held by the current thread or task. A context variable rather than a
+# thread-local, so coroutines sharing the event loop thread never see each
+# other's locks as their own.
+_held_locks: ContextVar[frozenset] = ContextVar("held_novel_locks", default=frozenset())
+
+@contextmanager
+def novel_lock(novel_id):
+    """
+    Exclusive lock for read-modify-write of a novel's files (novel, chapters,
+    assets), shared by every API/worker process through the coordination
+    backend. Re-entrant within a thread or task. Keep the critical section
+    short: load, modify and save inside it, never call the LLM while holding
+    it. Waiting for it blocks, so endpoints taking it are plain `def` (run in
+    the threadpool), never `async def`.
+    """
+    name = f"novel:{novel_id}"
+    held = _held_locks.get()
+    if name in held:
+        yield
+        return
+    try:
+        with coordination.lock(name, timeout=settings.NOVEL_LOCK_TIMEOUT_SECONDS):
+            token = _held_locks.set(held | {name})
+            try:
+                yield
+            finally:
+                _held_locks.reset(token)
+    except LockTimeout:
+        raise HTTPException(status_code=503, detail=f"Novel {novel_id} is busy, please retry")
+    except LockLost:
+        # The lock expired mid-update, so another writer may have interleaved with this one
+        raise HTTPException(status_code=409, detail=f"Novel {novel_id} was changed concurrently, please reload and retry")
 
 def load_json(filename: str) -> dict:
     path = os.path.join(settings.STORAGE_PATH, filename)
@@ -58,6 +172,7 @@ def delete_file(filename: str):
     if os.path.exists(path):
         try:
             os.remove(path)
+            _reindex(filename)
             return True
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Failed to delete file: {str(e)}")
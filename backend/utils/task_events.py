@@ -0,0 +1,75 @@
+"""
+Server-Sent Events stream of task progress.
+
+Every task change is recorded in the task_events table (see TaskManager._publish).
+Streams replay events after the client's Last-Event-ID, so a reconnecting
+EventSource resumes without gaps, and are woken immediately by changes made
+in this process. Changes made by separate worker processes are picked up
+within settings.TASK_EVENT_POLL_SECONDS.
+"""
+import json
+import asyncio
+import threading
+from typing import AsyncIterator
+
+from ..config import settings
+from .task_manager import task_manager
+
+_subscribers = set()
+_subscribers_lock = threading.Lock()
+
+def _notify_subscribers():
+    # Called from whichever thread updated the task
+    with _subscribers_lock:
+        subscribers = list(_subscribers)
+    for loop, wake in subscribers:
+        loop.call_soon_threadsafe(wake.set)
+
+task_manager.add_listener(_notify_subscribers)
+
+def _format_event(event_id: int, event: str, data) -> str:
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def stream_task_events(last_event_id: int = None, task_id: str = None) -> AsyncIterator[str]:
+    """
+    Yield SSE messages. Without `last_event_id` the stream starts with a
+    `snapshot` event holding the current active tasks (or the single task
+    when `task_id` is given), followed by `task` events for every change.
+    """
+    subscriber = (asyncio.get_running_loop(), asyncio.Event())
+    with _subscribers_lock:
+        _subscribers.add(subscriber)
+    try:
+        if last_event_id is not None and last_event_id < task_manager.get_first_event_id() - 1:
+            # Events since the client's position were pruned; start over from a snapshot
+            last_event_id = None
+        if last_event_id is None:
+            last_event_id = task_manager.get_last_event_id()
+            if task_id:
+                task = task_manager.get_task(task_id)
+                tasks = [task] if task else []
+            else:
+                tasks = task_manager.get_active_tasks()
+            yield _format_event(last_event_id, "snapshot", tasks)
+
+        idle = 0.0
+        wake = subscriber[1]
+        while True:
+            wake.clear()
+            events = task_manager.get_events(last_event_id, task_id)
+            for event in events:
+                last_event_id = event["id"]
+                yield _format_event(event["id"], "task", event["task"])
+            if events:
+                idle = 0.0
+                continue
+            try:
+                await asyncio.wait_for(wake.wait(), timeout=settings.TASK_EVENT_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                idle += settings.TASK_EVENT_POLL_SECONDS
+                if idle >= settings.TASK_EVENT_KEEPALIVE_SECONDS:
+                    idle = 0.0
+                    yield ": keep-alive\n\n"
+    finally:
+        with _subscribers_lock:
+            _subscribers.discard(subscriber)
@@ -1,60 +1,692 @@
+import os
+import json
 import uuid
-from datetime import datetime
-from typing import Dict, Any, List
+import time
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Callable
+
+from ..config import settings
+from .coordination import coordination, CoordinationBackend
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    description TEXT,
+    status TEXT NOT NULL,
+    progress INTEGER NOT NULL DEFAULT 0,
+    step TEXT,
+    stages TEXT,
+    current_stage_index INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    -- Queue fields: only set for tasks that are executed by a worker
+    payload TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 1,
+    available_at REAL,
+    lease_owner TEXT,
+    lease_expires REAL
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_queue ON tasks (status, available_at);
+CREATE TABLE IF NOT EXISTS task_limits (
+    task_group TEXT PRIMARY KEY,
+    max_running INTEGER NOT NULL
+);
+-- Append-only log of task snapshots, streamed to clients by /api/tasks/events
+CREATE TABLE IF NOT EXISTS task_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    task_id TEXT NOT NULL,
+    created_ts REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_task_events_task ON task_events (task_id, id);
+-- Finished tasks moved out of `tasks` by the retention policy; only read by id
+CREATE TABLE IF NOT EXISTS tasks_archive (
+    id TEXT PRIMARY KEY,
+    novel_id TEXT,
+    archived_ts REAL NOT NULL,
+    data TEXT NOT NULL
+);
+"""
+
+# Columns added after the initial schema: name -> column definition
+_MIGRATIONS = {
+    "task_group": "TEXT",
+    "novel_id": "TEXT",
+    "updated_ts": "REAL",
+    "idempotency_key": "TEXT",
+    "cancel_requested": "INTEGER NOT NULL DEFAULT 0",
+}
+
+def _timestamps():
+    # (ISO string for API consumers, epoch seconds for indexed range queries)
+    return datetime.now().isoformat(), time.time()
+
+# Concurrency group of each task type. Limits are enforced per group across
+# every worker sharing the database; unknown types form a group of their own.
+TASK_GROUPS = {
+    "outline_generation": "outline",
+    "chapter_generation": "chapter",
+    "illustration_generation": "illustration",
+    "audio_generation": "audio",
+    "audiobook_generation": "audiobook",
+    "novel_export": "export",
+    "asset_extraction": "extraction",
+}
+
+def task_group(task_type: str) -> str:
+    return TASK_GROUPS.get(task_type, task_type)
+
+class TaskCancelled(Exception):
+    """Raised inside a task handler when cancellation of its task was requested."""
 
 class TaskManager:
-    _instance = None
-    
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super(TaskManager, cls).__new__(cls)
-            cls._instance.tasks = {}
-        return cls._instance
-
-    def create_task(self, type: str, description: str = "", stages: List[str] = None) -> str:
-        task_id = str(uuid.uuid4())
-        self.tasks[task_id] = {
-            "id": task_id,
-            "type": type,
-            "description": description,
-            "status": "pending",
-            "progress": 0,
-            "step": "Initializing...",
-            "stages": stages or [],
-            "current_stage_index": 0,
-            "result": None,
-            "created_at": datetime.now().isoformat(),
-            "updated_at": datetime.now().isoformat()
+    """
+    Persistent task store and work queue backed by SQLite.
+
+    Every task is tracked here (status, progress, result). Tasks created with a
+    payload are also queued: a worker (see utils/task_worker.py) claims them
+    with a time-limited lease, so several worker processes can share one
+    database and a crashed worker's tasks are picked up again once the lease
+    expires.
+
+    Tasks without a payload run inside the process that created them (image
+    renders). They carry a lease as well, owned by that process and renewed
+    by a heartbeat thread while it lives; prune() fails the ones whose
+    process is gone, so they do not stay "active" forever after a restart.
+
+    With a shared coordination backend (Redis), every task snapshot is also
+    mirrored there so web processes on other hosts can answer get_task().
+    Task lists, the event log (SSE) and the queue stay in this host's
+    database: other hosts can look a task up by id, but not list, follow or
+    run it.
+    """
+
+    def __init__(self, db_path: str = None, backend: CoordinationBackend = None):
+        self.db_path = db_path or settings.TASK_DB_PATH
+        backend = backend or coordination
+        self.shared_state = backend if backend.shared else None
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        self._local = threading.local()
+        self._listeners: List[Callable[[], None]] = []
+        self._boot_id = uuid.uuid4().hex[:8]
+        self._heartbeat_pid = None
+        self._heartbeat_lock = threading.Lock()
+        self._init_db()
+
+    def _init_db(self):
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        existing = {r["name"] for r in conn.execute("PRAGMA table_info(tasks)")}
+        for column, definition in _MIGRATIONS.items():
+            if column not in existing:
+                conn.execute(f"ALTER TABLE tasks ADD COLUMN {column} {definition}")
+        for row in conn.execute("SELECT id, updated_at FROM tasks WHERE updated_ts IS NULL").fetchall():
+            conn.execute("UPDATE tasks SET updated_ts = ? WHERE id = ?",
+                         (datetime.fromisoformat(row["updated_at"]).timestamp(), row["id"]))
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_group ON tasks (task_group, status)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status, updated_ts)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_novel ON tasks (novel_id, status)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_idempotency ON tasks (idempotency_key, status)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_archive_ts ON tasks_archive (archived_ts)")
+
+    # --- Connection handling ---
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared between threads, keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _row_to_task(row: sqlite3.Row, queue_position: int = None) -> Dict:
+        return {
+            "id": row["id"],
+            "type": row["type"],
+            "description": row["description"],
+            "status": row["status"],
+            "progress": row["progress"],
+            "step": row["step"],
+            "stages": json.loads(row["stages"]) if row["stages"] else [],
+            "current_stage_index": row["current_stage_index"],
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"],
+            "attempts": row["attempts"],
+            "cancel_requested": bool(row["cancel_requested"]),
+            "task_group": row["task_group"],
+            "novel_id": row["novel_id"],
+            "queue_position": queue_position,
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"]
         }
+
+    # --- Change events ---
+
+    def add_listener(self, callback: Callable[[], None]):
+        """Register a callback invoked (from any thread) after a task event is recorded."""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback: Callable[[], None]):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def _publish(self, task_id: str):
+        task = self.get_task(task_id)
+        if not task:
+            return
+        self._conn().execute(
+            "INSERT INTO task_events (task_id, created_ts, data) VALUES (?, ?, ?)",
+            (task_id, time.time(), json.dumps(task, ensure_ascii=False))
+        )
+        if self.shared_state:
+            try:
+                self.shared_state.set(f"task:{task_id}", json.dumps(task, ensure_ascii=False),
+                                      ttl=settings.TASK_RETENTION_SECONDS)
+            except Exception as e:
+                print(f"Failed to mirror task {task_id}: {e}")
+        for callback in list(self._listeners):
+            try:
+                callback()
+            except Exception as e:
+                print(f"Task event listener failed: {e}")
+
+    def get_events(self, after_id: int = 0, task_id: str = None, limit: int = 500) -> List[Dict]:
+        """Events with id greater than `after_id`, oldest first. Each event carries a task snapshot."""
+        query = "SELECT id, data FROM task_events WHERE id > ?"
+        params = [after_id]
+        if task_id:
+            query += " AND task_id = ?"
+            params.append(task_id)
+        query += " ORDER BY id LIMIT ?"
+        params.append(limit)
+        return [{"id": r["id"], "task": json.loads(r["data"])} for r in self._conn().execute(query, params)]
+
+    def get_last_event_id(self) -> int:
+        return self._conn().execute("SELECT COALESCE(MAX(id), 0) FROM task_events").fetchone()[0]
+
+    def get_first_event_id(self) -> int:
+        return self._conn().execute("SELECT COALESCE(MIN(id), 0) FROM task_events").fetchone()[0]
+
+    # --- Task tracking ---
+
+    def create_task(self, type: str, description: str = "", stages: List[str] = None,
+                    payload: Dict[str, Any] = None, max_attempts: int = None, novel_id: str = None,
+                    idempotency_key: str = None) -> str:
+        """
+        Create a tracked task. If `payload` is given the task is also queued and
+        will be executed by the worker handler registered under `type`.
+        `novel_id` defaults to payload["novel_id"] and indexes the task by novel.
+        If an unfinished task with the same `idempotency_key` exists, its id is
+        returned instead of creating a duplicate.
+        """
+        task_id = str(uuid.uuid4())
+        now, now_ts = _timestamps()
+        queued = payload is not None
+        if novel_id is None and queued and payload.get("novel_id") is not None:
+            novel_id = payload["novel_id"]
+        with self._transaction() as conn:
+            if idempotency_key:
+                existing = conn.execute(
+                    """SELECT id FROM tasks WHERE idempotency_key = ?
+                       AND status IN ('pending', 'processing') AND cancel_requested = 0""",
+                    (idempotency_key,)
+                ).fetchone()
+                if existing:
+                    return existing["id"]
+            conn.execute(
+                """INSERT INTO tasks (id, type, description, status, progress, step, stages,
+                                      current_stage_index, created_at, updated_at, updated_ts,
+                                      payload, max_attempts, available_at, task_group, novel_id,
+                                      idempotency_key, lease_owner, lease_expires)
+                   VALUES (?, ?, ?, 'pending', 0, ?, ?, 0, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    task_id, type, description,
+                    "Queued..." if queued else "Initializing...",
+                    json.dumps(stages or [], ensure_ascii=False),
+                    now, now, now_ts,
+                    json.dumps(payload, ensure_ascii=False) if queued else None,
+                    (max_attempts or settings.TASK_MAX_ATTEMPTS) if queued else 1,
+                    time.time() if queued else None,
+                    task_group(type),
+                    str(novel_id) if novel_id is not None else None,
+                    idempotency_key,
+                    # In-process tasks are leased to this process (queued ones when claimed)
+                    None if queued else self.owner_id,
+                    None if queued else time.time() + settings.TASK_LEASE_SECONDS
+                )
+            )
+        if not queued:
+            self._start_heartbeat()
+        self._publish(task_id)
         return task_id
 
-    def update_task(self, task_id: str, status: str = None, progress: int = None, step: str = None, current_stage_index: int = None, result: Any = None):
-        if task_id in self.tasks:
-            task = self.tasks[task_id]
-            if status: task["status"] = status
-            if progress is not None: task["progress"] = progress
-            if step: task["step"] = step
-            if current_stage_index is not None: task["current_stage_index"] = current_stage_index
-            if result: task["result"] = result
-            task["updated_at"] = datetime.now().isoformat()
+    # --- In-process task leases ---
+
+    @property
+    def owner_id(self) -> str:
+        # Includes the pid, so processes forked after import get their own id
+        return f"{socket.gethostname()}:{os.getpid()}:{self._boot_id}"
+
+    def _start_heartbeat(self):
+        with self._heartbeat_lock:
+            if self._heartbeat_pid == os.getpid():
+                return
+            self._heartbeat_pid = os.getpid()
+        threading.Thread(target=self._renew_local_leases, name="task-lease-heartbeat", daemon=True).start()
+
+    def _renew_local_leases(self):
+        interval = max(1.0, settings.TASK_LEASE_SECONDS / 3)
+        while True:
+            time.sleep(interval)
+            try:
+                self._conn().execute(
+                    """UPDATE tasks SET lease_expires = ?
+                       WHERE payload IS NULL AND lease_owner = ? AND status IN ('pending', 'processing')""",
+                    (time.time() + settings.TASK_LEASE_SECONDS, self.owner_id)
+                )
+            except Exception as e:
+                print(f"Failed to renew in-process task leases: {e}")
+
+    def fail_orphaned_tasks(self) -> int:
+        """
+        Fail in-process tasks whose process stopped renewing their lease (it
+        exited or was restarted). Tasks from before leases were kept count as
+        orphaned once not updated for TASK_LEASE_SECONDS. Returns how many were failed.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            rows = conn.execute(
+                """SELECT id FROM tasks WHERE payload IS NULL AND status IN ('pending', 'processing')
+                   AND (lease_expires < ? OR (lease_expires IS NULL AND updated_ts < ?))""",
+                (now, now - settings.TASK_LEASE_SECONDS)
+            ).fetchall()
+            for row in rows:
+                conn.execute(
+                    """UPDATE tasks SET status = 'failed', step = ?, error = ?,
+                              lease_owner = NULL, lease_expires = NULL, updated_at = ?, updated_ts = ?
+                       WHERE id = ?""",
+                    ("Error: process lost", "The process running this task exited", *_timestamps(), row["id"])
+                )
+        for row in rows:
+            self._publish(row["id"])
+        return len(rows)
+
+    def update_task(self, task_id: str, status: str = None, progress: int = None, step: str = None, current_stage_index: int = None, result: Any = None, error: str = None):
+        fields = []
+        values = []
+        if status:
+            fields.append("status = ?")
+            values.append(status)
+        if progress is not None:
+            fields.append("progress = ?")
+            values.append(progress)
+        if step:
+            fields.append("step = ?")
+            values.append(step)
+        if current_stage_index is not None:
+            fields.append("current_stage_index = ?")
+            values.append(current_stage_index)
+        if result:
+            fields.append("result = ?")
+            values.append(json.dumps(result, ensure_ascii=False))
+        if error:
+            fields.append("error = ?")
+            values.append(error)
+        fields.append("updated_at = ?")
+        fields.append("updated_ts = ?")
+        values.extend(_timestamps())
+        values.append(task_id)
+        self._conn().execute(f"UPDATE tasks SET {', '.join(fields)} WHERE id = ?", values)
+        self._publish(task_id)
 
     def get_task(self, task_id: str) -> Dict:
-        return self.tasks.get(task_id)
-
-    def get_active_tasks(self) -> List[Dict]:
-        # Return tasks that are not completed or failed, or completed recently (5 mins)
-        active_tasks = []
-        now = datetime.now()
-        for t in self.tasks.values():
-            if t["status"] in ["pending", "processing"]:
-                active_tasks.append(t)
-            elif t["status"] in ["completed", "failed"]:
-                updated_at = datetime.fromisoformat(t["updated_at"])
-                if (now - updated_at).total_seconds() < 10:
-                    active_tasks.append(t)
-        
-        # Sort by updated_at desc
-        active_tasks.sort(key=lambda x: x["updated_at"], reverse=True)
-        return active_tasks
+        conn = self._conn()
+        row = conn.execute("SELECT * FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        if not row:
+            archived = conn.execute("SELECT data FROM tasks_archive WHERE id = ?", (task_id,)).fetchone()
+            if archived:
+                return json.loads(archived["data"])
+            return self._get_shared_task(task_id)
+        position = None
+        if row["status"] == "pending" and row["payload"] is not None:
+            position = conn.execute(
+                """SELECT COUNT(*) FROM tasks
+                   WHERE task_group = ? AND status = 'pending' AND payload IS NOT NULL
+                     AND available_at <= ?""",
+                (row["task_group"], row["available_at"])
+            ).fetchone()[0]
+        return self._row_to_task(row, position)
+
+    def _get_shared_task(self, task_id: str) -> Optional[Dict]:
+        # Task owned by another host's database
+        if not self.shared_state:
+            return None
+        try:
+            data = self.shared_state.get(f"task:{task_id}")
+        except Exception as e:
+            print(f"Failed to read shared task {task_id}: {e}")
+            return None
+        return json.loads(data) if data else None
+
+    def get_active_tasks(self, novel_id: str = None) -> List[Dict]:
+        """
+        Tasks that are pending or processing, plus those finished in the last 10s.
+        Both parts are range scans on the status index, so the cost depends on
+        the number of active tasks, not on how many tasks were ever created.
+        """
+        novel_filter = " AND novel_id = ?" if novel_id is not None else ""
+        novel_params = (str(novel_id),) if novel_id is not None else ()
+        recent = time.time() - 10
+        conn = self._conn()
+        rows = conn.execute(
+            f"SELECT * FROM tasks WHERE status IN ('pending', 'processing'){novel_filter}",
+            novel_params
+        ).fetchall()
+        rows += conn.execute(
+            f"SELECT * FROM tasks WHERE status IN ('completed', 'failed', 'cancelled') AND updated_ts >= ?{novel_filter}",
+            (recent, *novel_params)
+        ).fetchall()
+        rows.sort(key=lambda r: r["updated_ts"], reverse=True)
+        return self._with_positions(rows)
+
+    def get_novel_tasks(self, novel_id: str, limit: int = 50) -> List[Dict]:
+        """Most recent tasks (any status) of a novel, via the novel index."""
+        rows = self._conn().execute(
+            "SELECT * FROM tasks WHERE novel_id = ? ORDER BY updated_ts DESC LIMIT ?",
+            (str(novel_id), limit)
+        ).fetchall()
+        return self._with_positions(rows)
+
+    def _with_positions(self, rows: List[sqlite3.Row]) -> List[Dict]:
+        # Queue position within each concurrency group, in claim order
+        queued = sorted(
+            (r for r in rows if r["status"] == "pending" and r["payload"] is not None),
+            key=lambda r: r["available_at"]
+        )
+        positions = {}
+        group_counts = {}
+        for r in queued:
+            group_counts[r["task_group"]] = group_counts.get(r["task_group"], 0) + 1
+            positions[r["id"]] = group_counts[r["task_group"]]
+        return [self._row_to_task(r, positions.get(r["id"])) for r in rows]
+
+    # --- Retention ---
+
+    def prune(self, ttl_seconds: float = None, max_finished: int = None) -> int:
+        """
+        Move finished tasks older than `ttl_seconds`, or beyond the newest
+        `max_finished`, into tasks_archive, and drop task events older than
+        settings.TASK_EVENT_RETENTION_SECONDS. Archived tasks are deleted
+        after settings.TASK_ARCHIVE_RETENTION_SECONDS, or beyond the newest
+        settings.TASK_ARCHIVE_MAX. Orphaned in-process tasks are failed first
+        (fail_orphaned_tasks). Returns the number of archived tasks.
+        """
+        self.fail_orphaned_tasks()
+        ttl_seconds = settings.TASK_RETENTION_SECONDS if ttl_seconds is None else ttl_seconds
+        max_finished = settings.TASK_RETENTION_MAX if max_finished is None else max_finished
+        cutoff = time.time() - ttl_seconds
+        with self._transaction() as conn:
+            rows = conn.execute(
+                """SELECT * FROM tasks WHERE status IN ('completed', 'failed', 'cancelled') AND updated_ts < ?""",
+                (cutoff,)
+            ).fetchall()
+            rows += conn.execute(
+                """SELECT * FROM tasks WHERE status IN ('completed', 'failed', 'cancelled') AND updated_ts >= ?
+                   ORDER BY updated_ts DESC LIMIT -1 OFFSET ?""",
+                (cutoff, max_finished)
+            ).fetchall()
+            now = time.time()
+            for row in rows:
+                conn.execute(
+                    "INSERT OR REPLACE INTO tasks_archive (id, novel_id, archived_ts, data) VALUES (?, ?, ?, ?)",
+                    (row["id"], row["novel_id"], now, json.dumps(self._row_to_task(row), ensure_ascii=False))
+                )
+                conn.execute("DELETE FROM tasks WHERE id = ?", (row["id"],))
+            conn.execute("DELETE FROM task_events WHERE created_ts < ?", (now - settings.TASK_EVENT_RETENTION_SECONDS,))
+            conn.execute("DELETE FROM tasks_archive WHERE archived_ts < ?", (now - settings.TASK_ARCHIVE_RETENTION_SECONDS,))
+            conn.execute(
+                """DELETE FROM tasks_archive WHERE id IN (
+                       SELECT id FROM tasks_archive ORDER BY archived_ts DESC LIMIT -1 OFFSET ?)""",
+                (settings.TASK_ARCHIVE_MAX,)
+            )
+        return len(rows)
+
+    # --- Concurrency limits ---
+
+    def get_limits(self) -> Dict[str, int]:
+        limits = dict(settings.TASK_CONCURRENCY_LIMITS)
+        for row in self._conn().execute("SELECT task_group, max_running FROM task_limits"):
+            limits[row["task_group"]] = row["max_running"]
+        return limits
+
+    def set_limit(self, group: str, max_running: int):
+        """Change how many tasks of `group` may run at once. Takes effect on the next claim."""
+        self._conn().execute(
+            "INSERT INTO task_limits (task_group, max_running) VALUES (?, ?) "
+            "ON CONFLICT(task_group) DO UPDATE SET max_running = excluded.max_running",
+            (group, max_running)
+        )
+
+    def get_queue_stats(self) -> Dict[str, Dict]:
+        """Per-group limit, running and queued counts."""
+        stats = {g: {"limit": l, "running": 0, "queued": 0} for g, l in self.get_limits().items()}
+        rows = self._conn().execute(
+            """SELECT task_group, status, COUNT(*) AS n FROM tasks
+               WHERE payload IS NOT NULL AND status IN ('pending', 'processing')
+               GROUP BY task_group, status"""
+        )
+        for row in rows:
+            group = stats.setdefault(row["task_group"], {"limit": settings.DEFAULT_TASK_CONCURRENCY, "running": 0, "queued": 0})
+            group["running" if row["status"] == "processing" else "queued"] = row["n"]
+        return stats
+
+    # --- Queue operations (used by workers) ---
+
+    def claim_task(self, worker_id: str, lease_seconds: int = None) -> Optional[Dict]:
+        """
+        Atomically claim the oldest runnable queued task for `worker_id`.
+        Tasks whose concurrency group is already at its limit are skipped.
+        Tasks whose lease expired (worker crashed or was restarted) are
+        claimed again until they run out of attempts.
+        Returns the task dict with its `payload`, or None if nothing is runnable.
+        """
+        lease_seconds = lease_seconds or settings.TASK_LEASE_SECONDS
+        now = time.time()
+        abandoned = []
+        with self._transaction() as conn:
+            limits = self.get_limits()
+            running = {
+                r["task_group"]: r["n"] for r in conn.execute(
+                    """SELECT task_group, COUNT(*) AS n FROM tasks
+                       WHERE status = 'processing' AND lease_expires >= ?
+                       GROUP BY task_group""",
+                    (now,)
+                )
+            }
+            full = [g for g, n in running.items() if n >= limits.get(g, settings.DEFAULT_TASK_CONCURRENCY)]
+            full += [g for g, l in limits.items() if l <= 0 and g not in full]
+            exclude = f"AND task_group NOT IN ({', '.join('?' * len(full))})" if full else ""
+            while True:
+                row = conn.execute(
+                    f"""SELECT * FROM tasks
+                       WHERE payload IS NOT NULL AND (
+                             (status = 'pending' AND available_at <= ?)
+                          OR (status = 'processing' AND lease_expires < ?))
+                       {exclude}
+                       ORDER BY available_at
+                       LIMIT 1""",
+                    (now, now, *full)
+                ).fetchone()
+                if not row:
+                    break
+                if row["cancel_requested"]:
+                    # Worker died while a cancellation was pending
+                    conn.execute(
+                        """UPDATE tasks SET status = 'cancelled', step = 'Cancelled',
+                                  lease_owner = NULL, lease_expires = NULL, updated_at = ?, updated_ts = ?
+                           WHERE id = ?""",
+                        (*_timestamps(), row["id"])
+                    )
+                    abandoned.append(row["id"])
+                    continue
+                if row["attempts"] >= row["max_attempts"]:
+                    # Lease expired on the last attempt, give up on it
+                    conn.execute(
+                        """UPDATE tasks SET status = 'failed', step = ?, error = ?,
+                                  lease_owner = NULL, lease_expires = NULL, updated_at = ?, updated_ts = ?
+                           WHERE id = ?""",
+                        ("Error: worker lost", "Lease expired", *_timestamps(), row["id"])
+                    )
+                    abandoned.append(row["id"])
+                    continue
+                conn.execute(
+                    """UPDATE tasks SET status = 'processing', attempts = attempts + 1,
+                              lease_owner = ?, lease_expires = ?, updated_at = ?, updated_ts = ?
+                       WHERE id = ?""",
+                    (worker_id, now + lease_seconds, *_timestamps(), row["id"])
+                )
+                break
+        for task_id in abandoned:
+            self._publish(task_id)
+        if not row:
+            return None
+        self._publish(row["id"])
+        task = self.get_task(row["id"])
+        task["payload"] = json.loads(row["payload"])
+        return task
+
+    def renew_lease(self, task_id: str, worker_id: str, lease_seconds: int = None) -> bool:
+        lease_seconds = lease_seconds or settings.TASK_LEASE_SECONDS
+        cur = self._conn().execute(
+            "UPDATE tasks SET lease_expires = ? WHERE id = ? AND lease_owner = ? AND status = 'processing'",
+            (time.time() + lease_seconds, task_id, worker_id)
+        )
+        return cur.rowcount > 0
+
+    def complete_task(self, task_id: str, worker_id: str):
+        """Release the lease; mark completed unless the handler already set a final status."""
+        cur = self._conn().execute(
+            """UPDATE tasks SET
+                   status = CASE WHEN status = 'processing' THEN 'completed' ELSE status END,
+                   progress = CASE WHEN status = 'processing' THEN 100 ELSE progress END,
+                   lease_owner = NULL, lease_expires = NULL, updated_at = ?, updated_ts = ?
+               WHERE id = ? AND lease_owner = ?""",
+            (*_timestamps(), task_id, worker_id)
+        )
+        if cur.rowcount:
+            self._publish(task_id)
+
+    def fail_task(self, task_id: str, worker_id: str, error: str):
+        """Record a failed attempt: requeue with backoff, or fail for good when out of attempts."""
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT attempts, max_attempts FROM tasks WHERE id = ? AND lease_owner = ?",
+                (task_id, worker_id)
+            ).fetchone()
+            if not row:
+                return
+            now = _timestamps()
+            if row["attempts"] < row["max_attempts"]:
+                delay = settings.TASK_RETRY_BACKOFF_SECONDS * (2 ** (row["attempts"] - 1))
+                conn.execute(
+                    """UPDATE tasks SET status = 'pending', step = ?, error = ?, available_at = ?,
+                              lease_owner = NULL, lease_expires = NULL, updated_at = ?, updated_ts = ?
+                       WHERE id = ?""",
+                    (f"Retrying in {int(delay)}s (attempt {row['attempts']} failed: {error})",
+                     error, time.time() + delay, *now, task_id)
+                )
+            else:
+                conn.execute(
+                    """UPDATE tasks SET status = 'failed', step = ?, error = ?,
+                              lease_owner = NULL, lease_expires = NULL, updated_at = ?, updated_ts = ?
+                       WHERE id = ?""",
+                    (f"Error: {error}", error, *now, task_id)
+                )
+        self._publish(task_id)
+
+    # --- Cancellation ---
+
+    def cancel_task(self, task_id: str) -> Optional[Dict]:
+        """
+        Request cancellation. Queued tasks are cancelled at once; running tasks
+        are flagged and stop at their handler's next cancellation check, which
+        frees the worker slot. Returns the updated task, or None if unknown.
+        """
+        with self._transaction() as conn:
+            row = conn.execute("SELECT status FROM tasks WHERE id = ?", (task_id,)).fetchone()
+            if row and row["status"] == "pending":
+                conn.execute(
+                    """UPDATE tasks SET status = 'cancelled', step = 'Cancelled', cancel_requested = 1,
+                              updated_at = ?, updated_ts = ?
+                       WHERE id = ?""",
+                    (*_timestamps(), task_id)
+                )
+            elif row and row["status"] == "processing":
+                conn.execute(
+                    """UPDATE tasks SET step = 'Cancelling...', cancel_requested = 1,
+                              updated_at = ?, updated_ts = ?
+                       WHERE id = ?""",
+                    (*_timestamps(), task_id)
+                )
+        if row and row["status"] in ("pending", "processing"):
+            self._publish(task_id)
+        return self.get_task(task_id)
+
+    def is_cancel_requested(self, task_id: str) -> bool:
+        row = self._conn().execute("SELECT cancel_requested FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        return bool(row and row["cancel_requested"])
+
+    def cancel_checker(self, task_id: str, interval: float = 0.5) -> Callable[[], bool]:
+        """
+        Return a cheap `should_cancel()` callable for tight loops (e.g. per
+        streamed chunk); the database is consulted at most every `interval` seconds.
+        """
+        state = {"checked": 0.0, "cancelled": False}
+
+        def should_cancel() -> bool:
+            if not state["cancelled"] and time.time() - state["checked"] >= interval:
+                state["checked"] = time.time()
+                state["cancelled"] = self.is_cancel_requested(task_id)
+            return state["cancelled"]
+        return should_cancel
+
+    def check_cancelled(self, task_id: str):
+        """Raise TaskCancelled if cancellation was requested. Call between handler stages."""
+        if self.is_cancel_requested(task_id):
+            raise TaskCancelled(task_id)
+
+    def mark_cancelled(self, task_id: str, worker_id: str):
+        """Called by the worker once a handler stopped because of cancellation."""
+        cur = self._conn().execute(
+            """UPDATE tasks SET status = 'cancelled', step = 'Cancelled',
+                      lease_owner = NULL, lease_expires = NULL, updated_at = ?, updated_ts = ?
+               WHERE id = ? AND lease_owner = ?""",
+            (*_timestamps(), task_id, worker_id)
+        )
+        if cur.rowcount:
+            self._publish(task_id)
 
 task_manager = TaskManager()
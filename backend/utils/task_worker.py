@@ -0,0 +1,136 @@
+import os
+import uuid
+import time
+import socket
+import threading
+import traceback
+from typing import Callable, Dict
+
+from ..config import settings
+from .task_manager import task_manager, TaskManager, TaskCancelled
+
+# Registry of queued task handlers, keyed by task type
+_handlers: Dict[str, Callable] = {}
+
+def task_handler(task_type: str):
+    """
+    Register a function as the worker handler for `task_type`.
+    The handler is called as handler(task_id, **payload).
+    """
+    def decorator(func: Callable) -> Callable:
+        _handlers[task_type] = func
+        return func
+    return decorator
+
+def get_handler(task_type: str) -> Callable:
+    return _handlers.get(task_type)
+
+class TaskWorker:
+    """
+    Pulls queued tasks from the TaskManager database and executes them on a
+    fixed pool of threads. Per-group concurrency limits are enforced by the
+    TaskManager when claiming, so they hold across all workers.
+
+    Can run embedded in the web process (started on app startup) or as a
+    standalone process via `python -m backend.worker`; any number of workers
+    may share one task database.
+    """
+
+    def __init__(self, manager: TaskManager = None, concurrency: int = 1, poll_interval: float = 1.0,
+                 lease_seconds: int = None, worker_id: str = None):
+        self.manager = manager or task_manager
+        self.concurrency = max(1, concurrency)
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds or settings.TASK_LEASE_SECONDS
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._stop = threading.Event()
+        self._threads = []
+        self._inflight = set()
+        self._inflight_lock = threading.Lock()
+
+    def start(self):
+        self._stop.clear()
+        for i in range(self.concurrency):
+            t = threading.Thread(target=self._loop, name=f"task-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        hb = threading.Thread(target=self._heartbeat, name="task-worker-heartbeat", daemon=True)
+        hb.start()
+        self._threads.append(hb)
+        print(f"Task worker {self.worker_id} started with {self.concurrency} thread(s)")
+
+    def stop(self, timeout: float = None):
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def run_forever(self):
+        self.start()
+        try:
+            while not self._stop.wait(1):
+                pass
+        except KeyboardInterrupt:
+            print("Stopping task worker...")
+        finally:
+            self.stop()
+
+    def run_once(self) -> bool:
+        """Claim and execute a single task synchronously. Returns False if the queue was empty."""
+        task = self.manager.claim_task(self.worker_id, self.lease_seconds)
+        if not task:
+            return False
+        self._execute(task)
+        return True
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                if not self.run_once():
+                    self._stop.wait(self.poll_interval)
+            except Exception as e:
+                # Database busy or similar; back off and try again
+                print(f"Task worker error: {e}")
+                self._stop.wait(self.poll_interval)
+
+    def _execute(self, task: Dict):
+        task_id = task["id"]
+        handler = get_handler(task["type"])
+        with self._inflight_lock:
+            self._inflight.add(task_id)
+        try:
+            if handler is None:
+                raise RuntimeError(f"No handler registered for task type '{task['type']}'")
+            handler(task_id, **task["payload"])
+            self.manager.complete_task(task_id, self.worker_id)
+        except TaskCancelled:
+            print(f"Task {task_id} ({task['type']}) cancelled")
+            self.manager.mark_cancelled(task_id, self.worker_id)
+        except Exception as e:
+            print(f"Task {task_id} ({task['type']}) failed: {e}")
+            traceback.print_exc()
+            self.manager.fail_task(task_id, self.worker_id, str(e))
+        finally:
+            with self._inflight_lock:
+                self._inflight.discard(task_id)
+
+    def _heartbeat(self):
+        # Renew leases of running tasks well before they expire, and apply the retention policy
+        interval = max(1.0, self.lease_seconds / 3)
+        last_prune = 0.0
+        while not self._stop.wait(interval):
+            if time.time() - last_prune >= settings.TASK_PRUNE_INTERVAL_SECONDS:
+                last_prune = time.time()
+                try:
+                    archived = self.manager.prune()
+                    if archived:
+                        print(f"Archived {archived} finished task(s)")
+                except Exception as e:
+                    print(f"Task pruning failed: {e}")
+            with self._inflight_lock:
+                running = list(self._inflight)
+            for task_id in running:
+                try:
+                    self.manager.renew_lease(task_id, self.worker_id, self.lease_seconds)
+                except Exception as e:
+                    print(f"Failed to renew lease for task {task_id}: {e}")
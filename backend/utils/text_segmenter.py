@@ -0,0 +1,231 @@
+"""
+Sentence-aware segmentation of chapter text (plain or Tiptap HTML) for
+fan-out stages: illustrations, TTS, asset extraction.
+
+Text is split at CJK/Latin sentence boundaries and packed into windows
+within a character or token budget. Windows are balanced (a 1100-character
+chapter with a 500 budget gives three windows of ~370, not 500/500/100),
+can overlap by whole sentences, and carry offsets both into the plain text
+and back into the source HTML. segment_stable() instead picks boundaries
+from the content itself, so an edit only changes the segments around it.
+
+Run `python -m backend.utils.text_segmenter` for a quick benchmark.
+"""
+import re
+import math
+import zlib
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+
+from .html_text import html_to_text
+
+# Sentence end: terminal punctuation plus any closing quotes/brackets, or a line break
+_SENTENCE_END = re.compile(r'[。！？!?；;…]+[”’"\'」』）)\]】]*|\.(?=\s)|\n+')
+# Where to cut a sentence that alone exceeds the budget
+_CLAUSE_END = re.compile(r'[，、,：:]')
+_CJK = re.compile(r'[\u3000-\u303f\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]')
+_WORD = re.compile(r'[A-Za-z0-9]+')
+
+@dataclass
+class Segment:
+    index: int
+    text: str
+    # Offsets into the plain text the segment was cut from
+    start: int
+    end: int
+    # Offsets into the original HTML (same as start/end for plain input)
+    source_start: int
+    source_end: int
+    # Characters at the start of `text` repeated from the previous segment
+    overlap: int = 0
+
+def estimate_tokens(text: str) -> int:
+    """Rough LLM token count: one per CJK character, ~4 characters per Latin word piece."""
+    cjk = len(_CJK.findall(text))
+    words = sum(math.ceil(len(w) / 4) for w in _WORD.findall(text))
+    return cjk + words
+
+def split_sentences(text: str) -> List[Tuple[int, int]]:
+    """(start, end) spans of the sentences in `text`; whitespace between them is dropped."""
+    spans = []
+    start = 0
+    for m in _SENTENCE_END.finditer(text):
+        end = m.end()
+        if text[start:end].strip():
+            spans.append(_strip_span(text, start, end))
+        start = end
+    if text[start:].strip():
+        spans.append(_strip_span(text, start, len(text)))
+    return spans
+
+def _strip_span(text: str, start: int, end: int) -> Tuple[int, int]:
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+def _split_long(text: str, start: int, end: int, budget: int, length: Callable[[str], int]) -> List[Tuple[int, int]]:
+    # A single sentence over budget: cut at clause punctuation, else hard-cut
+    pieces = []
+    while length(text[start:end]) > budget:
+        # Largest prefix within budget (binary search keeps this fast for token budgets)
+        lo, hi = start + 1, end
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if length(text[start:mid]) <= budget:
+                lo = mid
+            else:
+                hi = mid - 1
+        cut = lo
+        clause = None
+        for m in _CLAUSE_END.finditer(text, start, cut):
+            clause = m.end()
+        if clause and clause - start > (cut - start) // 2:
+            cut = clause
+        pieces.append((start, cut))
+        start = cut
+    pieces.append((start, end))
+    return pieces
+
+def segment_text(text: str, max_chars: int = 500, overlap: int = 0, max_tokens: int = None,
+                 balanced: bool = True, offsets: Optional[List[int]] = None) -> List[Segment]:
+    """
+    Pack whole sentences into segments of at most `max_chars` characters
+    (or `max_tokens` estimated tokens, if given). `overlap` repeats up to
+    that many characters/tokens of trailing sentences from the previous
+    segment. `offsets` maps text positions back to a source document (see
+    html_text.html_to_text).
+    """
+    length = estimate_tokens if max_tokens else len
+    budget = max_tokens or max_chars
+    if budget <= 0:
+        raise ValueError("Segment budget must be positive")
+    overlap = min(overlap, budget // 2)
+
+    units = []
+    for start, end in split_sentences(text):
+        units.extend(_split_long(text, start, end, budget, length))
+    if not units:
+        return []
+    sizes = [length(text[s:e]) for s, e in units]
+    # suffix[k] = size of units[k:]
+    suffix = [0] * (len(units) + 1)
+    for k in range(len(units) - 1, -1, -1):
+        suffix[k] = suffix[k + 1] + sizes[k]
+
+    # Number of segments to spread the text over (greedy packing would need as many)
+    planned = math.ceil(suffix[0] / max(1, budget - overlap))
+    segments = []
+    prev_first = 0
+    i = 0
+    while i < len(units):
+        # Repeat trailing sentences of the previous segment (never all of it) as overlap
+        first = i
+        size = 0
+        if segments and overlap:
+            while first - 1 > prev_first and size + sizes[first - 1] <= overlap:
+                first -= 1
+                size += sizes[first]
+        target = budget
+        if balanced:
+            # Spread what is left evenly over the remaining planned segments
+            count = max(planned - len(segments), math.ceil(suffix[i] / max(1, budget - size)))
+            target = size + suffix[i] / count
+        j = i
+        # Add sentences while that brings the segment closer to the target, within budget
+        while j < len(units) and (j == i or (size + sizes[j] <= budget and size + sizes[j] / 2 <= target)):
+            size += sizes[j]
+            j += 1
+        if size + suffix[j] <= budget:
+            # Don't leave a short tail that still fits in this segment
+            j = len(units)
+        start, end = units[first][0], units[j - 1][1]
+        segments.append(Segment(
+            index=len(segments),
+            text=text[start:end],
+            start=start,
+            end=end,
+            source_start=offsets[start] if offsets else start,
+            source_end=offsets[end] if offsets else end,
+            overlap=units[i][0] - start,
+        ))
+        prev_first = i
+        i = j
+    return segments
+
+def segment_stable(text: str, max_chars: int = 500, min_chars: int = None,
+                   offsets: Optional[List[int]] = None) -> List[Segment]:
+    """
+    Content-defined segments for per-segment caching. Once a segment holds
+    `min_chars` (default half the budget) it ends after the next sentence
+    whose checksum marks it as an anchor, or earlier if the next sentence
+    would not fit. Boundaries depend only on nearby sentences, so after an
+    edit they fall back in step at the next anchor and the segments
+    before and after it come out unchanged.
+    """
+    if max_chars <= 0:
+        raise ValueError("Segment budget must be positive")
+    min_chars = max_chars // 2 if min_chars is None else min_chars
+    units = []
+    for start, end in split_sentences(text):
+        units.extend(_split_long(text, start, end, max_chars, len))
+
+    segments = []
+    i = 0
+    while i < len(units):
+        j = i + 1
+        size = units[i][1] - units[i][0]
+        while j < len(units):
+            if size >= min_chars and zlib.crc32(text[units[j - 1][0]:units[j - 1][1]].encode("utf-8")) % 3 == 0:
+                break
+            nxt = units[j][1] - units[j][0]
+            if size + nxt > max_chars:
+                break
+            size += nxt
+            j += 1
+        start, end = units[i][0], units[j - 1][1]
+        segments.append(Segment(
+            index=len(segments),
+            text=text[start:end],
+            start=start,
+            end=end,
+            source_start=offsets[start] if offsets else start,
+            source_end=offsets[end] if offsets else end,
+        ))
+        i = j
+    return segments
+
+def segment_html(content: str, stable: bool = False, **kwargs) -> List[Segment]:
+    """segment_text() (or segment_stable()) for Tiptap HTML; source offsets point into `content`."""
+    text, offsets = html_to_text(content)
+    return (segment_stable if stable else segment_text)(text, offsets=offsets, **kwargs)
+
+def clip_text(text: str, max_chars: int) -> str:
+    """The longest run of whole leading sentences within `max_chars` (hard cut if the first is longer)."""
+    if len(text) <= max_chars:
+        return text
+    end = 0
+    for s, e in split_sentences(text):
+        if e > max_chars:
+            break
+        end = e
+    return text[:end] if end else text[:max_chars]
+
+def _benchmark():
+    import time
+    sentence = "夜色渐深，城外的风卷起落叶，他握紧手中的剑，低声说道：“我们必须在天亮之前离开。”"
+    paragraph = "<p>" + sentence * 8 + "</p>"
+    content = paragraph * (100_000 // len(sentence * 8) + 1)
+    for label, kwargs in [("chars=500", {"max_chars": 500}),
+                          ("chars=500 overlap=80", {"max_chars": 500, "overlap": 80}),
+                          ("tokens=1000", {"max_tokens": 1000})]:
+        started = time.perf_counter()
+        segments = segment_html(content, **kwargs)
+        elapsed = (time.perf_counter() - started) * 1000
+        sizes = [len(s.text) for s in segments]
+        print(f"{label:>22}: {len(content):,} chars HTML -> {len(segments)} segments "
+              f"({min(sizes)}-{max(sizes)} chars) in {elapsed:.1f} ms")
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,61 @@
+"""
+Cache of synthesized speech, keyed by the text's hash, the voice and the
+rate. Entries exist at two levels:
+
+- segment: the MP3 frames of one sentence-aligned segment. Segments come
+  from segment_stable(), so editing part of a chapter leaves most segment
+  keys unchanged and only the edited segments are synthesized again.
+- chapter: the joined MP3 of a whole text, keyed by its segment keys,
+  served directly by the streaming endpoints.
+
+Files live in the LRU store of utils/file_cache.py (settings.TTS_CACHE_PATH,
+under the private state directory, with a settings.TTS_CACHE_MAX_BYTES
+budget); they are served by the streaming endpoints, not under /data.
+"""
+import os
+import json
+import uuid
+import hashlib
+from typing import List, Optional
+
+from ..config import settings
+from .file_cache import FileCache
+
+def segment_key(text: str, voice: str, rate: str, backend: str = "edge") -> str:
+    params = {"text": hashlib.sha256(text.encode("utf-8")).hexdigest(), "voice": voice, "rate": rate}
+    if backend != "edge":
+        # Other backends (e.g. the offline stand-in) never share entries with real speech
+        params["backend"] = backend
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+def chapter_key(segment_keys: List[str]) -> str:
+    return hashlib.sha256("\n".join(["chapter"] + segment_keys).encode("utf-8")).hexdigest()
+
+class AudioCache(FileCache):
+    default_extension = ".mp3"
+
+    def get_bytes(self, key: str) -> Optional[bytes]:
+        path = self.path(key)
+        if not path:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put_bytes(self, key: str, data: bytes):
+        tmp_path = os.path.join(self.cache_dir, f"{uuid.uuid4().hex}.part")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        self.put_file(key, tmp_path)
+
+    def put_file(self, key: str, path: str):
+        """Move a finished file (on the same filesystem) into the cache."""
+        filename = f"{key}.mp3"
+        os.replace(path, os.path.join(self.cache_dir, filename))
+        self._add_entry(key, filename)
+
+tts_cache = AudioCache(
+    settings.TTS_CACHE_PATH, settings.TTS_CACHE_MAX_BYTES, os.path.join(settings.STATE_PATH, "tts_cache.db")
+)
@@ -0,0 +1,25 @@
+"""
+Standalone task worker process.
+
+    python -m backend.worker --concurrency 4
+
+Runs queued generation tasks from the shared task database. Start as many of
+these as needed (and set MONSTER_EMBEDDED_WORKER=0 for the API) so the web tier
+and generation workers scale independently.
+"""
+import argparse
+
+from .services import generation_tasks  # noqa: F401  (registers task handlers)
+from .utils.task_worker import TaskWorker
+
+def main():
+    parser = argparse.ArgumentParser(description="Monster task worker")
+    parser.add_argument("--concurrency", type=int, default=2, help="Number of tasks to run in parallel")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds to wait when the queue is empty")
+    args = parser.parse_args()
+
+    worker = TaskWorker(concurrency=args.concurrency, poll_interval=args.poll_interval)
+    worker.run_forever()
+
+if __name__ == "__main__":
+    main()
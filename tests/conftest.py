@@ -0,0 +1,13 @@
+import os
+import shutil
+import tempfile
+
+# The module-level caches, indexes and the task manager open their SQLite
+# databases under STATE_PATH when backend modules are imported; point it at a
+# scratch directory before that happens, so tests never touch ./state
+_state_path = tempfile.mkdtemp(prefix="monster-test-state-")
+os.environ["MONSTER_STATE_PATH"] = _state_path
+os.environ["MONSTER_TASK_DB"] = os.path.join(_state_path, "tasks.db")
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(_state_path, ignore_errors=True)
@@ -0,0 +1,91 @@
+import os
+
+import pytest
+
+from backend.config import settings
+from backend.utils import storage
+from backend.utils.metadata_index import MetadataIndex
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    from fastapi.testclient import TestClient
+    from backend import main
+    monkeypatch.setattr(settings, "STORAGE_PATH", str(tmp_path))
+    index = MetadataIndex(str(tmp_path / "index.db"))
+    monkeypatch.setattr(storage, "metadata_index", index)
+    monkeypatch.setattr(main, "metadata_index", index)
+    for n in range(1, 6):
+        storage.save_json(f"novel_b_chapter_{n}.json", {"chapter_num": n, "content": f"<p>第{n}章</p>"})
+    return TestClient(main.app)
+
+def test_batch_fetch_by_range_and_numbers(client):
+    res = client.get("/api/novels/b/chapters/batch", params={"start": 2, "end": 4, "fields": "chapter_num,content"})
+    assert res.json() == [{"chapter_num": n, "content": f"<p>第{n}章</p>"} for n in (2, 3, 4)]
+
+    res = client.get("/api/novels/b/chapters/batch", params={"nums": "5,1,9", "fields": "chapter_num,word_count"})
+    assert res.json() == [{"chapter_num": 1, "word_count": 3}, {"chapter_num": 5, "word_count": 3}]
+
+    assert client.get("/api/novels/b/chapters/batch").status_code == 400
+    assert client.get("/api/novels/b/chapters/batch", params={"nums": "1,x"}).status_code == 400
+
+def test_batch_update_edits_and_swaps_in_one_write(client):
+    res = client.put("/api/novels/b/chapters/batch", json={"updates": [
+        {"chapter_num": 1, "new_chapter_num": 2},
+        {"chapter_num": 2, "new_chapter_num": 1, "content": "<p>新的开头</p>"},
+        {"chapter_num": 5, "new_chapter_num": 6},
+        {"chapter_num": 3, "images": ["a.png"]},
+    ]})
+    assert res.status_code == 200
+    chapters = {c["chapter_num"]: c for c in
+                client.get("/api/novels/b/chapters/batch", params={"start": 1, "end": 10}).json()}
+    assert sorted(chapters) == [1, 2, 3, 4, 6]
+    assert chapters[1]["content"] == "<p>新的开头</p>" and chapters[1]["plain_text"] == "新的开头"
+    assert chapters[2]["content"] == "<p>第1章</p>"
+    assert chapters[3]["images"] == ["a.png"]
+    assert storage.load_json("novel_b_chapter_5.json") is None
+
+def test_batch_update_is_rejected_as_a_whole(client):
+    before = client.get("/api/novels/b/chapters/batch", params={"start": 1, "end": 5}).json()
+    # Chapter 4 stays where it is, so 3 cannot move onto it
+    res = client.put("/api/novels/b/chapters/batch", json={"updates": [
+        {"chapter_num": 1, "content": "<p>改了</p>"},
+        {"chapter_num": 3, "new_chapter_num": 4},
+    ]})
+    assert res.status_code == 409
+    res = client.put("/api/novels/b/chapters/batch", json={"updates": [
+        {"chapter_num": 1, "new_chapter_num": 7},
+        {"chapter_num": 2, "new_chapter_num": 7},
+    ]})
+    assert res.status_code == 400
+    assert client.get("/api/novels/b/chapters/batch", params={"start": 1, "end": 10}).json() == before
+
+def test_failed_rename_restores_every_file(client, tmp_path, monkeypatch):
+    before = {name: (tmp_path / name).read_text(encoding="utf-8") for name in os.listdir(tmp_path) if name.endswith(".json")}
+    replace = os.replace
+    renames = []
+
+    def flaky_replace(src, dest):
+        if src.endswith(".tmp"):
+            renames.append(dest)
+            if len(renames) == 2:
+                raise OSError("disk full")
+        replace(src, dest)
+
+    monkeypatch.setattr(os, "replace", flaky_replace)
+    res = client.put("/api/novels/b/chapters/batch", json={"updates": [
+        {"chapter_num": 1, "new_chapter_num": 2},
+        {"chapter_num": 2, "new_chapter_num": 1},
+        {"chapter_num": 5, "new_chapter_num": 6},
+    ]})
+    assert res.status_code == 500 and len(renames) == 2
+    after = {name: (tmp_path / name).read_text(encoding="utf-8") for name in os.listdir(tmp_path)
+             if not name.startswith("index.db")}
+    assert after == before
+
+def test_delete_novel_removes_chapters_assets_and_index_rows(client, tmp_path):
+    storage.save_json("novel_b.json", {"id": "b", "title": "B"})
+    storage.save_json("novel_b_assets.json", [{"id": 1, "name": "a"}])
+    assert client.delete("/api/novels/b").status_code == 200
+    assert not [name for name in os.listdir(tmp_path) if name.startswith("novel_b")]
+    assert storage.metadata_index.chapters("b")[0] == [] and storage.metadata_index.assets("b")[0] == []
+    assert client.delete("/api/novels/b/chapters/1").status_code == 404
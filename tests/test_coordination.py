@@ -0,0 +1,115 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+from backend.utils.coordination import LocalBackend, RedisBackend, LockTimeout, LockLost
+from backend.utils.resp_standin import RespStandin
+from backend.utils.task_manager import TaskManager
+
+@pytest.fixture
+def redis_backend():
+    server = RespStandin().start()
+    yield RedisBackend(server.url)
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture(params=["local", "redis"])
+def backend(request, tmp_path):
+    if request.param == "local":
+        return LocalBackend(str(tmp_path))
+    return request.getfixturevalue("redis_backend")
+
+def test_key_value_roundtrip(backend):
+    assert backend.get("missing") is None
+    backend.set("k", "värde")
+    assert backend.get("k") == "värde"
+    backend.delete("k")
+    assert backend.get("k") is None
+
+def test_lock_is_exclusive(backend):
+    held = threading.Event()
+    release = threading.Event()
+
+    def holder():
+        with backend.lock("novel:1"):
+            held.set()
+            release.wait(5)
+
+    t = threading.Thread(target=holder)
+    t.start()
+    held.wait(5)
+    with pytest.raises(LockTimeout):
+        with backend.lock("novel:1", timeout=0.1):
+            pass
+    # Other names are independent
+    with backend.lock("novel:2", timeout=0.1):
+        pass
+    release.set()
+    t.join()
+    with backend.lock("novel:1", timeout=1):
+        pass
+
+def test_redis_lock_is_renewed_while_held(redis_backend):
+    with redis_backend.lock("novel:1", ttl=0.3):
+        time.sleep(0.6)
+        with pytest.raises(LockTimeout):
+            with redis_backend.lock("novel:1", timeout=0.05):
+                pass
+
+    with pytest.raises(LockLost):
+        with redis_backend.lock("novel:2", ttl=0.3):
+            redis_backend.execute("FLUSHALL")
+            time.sleep(0.3)
+
+def test_task_state_is_shared_across_hosts(tmp_path, redis_backend):
+    # Two managers with separate databases stand in for two hosts
+    host_a = TaskManager(str(tmp_path / "a.db"), backend=redis_backend)
+    host_b = TaskManager(str(tmp_path / "b.db"), backend=redis_backend)
+
+    task_id = host_a.create_task("test_echo", "remote")
+    host_a.update_task(task_id, status="processing", progress=40)
+
+    task = host_b.get_task(task_id)
+    assert task["description"] == "remote"
+    assert task["progress"] == 40
+
+def test_novel_lock_is_reentrant_per_task_not_per_thread(tmp_path, monkeypatch):
+    from fastapi import HTTPException
+    from backend.config import settings
+    from backend.utils import storage
+    monkeypatch.setattr(storage, "coordination", LocalBackend(str(tmp_path)))
+    monkeypatch.setattr(settings, "NOVEL_LOCK_TIMEOUT_SECONDS", 0.1)
+
+    async def main():
+        held = asyncio.Event()
+        release = asyncio.Event()
+
+        async def holder():
+            with storage.novel_lock("n1"):
+                with storage.novel_lock("n1"):
+                    held.set()
+                    await release.wait()
+
+        task = asyncio.ensure_future(holder())
+        await held.wait()
+        # Same thread, other task: must not be let in as a re-entrant holder
+        with pytest.raises(HTTPException) as e:
+            with storage.novel_lock("n1"):
+                pass
+        release.set()
+        await task
+        assert e.value.status_code == 503
+
+    asyncio.run(main())
+
+def test_lost_novel_lock_is_a_conflict(redis_backend, monkeypatch):
+    from fastapi import HTTPException
+    from backend.utils import storage
+    monkeypatch.setattr(storage, "coordination", redis_backend)
+    with pytest.raises(HTTPException) as e:
+        with storage.novel_lock("n1"):
+            # Expired and taken over meanwhile
+            redis_backend.execute("FLUSHALL")
+    assert e.value.status_code == 409
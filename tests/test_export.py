@@ -0,0 +1,171 @@
+import io
+import os
+import zipfile
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from backend.config import settings
+from backend.services import export_service
+from backend.utils import storage
+from backend.utils.export_cache import ExportCache
+
+NOVEL = {"id": "e1", "title": "长夜 & 黎明", "description": "一部测试小说"}
+
+def export(novel, fmt):
+    out = io.BytesIO()
+    export_service.write_export(out, novel, "e1", fmt)
+    return out.getvalue()
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = ExportCache(str(tmp_path / "exports"), str(tmp_path / "export_cache.db"))
+    monkeypatch.setattr(export_service, "export_cache", cache)
+    return cache
+
+@pytest.fixture
+def novel(tmp_path, monkeypatch, cache):
+    monkeypatch.setattr(settings, "STORAGE_PATH", str(tmp_path))
+    storage.save_json("novel_e1.json", NOVEL)
+    # Chapter 10 must sort after chapter 2
+    for num in (1, 2, 10):
+        storage.save_json(f"novel_e1_chapter_{num}.json", {
+            "chapter_num": num,
+            "content": f"<p>第{num}章开头 &amp; <strong>重点</strong><br>换行</p><p>未闭合<em>斜体</p><img src='x.png'>",
+        })
+    return NOVEL
+
+def test_txt_streams_one_chapter_at_a_time(novel):
+    path, stream = export_service.open_export(novel, "e1", "txt")
+    chunks = list(stream)
+    assert path is None and len(chunks) == 4
+    text = b"".join(chunks).decode("utf-8")
+    assert text.index("Chapter 2") < text.index("Chapter 10")
+    assert "第1章开头 & 重点\n换行\n未闭合斜体" in text
+    assert "<" not in text
+
+def test_epub_is_well_formed(novel):
+    data = export(novel, "epub")
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        first = zf.infolist()[0]
+        assert first.filename == "mimetype" and first.compress_type == zipfile.ZIP_STORED
+        assert zf.read("mimetype") == b"application/epub+zip"
+        names = zf.namelist()
+        for name in names:
+            if name.endswith((".xhtml", ".opf", ".ncx", ".xml")):
+                ET.fromstring(zf.read(name))
+        assert [n for n in names if n.startswith("OEBPS/text/chap_")] == [
+            "OEBPS/text/chap_1.xhtml", "OEBPS/text/chap_2.xhtml", "OEBPS/text/chap_3.xhtml"]
+        chapter = zf.read("OEBPS/text/chap_3.xhtml").decode("utf-8")
+        assert "<h1>Chapter 10</h1>" in chapter and "<em>斜体</em></p>" in chapter
+        assert "长夜 &amp; 黎明" in zf.read("OEBPS/content.opf").decode("utf-8")
+
+def test_docx_opens_in_python_docx(novel):
+    docx = pytest.importorskip("docx")
+    data = export(novel, "docx")
+    doc = docx.Document(io.BytesIO(data))
+    headings = [p.text for p in doc.paragraphs if p.style.name == "Heading 1"]
+    assert headings == ["Chapter 1", "Chapter 2", "Chapter 10"]
+    assert doc.paragraphs[0].text == NOVEL["title"]
+
+def test_unchanged_novel_is_served_from_cache(novel, cache):
+    path, _ = export_service.open_export(novel, "e1", "epub")
+    # The TXT stream is cached once it has been sent completely
+    list(export_service.open_export(novel, "e1", "txt")[1])
+    assert export_service.open_export(novel, "e1", "txt")[0]
+
+    again, _ = export_service.open_export(novel, "e1", "epub")
+    assert again == path and cache.get_stats()["hits"] >= 1
+
+    storage.save_json("novel_e1_chapter_2.json", {"chapter_num": 2, "content": "<p>改过的第二章</p>"})
+    rebuilt, _ = export_service.open_export(novel, "e1", "epub")
+    assert rebuilt != path and not os.path.exists(path)
+    with zipfile.ZipFile(rebuilt) as zf:
+        assert "改过的第二章" in zf.read("OEBPS/text/chap_2.xhtml").decode("utf-8")
+
+def test_epub_rebuild_converts_only_changed_chapters(novel, monkeypatch):
+    converted = []
+    original = export_service.chapter_section
+    monkeypatch.setattr(export_service, "chapter_section", lambda c: converted.append(c["chapter_num"]) or original(c))
+    export(novel, "epub")
+    assert converted == [1, 2, 10]
+
+    converted.clear()
+    storage.save_json("novel_e1_chapter_10.json", {"chapter_num": 10, "content": "<p>新的结局</p>"})
+    export(novel, "epub")
+    assert converted == [10]
+
+def test_export_job_converts_in_parallel_and_builds_all_formats(novel, cache, tmp_path, monkeypatch):
+    from backend.services import generation_tasks
+    from backend.utils.task_manager import TaskManager
+    manager = TaskManager(str(tmp_path / "tasks.db"))
+    monkeypatch.setattr(generation_tasks, "task_manager", manager)
+    monkeypatch.setattr(settings, "EXPORT_CONVERT_WORKERS", 2)
+    monkeypatch.setattr(settings, "EXPORT_CONVERT_MIN_BATCH", 1)
+
+    def run():
+        task_id = manager.create_task("novel_export", "export", stages=["a", "b", "c", "d"])
+        generation_tasks.run_novel_export(task_id, "e1", ["epub", "txt"])
+        return manager.get_task(task_id)
+
+    task = run()
+    assert task["status"] == "completed"
+    result = task["result"]
+    assert sorted(result["built"]) == ["epub", "txt"]
+    # Every chapter was converted in the worker processes, once per kind
+    assert cache.get_stats()["sections"] == 6
+    assert result["files"]["txt"]["url"] == f"/api/novels/e1/exports/{result['revision']}/txt"
+    txt = cache.export_path("e1", result["revision"], "txt")
+    assert "第10章开头 & 重点" in open(txt, encoding="utf-8").read()
+
+    again = run()["result"]
+    assert again["revision"] == result["revision"] and again["built"] == []
+
+def test_export_job_survives_its_files_being_replaced(novel, cache, tmp_path, monkeypatch):
+    from backend.services import generation_tasks
+    from backend.utils.task_manager import TaskManager
+    manager = TaskManager(str(tmp_path / "tasks.db"))
+    monkeypatch.setattr(generation_tasks, "task_manager", manager)
+    store = cache.store
+
+    def store_then_replaced(novel_id, revision, fmt, tmp_path):
+        path, size = store(novel_id, revision, fmt, tmp_path)
+        # An export of a newer revision evicts this one right after it is published
+        os.remove(path)
+        return path, size
+
+    monkeypatch.setattr(cache, "store", store_then_replaced)
+    task_id = manager.create_task("novel_export", "export", stages=["a", "b", "c", "d"])
+    generation_tasks.run_novel_export(task_id, "e1", ["epub"])
+    task = manager.get_task(task_id)
+    assert task["status"] == "completed" and task["result"]["files"]["epub"]["size"] > 0
+
+def test_illustrated_epub_stores_each_image_once_downscaled(novel, tmp_path, monkeypatch):
+    Image = pytest.importorskip("PIL.Image")
+    monkeypatch.setattr(settings, "IMAGE_VARIANT_PATH", str(tmp_path / "variants"))
+    Image.new("RGB", (2400, 1600), (200, 80, 40)).save(tmp_path / "scene.png")
+    (tmp_path / "scene_copy.png").write_bytes((tmp_path / "scene.png").read_bytes())
+    for num, names in ((1, ["scene.png", "scene_copy.png"]), (2, ["scene.png", "missing.png"])):
+        chapter = storage.load_json(f"novel_e1_chapter_{num}.json")
+        chapter["images"] = [{"url": f"/data/{name}", "source": "auto"} for name in names]
+        storage.save_json(f"novel_e1_chapter_{num}.json", chapter)
+    storage.save_json("novel_e1_assets.json", [
+        {"id": 1, "type": "character", "name": "林", "role": "主角", "img": "http://localhost:8000/data/scene.png"},
+        {"id": 2, "type": "scene", "name": "城外", "img": "/data/scene.png"},
+    ])
+
+    data = export(novel, "epub_images")
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        images = [n for n in zf.namelist() if n.startswith("OEBPS/images/")]
+        # Three references to the same picture in chapters, one portrait size
+        assert len(images) == 2
+        sizes = sorted(Image.open(io.BytesIO(zf.read(n))).width for n in images)
+        assert sizes == [settings.EPUB_PORTRAIT_WIDTH, settings.EPUB_IMAGE_WIDTH]
+        opf = zf.read("OEBPS/content.opf").decode("utf-8")
+        assert all(f'href="{n[len("OEBPS/"):]}"' in opf for n in images)
+        assert [zf.read(f"OEBPS/text/chap_{i}.xhtml").decode("utf-8").count("<img ") for i in (1, 2)] == [2, 1]
+        assert "<h2>林</h2>" in zf.read("OEBPS/text/characters.xhtml").decode("utf-8")
+        for name in zf.namelist():
+            if name.endswith(".xhtml"):
+                ET.fromstring(zf.read(name))
+    assert len(data) < (tmp_path / "scene.png").stat().st_size * 2
@@ -0,0 +1,32 @@
+from backend.utils import html_text
+
+CONTENT = "<h2>序</h2><p>  第一句 &amp; <strong>重点</strong><br>换行</p><p></p><ul><li>甲</li><li>乙 &lt;丙&gt;</li></ul><p>未闭合<em>斜体"
+
+def test_plain_text_keeps_paragraphs():
+    assert html_text.plain_text(CONTENT) == "序\n第一句 & 重点\n换行\n甲\n乙 <丙>\n未闭合斜体"
+    assert html_text.paragraphs("纯文本第一段\n\n  第二段  ") == ["纯文本第一段", "第二段"]
+    assert html_text.plain_text("") == "" and html_text.paragraphs("<p></p>") == []
+
+def test_less_than_sign_in_plain_text_is_kept():
+    # Generated chapters are stored as plain text; a "<" there must not swallow the rest
+    assert html_text.plain_text("他说：x<y，然后离开了。\n第二段") == "他说：x<y，然后离开了。\n第二段"
+    assert html_text.plain_text("a > b &amp; c") == "a > b &amp; c"
+    assert html_text.plain_text("<p>x<y，然后离开了。</p><p>第二段</p>") == "x<y，然后离开了。\n第二段"
+    text, offsets = html_text.html_to_text("<p>1 < 2</p>")
+    assert text == "1 < 2\n" and offsets[2] == 5
+
+def test_plain_text_matches_offset_converter():
+    text, _ = html_text.html_to_text(CONTENT)
+    assert html_text.plain_text(CONTENT) == "\n".join(line.strip() for line in text.splitlines() if line.strip())
+
+def test_word_count_counts_cjk_characters_and_latin_words():
+    assert html_text.word_count("他说：“OK，let's go 2024！”") == 5 + 4
+
+def test_stored_plain_text_is_reused_until_content_changes():
+    chapter = html_text.refresh_chapter({"content": "<p>第一章</p>"})
+    assert chapter["plain_text"] == "第一章" and chapter["word_count"] == 3
+    chapter["plain_text"] = "stored"
+    assert html_text.chapter_text(chapter) == "stored"
+    chapter["content"] = "<p>改过了</p>"
+    assert html_text.chapter_text(chapter) == "改过了" and html_text.chapter_word_count(chapter) == 3
+    assert html_text.chapter_text({"content": "<p>旧章节</p>"}) == "旧章节"
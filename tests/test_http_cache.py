@@ -0,0 +1,67 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from backend.config import settings
+from backend.utils.http_cache import JSONResponseCacheMiddleware
+from backend.utils.image_variants import VariantStaticFiles
+
+def make_client(tmp_path):
+    app = FastAPI()
+    app.add_middleware(JSONResponseCacheMiddleware)
+    state = {"content": "<p>" + "夜色渐深。" * 400 + "</p>"}
+
+    @app.get("/api/chapter")
+    def chapter():
+        return state
+
+    @app.get("/api/small")
+    def small():
+        return {"ok": True}
+
+    app.mount("/data", VariantStaticFiles(directory=str(tmp_path)))
+    return TestClient(app), state
+
+def test_json_polls_revalidate_to_empty_304(tmp_path):
+    client, state = make_client(tmp_path)
+    first = client.get("/api/chapter", headers={"Accept-Encoding": "gzip"})
+    assert first.headers["content-encoding"] == "gzip" and first.headers["cache-control"] == "no-cache"
+    assert int(first.headers["content-length"]) < len(first.json()["content"].encode("utf-8")) / 10
+
+    again = client.get("/api/chapter", headers={"Accept-Encoding": "gzip", "If-None-Match": first.headers["etag"]})
+    assert again.status_code == 304 and again.content == b"" and again.headers["etag"] == first.headers["etag"]
+
+    state["content"] += "<p>新的一段</p>"
+    changed = client.get("/api/chapter", headers={"Accept-Encoding": "gzip", "If-None-Match": first.headers["etag"]})
+    assert changed.status_code == 200 and changed.headers["etag"] != first.headers["etag"]
+
+def test_small_or_unaccepted_bodies_are_not_compressed(tmp_path):
+    client, _ = make_client(tmp_path)
+    small = client.get("/api/small", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in small.headers and small.headers["etag"]
+    plain = client.get("/api/chapter", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    assert len(plain.content) >= settings.HTTP_COMPRESS_MIN_BYTES
+    # Identity and gzip representations share the validator
+    assert client.get("/api/chapter", headers={"Accept-Encoding": "gzip", "If-None-Match": plain.headers["etag"]}).status_code == 304
+
+def test_media_gets_range_and_cache_headers(tmp_path):
+    client, _ = make_client(tmp_path)
+    (tmp_path / "1_tts_100.mp3").write_bytes(bytes(range(256)) * 4)
+    (tmp_path / "audiobook").mkdir()
+    (tmp_path / "audiobook" / "audiobook.mp3").write_bytes(b"x" * 100)
+
+    (tmp_path / "z_gen_0123456789abcdef0123456789abcdef.png").write_bytes(b"png")
+    assert client.get("/data/z_gen_0123456789abcdef0123456789abcdef.png").headers["cache-control"] == \
+        "public, max-age=31536000, immutable"
+
+    audio = client.get("/data/1_tts_100.mp3")
+    assert audio.headers["cache-control"] == "no-cache"
+    part = client.get("/data/1_tts_100.mp3", headers={"Range": "bytes=256-511"})
+    assert part.status_code == 206 and part.content == bytes(range(256))
+    assert client.get("/data/1_tts_100.mp3", headers={"If-None-Match": audio.headers["etag"]}).status_code == 304
+
+    # Rebuilt in place: the old validator no longer matches
+    book = client.get("/data/audiobook/audiobook.mp3")
+    (tmp_path / "audiobook" / "audiobook.mp3").write_bytes(b"y" * 200)
+    rebuilt = client.get("/data/audiobook/audiobook.mp3", headers={"If-None-Match": book.headers["etag"]})
+    assert rebuilt.status_code == 200 and rebuilt.content == b"y" * 200
@@ -0,0 +1,205 @@
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from backend.config import settings
+from backend.services import z_image_generator as zmod
+from backend.utils.image_cache import ImageCache, cache_key
+from backend.utils.task_manager import TaskManager
+
+class FakeStatus:
+    rank = None
+    queue_size = None
+    eta = None
+    progress_data = None
+
+class FakeJob:
+    def __init__(self):
+        self.future = Future()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self):
+        return self.future.result()
+
+    def status(self):
+        return FakeStatus()
+
+    def cancel(self):
+        return self.future.cancel()
+
+class FakeClient:
+    src = "http://z-image.invalid/"
+
+    def __init__(self, src, tmp_path):
+        self.tmp_path = tmp_path
+        self.jobs = []
+        self.max_in_flight = 0
+
+    def submit(self, prompt, **kwargs):
+        job = FakeJob()
+        self.jobs.append((prompt, job))
+        self.last_kwargs = kwargs
+        in_flight = sum(1 for _, j in self.jobs if not j.done())
+        self.max_in_flight = max(self.max_in_flight, in_flight)
+        return job
+
+    def finish(self, job):
+        path = self.tmp_path / f"out_{id(job)}.png"
+        path.write_bytes(b"png")
+        # Gallery output plus the seed used
+        job.future.set_result([[{"image": str(path), "caption": None}], 42])
+
+@pytest.fixture
+def generator(tmp_path, monkeypatch):
+    manager = TaskManager(str(tmp_path / "tasks.db"))
+    monkeypatch.setattr(zmod, "task_manager", manager)
+    monkeypatch.setattr(zmod, "image_cache", ImageCache(str(tmp_path / "cache"), db_path=str(tmp_path / "cache.db")))
+    monkeypatch.setattr(zmod, "Client", lambda src, **kwargs: FakeClient(src, tmp_path))
+    monkeypatch.setattr(settings, "STORAGE_PATH", str(tmp_path / "storage"))
+    monkeypatch.setattr(settings, "IMAGE_MAX_CONCURRENT_JOBS", 2)
+    monkeypatch.setattr(settings, "IMAGE_STATUS_POLL_SECONDS", 0.05)
+    gen = zmod.ZImageGenerator()
+    gen.start()
+    _wait_for(lambda: gen.client is not None)
+    yield gen, manager
+    gen.stop()
+
+def _wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+def test_submit_returns_immediately_and_pool_is_bounded(generator):
+    gen, manager = generator
+    ids = [gen.submit_job(f"prompt {i}") for i in range(5)]
+
+    # Only two jobs are handed to gradio, the rest wait for a slot
+    assert len(gen.client.jobs) == 2
+    assert [manager.get_task(i)["status"] for i in ids].count("pending") == 3
+
+    while any(not job.done() for _, job in gen.client.jobs) or len(gen.client.jobs) < 5:
+        _, job = next((p, j) for p, j in gen.client.jobs if not j.done())
+        gen.client.finish(job)
+
+    for task_id in ids:
+        task = manager.get_task(task_id)
+        assert task["status"] == "completed"
+        assert task["result"]["image_url"].startswith("/data/z_gen_")
+        assert os.path.exists(os.path.join(settings.STORAGE_PATH, task["result"]["image_url"][len("/data/"):]))
+    assert gen.client.max_in_flight == 2
+
+def test_cancel_running_job(generator):
+    gen, manager = generator
+    task_id = gen.submit_job("dragon")
+    manager.cancel_task(task_id)
+    _wait_for(lambda: manager.get_task(task_id)["status"] == "cancelled")
+    assert gen.get_stats()["running"] == 0
+
+def test_client_connects_in_background_with_backoff(tmp_path, monkeypatch):
+    manager = TaskManager(str(tmp_path / "tasks.db"))
+    monkeypatch.setattr(zmod, "task_manager", manager)
+    monkeypatch.setattr(settings, "STORAGE_PATH", str(tmp_path / "storage"))
+    monkeypatch.setattr(settings, "IMAGE_CONNECT_BACKOFF_SECONDS", 0.05)
+    monkeypatch.setattr(settings, "IMAGE_STATUS_POLL_SECONDS", 0.05)
+    attempts = []
+
+    def flaky_client(src, **kwargs):
+        attempts.append(src)
+        if len(attempts) < 3:
+            raise ConnectionError("Space unreachable")
+        return FakeClient(src, tmp_path)
+    monkeypatch.setattr(zmod, "Client", flaky_client)
+
+    # Constructing the generator does not touch the network
+    gen = zmod.ZImageGenerator()
+    assert attempts == [] and gen.get_status()["state"] == "idle"
+
+    # Jobs submitted while disconnected wait for the connection
+    task_id = gen.submit_job("lighthouse")
+    assert manager.get_task(task_id)["status"] == "pending"
+    _wait_for(lambda: gen.client is not None)
+    assert len(attempts) == 3
+    status = gen.get_status()
+    assert status["ready"] and status["consecutive_failures"] == 0
+
+    _wait_for(lambda: gen.client.jobs)
+    gen.client.finish(gen.client.jobs[0][1])
+    assert manager.get_task(task_id)["status"] == "completed"
+    gen.stop()
+
+def test_illustrations_are_saved_as_they_render(generator, monkeypatch):
+    from backend.services import generation_tasks
+    from backend.utils import storage
+    gen, manager = generator
+    monkeypatch.setattr(generation_tasks, "task_manager", manager)
+    monkeypatch.setattr(generation_tasks, "z_image_generator", gen)
+    monkeypatch.setattr(generation_tasks.novel_generator, "generate_illustration_prompt", lambda text: f"scene: {text[:5]}")
+    monkeypatch.setattr(settings, "ILLUSTRATION_CHUNK_SIZE", 10)
+    monkeypatch.setattr(settings, "ILLUSTRATION_BATCH_SIZE", 2)
+    os.makedirs(settings.STORAGE_PATH, exist_ok=True)
+    manual = {"id": "img_manual", "url": "/data/manual.png", "prompt": "mine"}
+    storage.save_json("novel_n1_chapter_1.json", {"content": "<p>" + "".join(chr(0x4e00 + i) for i in range(30)) + "</p>", "images": [manual]})
+
+    task_id = manager.create_task("illustration_generation")
+    t = threading.Thread(target=generation_tasks.run_illustration_generation, args=(task_id, "n1", 1))
+    t.start()
+
+    # Batches of two: the second batch is only submitted once the first has finished
+    _wait_for(lambda: len(gen.client.jobs) == 2)
+    gen.client.finish(gen.client.jobs[1][1])
+    _wait_for(lambda: len(storage.load_json("novel_n1_chapter_1.json")["images"]) == 2)
+    assert len(gen.client.jobs) == 2
+    gen.client.finish(gen.client.jobs[0][1])
+    _wait_for(lambda: len(gen.client.jobs) == 3)
+    gen.client.finish(gen.client.jobs[2][1])
+    t.join(5)
+
+    images = storage.load_json("novel_n1_chapter_1.json")["images"]
+    assert images[0] == manual
+    assert [img["segment_index"] for img in images[1:]] == [0, 1, 2]
+    assert manager.get_task(task_id)["result"] == {"images": 3, "failed": 0, "segments": 3}
+
+def test_deterministic_seed_is_served_from_cache(generator):
+    gen, manager = generator
+    first = gen.submit_job("A  Red Fox", deterministic=True)
+    assert gen.client.last_kwargs["random_seed"] is False
+    gen.client.finish(gen.client.jobs[0][1])
+    assert manager.get_task(first)["result"]["cached"] is False
+
+    # Same prompt up to case/whitespace: no new render
+    second = gen.submit_job("a red fox ", deterministic=True)
+    task = manager.get_task(second)
+    assert task["status"] == "completed" and task["result"]["cached"] is True
+    assert len(gen.client.jobs) == 1
+    assert task["result"]["seed"] == manager.get_task(first)["result"]["seed"]
+
+    # Random seeds always render
+    gen.submit_job("a red fox")
+    assert len(gen.client.jobs) == 2
+    assert zmod.image_cache.get_stats()["hits"] == 1
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = ImageCache(str(tmp_path / "cache"), max_bytes=250, db_path=str(tmp_path / "cache.db"))
+    keys = [cache_key(f"p{i}", "1024x1024", 8, 1) for i in range(3)]
+    for key in keys[:2]:
+        src = tmp_path / f"{key}.src.png"
+        src.write_bytes(b"x" * 100)
+        cache.put(key, str(src))
+    # Touch the first entry so the second becomes least recently used
+    assert cache.get(keys[0], str(tmp_path / "hit.png"))
+    src = tmp_path / "third.png"
+    src.write_bytes(b"x" * 100)
+    cache.put(keys[2], str(src))
+
+    assert not cache.get(keys[1], str(tmp_path / "miss.png"))
+    assert cache.get(keys[0], str(tmp_path / "hit2.png"))
+    stats = cache.get_stats()
+    assert stats["evictions"] == 1 and stats["entries"] == 2 and stats["bytes"] == 200
+    # Handed-out copies survive eviction
+    assert (tmp_path / "hit.png").exists()
@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+from backend.config import settings
+from backend.utils import image_variants
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "STORAGE_PATH", str(tmp_path))
+    monkeypatch.setattr(settings, "IMAGE_VARIANT_PATH", str(tmp_path / "variants"))
+    source = tmp_path / "z_gen_abc.png"
+    Image.new("RGB", (1024, 768), (10, 120, 200)).save(source)
+    return tmp_path, str(source)
+
+def test_width_is_snapped_to_allowed_sizes():
+    assert image_variants.snap_width(1) == settings.IMAGE_VARIANT_WIDTHS[0]
+    assert image_variants.snap_width(200) == 256
+    assert image_variants.snap_width(10 ** 6) == settings.IMAGE_VARIANT_WIDTHS[-1]
+
+def test_variant_is_resized_and_generated_once(storage):
+    _, source = storage
+    path = image_variants.get_variant(source, 256, "webp")
+    with Image.open(path) as img:
+        assert img.format == "WEBP"
+        assert img.size == (256, 192)
+    mtime = os.path.getmtime(path)
+    assert image_variants.get_variant(source, 256, "webp") == path
+    assert os.path.getmtime(path) == mtime
+
+def test_static_mount_serves_variants(storage):
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    root, _ = storage
+    app = FastAPI()
+    app.mount("/data", image_variants.VariantStaticFiles(directory=str(root)))
+    client = TestClient(app)
+
+    original = client.get("/data/z_gen_abc.png")
+    # The source can be rewritten under its name, so the variant URL is versioned
+    redirect = client.get("/data/z_gen_abc.png?w=256", headers={"Accept": "image/webp,*/*"}, follow_redirects=False)
+    assert redirect.status_code in (302, 307) and redirect.headers["cache-control"] == "no-cache"
+    versioned = redirect.headers["location"]
+    assert versioned.startswith("/data/z_gen_abc.png?w=256&v=")
+    variant = client.get(versioned, headers={"Accept": "image/webp,*/*"})
+    assert variant.status_code == 200
+    assert variant.headers["content-type"] == "image/webp"
+    assert variant.headers["cache-control"] == "public, max-age=31536000, immutable"
+    assert client.get(versioned, headers={"Accept": "image/webp,*/*",
+                      "If-None-Match": variant.headers["etag"]}).status_code == 304
+    assert len(variant.content) < len(original.content)
+
+    # A rewritten source moves to a new version
+    Image.new("RGB", (800, 600), (200, 10, 10)).save(root / "z_gen_abc.png")
+    stale = client.get(versioned, follow_redirects=False)
+    assert stale.headers["location"] != versioned
+
+    # uuid-named files are never rewritten, so their variants need no version
+    unique = "z_gen_0123456789abcdef0123456789abcdef.png"
+    Image.new("RGB", (600, 400)).save(root / unique)
+    direct = client.get(f"/data/{unique}?w=256", follow_redirects=False)
+    assert direct.status_code == 200 and direct.headers["cache-control"] == "public, max-age=31536000, immutable"
+
+    # Not an image, or no width: served as-is
+    (root / "notes.json").write_text("{}")
+    assert client.get("/data/notes.json?w=256").text == "{}"
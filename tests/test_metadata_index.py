@@ -0,0 +1,68 @@
+import json
+import os
+
+import pytest
+
+from backend.config import settings
+from backend.utils import storage
+from backend.utils.metadata_index import MetadataIndex
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "STORAGE_PATH", str(tmp_path))
+    index = MetadataIndex(str(tmp_path / "index.db"))
+    monkeypatch.setattr(storage, "metadata_index", index)
+    return index
+
+@pytest.fixture
+def client(index, monkeypatch):
+    from fastapi.testclient import TestClient
+    from backend import main
+    monkeypatch.setattr(main, "metadata_index", index)
+    return TestClient(main.app)
+
+def test_saves_are_indexed_without_large_fields(index):
+    storage.save_json("novel_n1.json", {"id": "n1", "title": "长夜", "outline": "大纲" * 1000})
+    storage.save_json("novel_n1_chapter_2.json", {"chapter_num": 2, "content": "<p>第二章</p>" * 50})
+    storage.save_json("novel_n1_assets.json", [{"id": 1, "type": "character", "name": "林", "details": "x" * 5000}])
+
+    (_, novel), = index.novels()[0]
+    assert novel == {"id": "n1", "title": "长夜"}
+    (num, chapter), = index.chapters("n1")[0]
+    assert num == 2 and "content" not in chapter and chapter["word_count"] == 150
+    assert "details" not in index.assets("n1")[0][0][1]
+
+    storage.delete_file("novel_n1_chapter_2.json")
+    assert index.chapters("n1")[0] == []
+
+def test_resync_picks_up_files_written_directly(index, tmp_path):
+    storage.save_json("novel_n1.json", {"id": "n1", "title": "旧名"})
+    (tmp_path / "novel_n2.json").write_text(json.dumps({"id": "n2", "title": "外部"}), encoding="utf-8")
+    os.remove(tmp_path / "novel_n1.json")
+    assert index.sync(force=True) == 2
+    assert [meta["title"] for _, meta in index.novels()[0]] == ["外部"]
+
+def test_list_endpoints_page_with_cursor_and_fields(client, index):
+    for n in range(1, 8):
+        storage.save_json(f"novel_p_chapter_{n}.json", {"chapter_num": n, "content": f"<p>第{n}章</p>"})
+    storage.save_json("novel_p_assets.json", [
+        {"id": i, "type": "character" if i % 2 else "scene", "name": f"a{i}", "details": "长文" * 100} for i in range(5)
+    ])
+
+    seen = []
+    cursor = None
+    while True:
+        res = client.get("/api/novels/p/chapters", params={"limit": 3, **({"cursor": cursor} if cursor else {})})
+        seen += [c["chapter_num"] for c in res.json()]
+        cursor = res.headers.get("x-next-cursor")
+        if not cursor:
+            break
+    assert seen == list(range(1, 8))
+    assert client.get("/api/novels/p/chapters", params={"cursor": "%%%"}).status_code == 400
+
+    full = client.get("/api/novels/p/chapters", params={"limit": 1, "fields": "chapter_num,content"}).json()
+    assert full == [{"chapter_num": 1, "content": "<p>第1章</p>"}]
+
+    names = client.get("/api/novels/p/assets", params={"fields": "name", "type": "character"}).json()
+    assert names == [{"name": "a1"}, {"name": "a3"}]
+    assert client.get("/api/novels/p/assets").json()[0]["details"] == "长文" * 100
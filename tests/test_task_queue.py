@@ -0,0 +1,168 @@
+import time
+
+from backend.config import settings
+from backend.utils.task_manager import TaskManager
+from backend.utils.task_worker import TaskWorker, task_handler
+
+calls = []
+
+@task_handler("test_echo")
+def _echo(task_id, value):
+    calls.append(value)
+
+@task_handler("test_flaky")
+def _flaky(task_id):
+    raise RuntimeError("boom")
+
+def test_task_survives_new_manager_instance(tmp_path):
+    db = str(tmp_path / "tasks.db")
+    task_id = TaskManager(db).create_task("test_echo", "persisted", payload={"value": 1})
+
+    # A fresh manager (e.g. after a restart, or another process) sees the same task
+    task = TaskManager(db).get_task(task_id)
+    assert task["status"] == "pending"
+    assert task["description"] == "persisted"
+
+def test_worker_runs_queued_task(tmp_path):
+    manager = TaskManager(str(tmp_path / "tasks.db"))
+    task_id = manager.create_task("test_echo", payload={"value": 42})
+
+    worker = TaskWorker(manager=manager)
+    assert worker.run_once()
+    assert not worker.run_once()
+
+    assert 42 in calls
+    task = manager.get_task(task_id)
+    assert task["status"] == "completed"
+    assert task["progress"] == 100
+
+def test_failed_task_is_retried_then_failed(tmp_path, monkeypatch):
+    from backend.config import settings
+    monkeypatch.setattr(settings, "TASK_RETRY_BACKOFF_SECONDS", 0)
+
+    manager = TaskManager(str(tmp_path / "tasks.db"))
+    task_id = manager.create_task("test_flaky", payload={}, max_attempts=2)
+    worker = TaskWorker(manager=manager)
+
+    assert worker.run_once()
+    task = manager.get_task(task_id)
+    assert task["status"] == "pending"
+    assert task["attempts"] == 1
+
+    assert worker.run_once()
+    task = manager.get_task(task_id)
+    assert task["status"] == "failed"
+    assert task["error"] == "boom"
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    manager = TaskManager(str(tmp_path / "tasks.db"))
+    task_id = manager.create_task("test_echo", payload={"value": 7})
+
+    claimed = manager.claim_task("dead-worker", lease_seconds=1)
+    assert claimed["id"] == task_id
+    assert manager.claim_task("other-worker") is None
+
+    time.sleep(1.1)
+    reclaimed = manager.claim_task("other-worker")
+    assert reclaimed["id"] == task_id
+    assert reclaimed["attempts"] == 2
+
+    # The stale worker can no longer finish the task
+    manager.complete_task(task_id, "dead-worker")
+    assert manager.get_task(task_id)["status"] == "processing"
+
+def test_group_limit_holds_tasks_in_queue(tmp_path):
+    manager = TaskManager(str(tmp_path / "tasks.db"))
+    manager.set_limit("chapter", 1)
+    first = manager.create_task("chapter_generation", payload={})
+    second = manager.create_task("chapter_generation", payload={})
+    outline = manager.create_task("outline_generation", payload={})
+
+    assert manager.get_task(second)["queue_position"] == 2
+
+    assert manager.claim_task("w1")["id"] == first
+    # Chapter group is full, so the outline task is claimed next
+    assert manager.claim_task("w1")["id"] == outline
+    assert manager.claim_task("w1") is None
+    assert manager.get_task(second)["queue_position"] == 1
+
+    # Raising the limit at runtime releases the waiting task
+    manager.set_limit("chapter", 2)
+    assert manager.claim_task("w1")["id"] == second
+    assert manager.get_queue_stats()["chapter"] == {"limit": 2, "running": 2, "queued": 0}
+
+def test_prune_archives_finished_tasks(tmp_path):
+    manager = TaskManager(str(tmp_path / "tasks.db"))
+    done = [manager.create_task("test_echo", novel_id="n1") for _ in range(3)]
+    for task_id in done:
+        manager.update_task(task_id, status="completed")
+    running = manager.create_task("test_echo", novel_id="n1")
+    manager.update_task(running, status="processing")
+
+    # Keep only the newest finished task
+    assert manager.prune(ttl_seconds=3600, max_finished=1) == 2
+    assert {t["id"] for t in manager.get_novel_tasks("n1")} == {running, done[2]}
+    assert {t["id"] for t in manager.get_active_tasks("n1")} == {running, done[2]}
+
+    # Archived tasks can still be looked up by id
+    assert manager.get_task(done[0])["status"] == "completed"
+
+    assert manager.prune(ttl_seconds=0, max_finished=100) == 1
+    assert [t["id"] for t in manager.get_novel_tasks("n1")] == [running]
+
+def test_prune_trims_the_archive(tmp_path, monkeypatch):
+    manager = TaskManager(str(tmp_path / "tasks.db"))
+    done = [manager.create_task("test_echo") for _ in range(4)]
+    for task_id in done:
+        manager.update_task(task_id, status="completed")
+    monkeypatch.setattr(settings, "TASK_ARCHIVE_MAX", 2)
+    assert manager.prune(ttl_seconds=0) == 4
+    assert manager._conn().execute("SELECT COUNT(*) FROM tasks_archive").fetchone()[0] == 2
+
+    monkeypatch.setattr(settings, "TASK_ARCHIVE_RETENTION_SECONDS", -1)
+    manager.prune(ttl_seconds=0)
+    assert manager.get_task(done[0]) is None
+
+def test_orphaned_in_process_tasks_are_failed(tmp_path):
+    manager = TaskManager(str(tmp_path / "tasks.db"))
+    live = manager.create_task("image_generation", "live")
+    orphan = manager.create_task("image_generation", "orphan")
+    # Its process died before the lease was renewed
+    manager._conn().execute("UPDATE tasks SET lease_expires = ? WHERE id = ?", (time.time() - 1, orphan))
+
+    manager.prune()
+    assert manager.get_task(orphan)["status"] == "failed"
+    assert manager.get_task(live)["status"] == "pending"
+    assert [t["id"] for t in manager.get_active_tasks() if t["status"] == "pending"] == [live]
+
+def test_duplicate_submission_returns_existing_task(tmp_path):
+    manager = TaskManager(str(tmp_path / "tasks.db"))
+    first = manager.create_task("chapter_generation", payload={}, idempotency_key="chapter:n1:3")
+    assert manager.create_task("chapter_generation", payload={}, idempotency_key="chapter:n1:3") == first
+    assert manager.create_task("chapter_generation", payload={}, idempotency_key="chapter:n1:4") != first
+
+    # Once the first task has finished a new submission starts a new task
+    manager.update_task(first, status="completed")
+    assert manager.create_task("chapter_generation", payload={}, idempotency_key="chapter:n1:3") != first
+
+@task_handler("test_cancellable")
+def _cancellable(task_id):
+    # Simulates a cancel request arriving while the handler runs
+    _cancellable.manager.cancel_task(task_id)
+    _cancellable.manager.check_cancelled(task_id)
+    raise AssertionError("should have been cancelled")
+
+def test_cancel_queued_and_running_tasks(tmp_path):
+    manager = TaskManager(str(tmp_path / "tasks.db"))
+    worker = TaskWorker(manager=manager)
+
+    queued = manager.create_task("test_echo", payload={"value": 0})
+    assert manager.cancel_task(queued)["status"] == "cancelled"
+    assert not worker.run_once()
+
+    _cancellable.manager = manager
+    running = manager.create_task("test_cancellable", payload={})
+    assert worker.run_once()
+    task = manager.get_task(running)
+    assert task["status"] == "cancelled"
+    assert task["attempts"] == 1
@@ -0,0 +1,75 @@
+import time
+
+from backend.utils.text_segmenter import (
+    clip_text, estimate_tokens, html_to_text, segment_html, segment_stable, segment_text, split_sentences
+)
+
+SENTENCE = "夜色渐深，城外的风卷起落叶，他低声说道：“我们必须在天亮之前离开。”"
+
+def test_sentences_keep_closing_quotes():
+    text = "他说：“走吧！”她点头。真的吗？Yes. Done"
+    assert [text[s:e] for s, e in split_sentences(text)] == ["他说：“走吧！”", "她点头。", "真的吗？", "Yes.", "Done"]
+
+def test_html_offsets_map_back_to_source():
+    content = "<p>第一句。</p><p>A &amp; B。<br>第三句。</p>"
+    text, offsets = html_to_text(content)
+    assert text == "第一句。\nA & B。\n第三句。\n"
+    for seg in segment_html(content, max_chars=6):
+        source = content[seg.source_start:seg.source_end]
+        assert html_to_text(source)[0].strip() == seg.text
+
+def test_segments_respect_budget_and_sentence_boundaries():
+    text = SENTENCE * 40
+    segments = segment_text(text, max_chars=200)
+    assert all(len(s.text) <= 200 for s in segments)
+    assert all(s.text.endswith("”") for s in segments)
+    assert "".join(s.text for s in segments) == text
+
+def test_segments_are_balanced():
+    # Greedy packing would give 500/500/100; balanced packing evens them out
+    text = "。".join(["字" * 49] * 22) + "。"
+    sizes = [len(s.text) for s in segment_text(text, max_chars=500)]
+    assert len(sizes) == 3
+    assert max(sizes) - min(sizes) <= 50
+
+def test_overlap_repeats_trailing_sentences():
+    text = SENTENCE * 20
+    segments = segment_text(text, max_chars=200, overlap=80)
+    for prev, seg in zip(segments, segments[1:]):
+        assert seg.overlap > 0
+        assert prev.text.endswith(seg.text[:seg.overlap])
+        assert seg.start < prev.end
+
+def test_long_sentence_is_cut_at_clauses():
+    text = "，".join(["很长的从句"] * 100) + "。"
+    segments = segment_text(text, max_chars=60)
+    assert all(len(s.text) <= 60 for s in segments)
+    assert all(s.text.endswith(("，", "。")) for s in segments)
+
+def test_token_budget():
+    segments = segment_text(SENTENCE * 50 + " English words mixed in." * 20, max_tokens=300)
+    assert all(estimate_tokens(s.text) <= 300 for s in segments)
+
+def test_clip_text_stops_at_sentence():
+    assert clip_text(SENTENCE * 3, len(SENTENCE) * 2 + 5) == SENTENCE * 2
+    assert clip_text("无标点" * 10, 5) == "无标点无标"
+
+def test_100k_character_chapter_is_fast():
+    content = ("<p>" + SENTENCE * 8 + "</p>") * 400
+    assert len(content) > 100_000
+    started = time.perf_counter()
+    segments = segment_html(content, max_chars=500)
+    overlapping = segment_html(content, max_chars=500, overlap=50)
+    assert time.perf_counter() - started < 2
+    sizes = [len(s.text) for s in segments]
+    assert max(sizes) <= 500 and min(sizes) > 400
+    sizes = [len(s.text) for s in overlapping]
+    assert max(sizes) <= 500 and min(sizes) > 300
+
+def test_stable_segments_survive_edits():
+    sentences = [f"第{i}段里有一句长短不一的话{'啊' * (i % 7)}。" for i in range(300)]
+    before = [s.text for s in segment_stable("".join(sentences), max_chars=200)]
+    sentences[150] = "改写过的句子。"
+    after = [s.text for s in segment_stable("".join(sentences), max_chars=200)]
+    assert all(len(s) <= 200 for s in after)
+    assert len(set(after) - set(before)) <= 2
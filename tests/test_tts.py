@@ -0,0 +1,254 @@
+import asyncio
+import json
+import os
+import time
+
+import pytest
+
+from backend.config import settings
+from backend.services import generation_tasks, tts_service
+from backend.services.tts_backends import SyntheticTTSBackend
+from backend.utils import html_text, mp3
+from backend.utils.task_manager import TaskManager
+from backend.utils.tts_cache import AudioCache
+
+FRAME = mp3.SILENT_FRAME
+
+def test_frame_parsing_and_duration():
+    assert mp3.parse_header(FRAME[:4]) == (144, 24000, 576)
+    data = FRAME * 50
+    assert [f[0] for f in mp3.iter_frames(data)][:3] == [0, 144, 288]
+    assert mp3.duration_ms(data) == 1200
+
+def test_audio_frames_drops_tags_and_partial_frames():
+    id3 = b"ID3\x04\x00\x00\x00\x00\x00\x05" + b"x" * 5
+    data = id3 + FRAME * 3 + FRAME[:50]
+    assert mp3.audio_frames(data) == FRAME * 3
+    # Fed in chunks that split the tag and the frames
+    frames = mp3.FrameFilter()
+    assert b"".join(frames.feed(data[i:i + 7]) for i in range(0, len(data), 7)) == FRAME * 3
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+    cache = AudioCache(str(tmp_path / "tts_cache"), 10 * 1024 * 1024, str(tmp_path / "tts_cache.db"))
+    monkeypatch.setattr(tts_service, "tts_cache", cache)
+    return cache
+
+@pytest.fixture
+def fake_tts(monkeypatch):
+    calls = {"active": 0, "max_active": 0, "texts": []}
+
+    async def synthesize_segment(text, voice=tts_service.DEFAULT_VOICE, rate="+0%"):
+        calls["active"] += 1
+        calls["max_active"] = max(calls["max_active"], calls["active"])
+        calls["texts"].append(text)
+        # Later segments finish first, so ordering must not depend on completion
+        await asyncio.sleep(0.01 / (len(calls["texts"])))
+        calls["active"] -= 1
+        return FRAME * len(text)
+
+    monkeypatch.setattr(tts_service, "synthesize_segment", synthesize_segment)
+    monkeypatch.setattr(settings, "TTS_SEGMENT_CHARS", 40)
+    monkeypatch.setattr(settings, "TTS_CONCURRENCY", 3)
+    return calls
+
+def test_segments_are_joined_in_order_with_index(fake_tts, tmp_path):
+    text = "".join(f"第{i}句话写在这里。" for i in range(30))
+    out = tmp_path / "chapter.mp3"
+    progress = []
+    index = asyncio.run(tts_service.synthesize_to_file(text, str(out), on_progress=lambda d, t: progress.append((d, t))))
+
+    segments = index["segments"]
+    assert len(segments) > 3
+    assert fake_tts["max_active"] == 3
+    assert progress[-1] == (len(segments), len(segments))
+    # One frame per character, in text order
+    assert out.read_bytes() == FRAME * sum(s["text_end"] - s["text_start"] for s in segments)
+    assert index["duration_ms"] == mp3.duration_ms(out.read_bytes())
+    for prev, seg in zip(segments, segments[1:]):
+        assert seg["start_ms"] == prev["end_ms"]
+        assert text[seg["text_start"]:seg["text_end"]].startswith(seg["preview"])
+
+def test_audio_task_saves_audio_index_and_asset(fake_tts, tmp_path, monkeypatch):
+    manager = TaskManager(str(tmp_path / "tasks.db"))
+    monkeypatch.setattr(generation_tasks, "task_manager", manager)
+    monkeypatch.setattr(settings, "STORAGE_PATH", str(tmp_path))
+    generation_tasks.storage.save_json("novel_n1_chapter_2.json", {"content": "<p>" + "他走进了院子。" * 30 + "</p>"})
+
+    task_id = manager.create_task("audio_generation", "audio", stages=["a", "b", "c", "d"])
+    generation_tasks.run_audio_generation(task_id, "n1", 2)
+
+    task = manager.get_task(task_id)
+    assert task["status"] == "completed"
+    asset = task["result"]["asset"]
+    audio = tmp_path / asset["file_path"]
+    index = json.loads((tmp_path / asset["index_path"]).read_text(encoding="utf-8"))
+    assert mp3.duration_ms(audio.read_bytes()) == index["duration_ms"]
+    # Offsets point into the chapter's plain text
+    plain = html_text.plain_text(generation_tasks.storage.load_json("novel_n1_chapter_2.json")["content"])
+    first = index["segments"][0]
+    assert plain[first["source_start"]:first["source_end"]].startswith(first["preview"])
+    assets = generation_tasks.storage.load_json("novel_n1_assets.json")
+    assert assets[-1]["file_path"] == asset["file_path"]
+
+@pytest.fixture
+def fake_stream(monkeypatch, tmp_path):
+    calls = {"started": []}
+
+    async def stream_segment(text, voice=tts_service.DEFAULT_VOICE, rate="+0%"):
+        calls["started"].append(text)
+        # Like edge-tts, the service may send more than audio frames
+        yield b"ID3\x04\x00\x00\x00\x00\x00\x05" + b"x" * 5
+        for ch in text:
+            await asyncio.sleep(0.001)
+            yield FRAME
+
+    monkeypatch.setattr(tts_service, "stream_segment", stream_segment)
+    monkeypatch.setattr(settings, "TTS_SEGMENT_CHARS", 40)
+    monkeypatch.setattr(settings, "TTS_CONCURRENCY", 2)
+    return calls
+
+def test_stream_relays_audio_and_fills_cache(fake_stream):
+    text = "".join(f"第{i}句话写在这里。" for i in range(30))
+
+    async def consume():
+        path, stream = tts_service.stream_to_cache(text)
+        assert path is None
+        chunks = []
+        async for data in stream:
+            if not chunks:
+                # First audio goes out before the later segments have even started
+                assert len(fake_stream["started"]) <= settings.TTS_CONCURRENCY
+            chunks.append(data)
+        return b"".join(chunks)
+
+    audio = asyncio.run(consume())
+    assert audio == FRAME * len("".join(fake_stream["started"]))
+    path, stream = tts_service.stream_to_cache(text)
+    assert stream is None
+    assert open(path, "rb").read() == audio
+
+def test_interrupted_stream_is_not_cached(fake_stream, cache):
+    text = "".join(f"第{i}句话写在这里。" for i in range(30))
+
+    async def consume_some():
+        _, stream = tts_service.stream_to_cache(text)
+        async for _ in stream:
+            break
+        await stream.aclose()
+
+    asyncio.run(consume_some())
+    path, stream = tts_service.stream_to_cache(text)
+    assert stream is not None
+    assert not [name for name in os.listdir(cache.cache_dir) if name.endswith(".part")]
+
+def test_tts_endpoint_uses_the_cache(fake_stream):
+    from fastapi.testclient import TestClient
+    from backend import main
+    client = TestClient(main.app)
+    text = "".join(f"第{i}句话写在这里。" for i in range(5))
+    first = client.post("/api/tts", json={"text": text})
+    assert first.status_code == 200 and first.headers["content-type"] == "audio/mpeg"
+    started = len(fake_stream["started"])
+    second = client.post("/api/tts", json={"text": text})
+    assert second.content == first.content and len(fake_stream["started"]) == started
+    assert client.post("/api/tts", json={"text": "  \n "}).status_code == 400
+
+def test_edit_resynthesizes_only_changed_segments(fake_tts, tmp_path):
+    sentences = [f"第{i}句话写在这里。" for i in range(60)]
+    asyncio.run(tts_service.synthesize_to_file("".join(sentences), str(tmp_path / "a.mp3")))
+    first_run = len(fake_tts["texts"])
+
+    sentences[30] = "这一句被改写了。"
+    fake_tts["texts"].clear()
+    index = asyncio.run(tts_service.synthesize_to_file("".join(sentences), str(tmp_path / "b.mp3")))
+    assert 1 <= len(fake_tts["texts"]) <= 2 < first_run
+    assert any("这一句被改写了" in text for text in fake_tts["texts"])
+    assert index["duration_ms"] == mp3.duration_ms((tmp_path / "b.mp3").read_bytes())
+
+def test_repeated_audio_task_reuses_and_collapses_assets(fake_tts, tmp_path, monkeypatch):
+    manager = TaskManager(str(tmp_path / "tasks.db"))
+    monkeypatch.setattr(generation_tasks, "task_manager", manager)
+    monkeypatch.setattr(settings, "STORAGE_PATH", str(tmp_path))
+    storage = generation_tasks.storage
+    storage.save_json("novel_n1_chapter_1.json", {"content": "<p>" + "他走进了院子。" * 30 + "</p>"})
+    # Duplicates left by earlier versions, plus an unrelated asset
+    storage.save_json("novel_n1_assets.json", [
+        {"id": 1, "type": "audio", "name": "old", "role": "Chapter 1 Audio", "file_path": "novel_n1/audio/old1.mp3"},
+        {"id": 2, "type": "audio", "name": "old", "role": "Chapter 1 Audio", "file_path": "novel_n1/audio/old2.mp3"},
+        {"id": 3, "type": "character", "name": "林", "role": "主角"},
+    ])
+
+    def run():
+        task_id = manager.create_task("audio_generation", "audio", stages=["a", "b", "c", "d"])
+        generation_tasks.run_audio_generation(task_id, "n1", 1)
+        return manager.get_task(task_id)["result"]
+
+    first = run()
+    assets = storage.load_json("novel_n1_assets.json")
+    assert [a["id"] for a in assets] == [3, 1]
+    assert assets[1]["file_path"] == first["asset"]["file_path"]
+
+    calls = len(fake_tts["texts"])
+    second = run()
+    assert second["cached"] and second["asset"]["id"] == 1
+    assert len(fake_tts["texts"]) == calls
+    assert len(storage.load_json("novel_n1_assets.json")) == 2
+
+def test_audiobook_build_resumes_from_chapter_checkpoints(fake_tts, tmp_path, monkeypatch):
+    manager = TaskManager(str(tmp_path / "tasks.db"))
+    monkeypatch.setattr(generation_tasks, "task_manager", manager)
+    monkeypatch.setattr(settings, "STORAGE_PATH", str(tmp_path))
+    storage = generation_tasks.storage
+    storage.save_json("novel_b1.json", {"id": "b1", "title": "长夜"})
+    for num in (1, 2, 10):
+        storage.save_json(f"novel_b1_chapter_{num}.json", {"chapter_num": num, "content": f"<p>{'第%d章的故事继续。' % num * 12}</p>"})
+
+    def run():
+        task_id = manager.create_task("audiobook_generation", "book", stages=["a", "b", "c", "d"])
+        generation_tasks.run_audiobook_generation(task_id, "b1")
+        return manager.get_task(task_id)["result"]
+
+    first = run()
+    manifest = first["manifest"]
+    assert [c["chapter_num"] for c in manifest["chapters"]] == [1, 2, 10]
+    assert first["resumed_chapters"] == 0
+    book = (tmp_path / manifest["file_path"]).read_bytes()
+    assert book.startswith(b"ID3") and b"CTOC" in book and book.count(b"CHAP") == 3
+    assert mp3.duration_ms(mp3.strip_id3(book)) == manifest["duration_ms"] == manifest["chapters"][-1]["end_ms"]
+
+    # Only the edited chapter is rebuilt
+    storage.save_json("novel_b1_chapter_2.json", {"chapter_num": 2, "content": "<p>改写后的第二章。</p>"})
+    second = run()
+    assert second["resumed_chapters"] == 2
+    assert second["manifest"]["chapters"][1]["tts_key"] != manifest["chapters"][1]["tts_key"]
+
+def test_synthetic_backend_produces_valid_mp3():
+    backend = SyntheticTTSBackend(latency_ms=0, speed=0, chars_per_second=4)
+
+    async def collect(rate):
+        return b"".join([data async for data in backend.stream("一二三四五六七八", "any", rate)])
+
+    audio = asyncio.run(collect("+0%"))
+    assert mp3.audio_frames(audio) == audio
+    assert abs(mp3.duration_ms(audio) - 2000) <= mp3.SILENT_FRAME_MS
+    assert mp3.duration_ms(asyncio.run(collect("+100%"))) < 1100
+
+def test_offline_chapters_synthesize_concurrently(monkeypatch, tmp_path):
+    monkeypatch.setattr(tts_service, "tts_backend", SyntheticTTSBackend(latency_ms=100, speed=0))
+    monkeypatch.setattr(settings, "TTS_SEGMENT_CHARS", 40)
+    monkeypatch.setattr(settings, "TTS_CONCURRENCY", 4)
+    chapters = ["".join(f"第{n}章第{i}句话。" for i in range(16)) for n in range(3)]
+
+    async def run():
+        return await asyncio.gather(*(tts_service.synthesize_to_file(text, str(tmp_path / f"{n}.mp3"))
+                                      for n, text in enumerate(chapters)))
+
+    started = time.perf_counter()
+    indexes = asyncio.run(run())
+    elapsed = time.perf_counter() - started
+    segments = sum(len(index["segments"]) for index in indexes)
+    # Serial synthesis would take segments x 100 ms
+    assert segments >= 12 and elapsed < segments * 0.1 / 2
+    for n, index in enumerate(indexes):
+        assert mp3.duration_ms((tmp_path / f"{n}.mp3").read_bytes()) == index["duration_ms"] > 0